@@ -0,0 +1,320 @@
+"""
+A local stand-in for the parts of B2 the puller and the web app use:
+authorizing, downloading files by id, and uploading files, whole or as
+large files in parts. Point B2_REALM at its URL.
+
+Latency, bandwidth and failures can be injected to see how the sync path
+copes with a slow or flaky B2.
+"""
+
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+AUTH_TOKEN = "fake-b2-auth-token"
+UPLOAD_TOKEN = "fake-b2-upload-token"
+
+
+class FakeB2(ThreadingHTTPServer):
+    """
+    Serves files from files, a dict of file id to bytes. Uploaded files
+    are added to it, and their names and infos kept in uploads.
+
+    :param latency: seconds to wait before answering each request
+    :param throttle: bytes per second to send each response at, or None
+    :param fail_rate: fraction of downloads and uploads answered with a 503
+    :param drop_rate: fraction of downloads cut off half way through
+    """
+
+    daemon_threads = True
+
+    def __init__(self, files, latency=0.0, throttle=None, fail_rate=0.0, drop_rate=0.0, port=0):
+        super().__init__(("127.0.0.1", port), FakeB2Handler)
+        self.files = files
+        self.uploads = {}  # file id -> {"fileName": ..., "fileInfo": ...}
+        self.large_files = {}  # file id of an unfinished large file -> {part number: bytes}
+        self.sha1s = {file_id: hashlib.sha1(data).hexdigest() for file_id, data in files.items()}
+        self.latency = latency
+        self.throttle = throttle
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self._lock = threading.Lock()
+        self._file_ids = itertools.count()
+        self.random = random.Random(0)
+        self.stats = {"requests": 0, "authorizations": 0, "downloads": 0, "failures": 0, "bytes_sent": 0,
+                      "upload_urls": 0, "uploads": 0, "parts": 0, "bytes_received": 0}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def new_file_id(self):
+        with self._lock:
+            return f"fake-upload-{next(self._file_ids)}"
+
+    def count(self, stat, n=1):
+        with self._lock:
+            self.stats[stat] += n
+
+    def roll(self, rate):
+        with self._lock:
+            return self.random.random() < rate
+
+
+class FakeB2Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        # b2sdk POSTs its API calls with a JSON body; uploads POST the file
+        self.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.do_GET()
+
+    def json_body(self):
+        return json.loads(self.body) if getattr(self, "body", None) else {}
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urlparse(self.path)
+        if re.fullmatch(r"/b2api/v\d+/b2_authorize_account", url.path):
+            self.authorize()
+        elif re.fullmatch(r"/b2api/v\d+/b2_download_file_by_id", url.path):
+            self.download(parse_qs(url.query).get("fileId", [""])[0])
+        elif re.fullmatch(r"/b2api/v\d+/b2_get_upload_url", url.path):
+            self.get_upload_url()
+        elif re.fullmatch(r"/b2api/v\d+/b2_start_large_file", url.path):
+            self.start_large_file()
+        elif re.fullmatch(r"/b2api/v\d+/b2_get_upload_part_url", url.path):
+            self.get_upload_part_url()
+        elif re.fullmatch(r"/b2api/v\d+/b2_list_parts", url.path):
+            self.list_parts()
+        elif re.fullmatch(r"/b2api/v\d+/b2_finish_large_file", url.path):
+            self.finish_large_file()
+        elif re.fullmatch(r"/b2api/v\d+/b2_get_file_info", url.path):
+            self.get_file_info()
+        elif url.path == "/upload":
+            self.upload_file()
+        elif url.path.startswith("/upload_part/"):
+            self.upload_part(url.path[len("/upload_part/"):])
+        else:
+            self.send_json(404, {"status": 404, "code": "not_found", "message": url.path})
+
+    def authorize(self):
+        self.server.count("authorizations")
+        storage_api = {
+            "apiUrl": self.server.url,
+            "downloadUrl": self.server.url,
+            "s3ApiUrl": self.server.url,
+            "recommendedPartSize": 100 * 1000 * 1000,
+            "absoluteMinimumPartSize": 5 * 1000 * 1000,
+        }
+        allowed = {"bucketId": None, "bucketName": None, "capabilities": ["readFiles", "writeFiles"],
+                   "namePrefix": None}
+        # answer in the shape of both the v2 and v3 APIs, whichever b2sdk asks for
+        self.send_json(200, dict(
+            storage_api,
+            accountId="fake-account",
+            authorizationToken=AUTH_TOKEN,
+            allowed=allowed,
+            apiInfo={"storageApi": dict(
+                storage_api,
+                # b2sdk's v2 interface reads these from here
+                **allowed,
+                infoType="storageApi",
+                allowed={"buckets": [], "capabilities": allowed["capabilities"], "namePrefix": None},
+            )},
+        ))
+
+    def authorized(self):
+        if self.headers.get("Authorization") != AUTH_TOKEN:
+            self.send_json(401, {"status": 401, "code": "bad_auth_token", "message": "bad auth token"})
+            return False
+        return True
+
+    def get_upload_url(self):
+        if not self.authorized():
+            return
+        self.server.count("upload_urls")
+        self.send_json(200, {"bucketId": "fake-bucket", "uploadUrl": f"{self.server.url}/upload",
+                             "authorizationToken": UPLOAD_TOKEN})
+
+    def check_upload(self):
+        """
+        Check an upload's token and SHA-1, maybe injecting a failure.
+        """
+
+        server = self.server
+        if self.headers.get("Authorization") != UPLOAD_TOKEN:
+            self.send_json(401, {"status": 401, "code": "bad_auth_token", "message": "bad upload token"})
+            return False
+        if server.roll(server.fail_rate):
+            server.count("failures")
+            self.send_json(503, {"status": 503, "code": "service_unavailable", "message": "injected failure"})
+            return False
+        if hashlib.sha1(self.body).hexdigest() != self.headers.get("X-Bz-Content-Sha1"):
+            self.send_json(400, {"status": 400, "code": "bad_request", "message": "sha1 did not match data"})
+            return False
+        server.count("bytes_received", len(self.body))
+        return True
+
+    def upload_file(self):
+        server = self.server
+        if not self.check_upload():
+            return
+        file_id = server.new_file_id()
+        info = {key[len("X-Bz-Info-"):]: value for key, value in self.headers.items() if key.startswith("X-Bz-Info-")}
+        with server._lock:
+            server.files[file_id] = self.body
+            server.sha1s[file_id] = self.headers["X-Bz-Content-Sha1"]
+            server.uploads[file_id] = {"fileName": self.headers["X-Bz-File-Name"], "fileInfo": info}
+        server.count("uploads")
+        self.send_json(200, {"fileId": file_id, "fileName": self.headers["X-Bz-File-Name"],
+                             "contentLength": len(self.body), "contentSha1": self.headers["X-Bz-Content-Sha1"]})
+
+    def start_large_file(self):
+        server = self.server
+        if not self.authorized():
+            return
+        body = self.json_body()
+        file_id = server.new_file_id()
+        with server._lock:
+            server.large_files[file_id] = {}
+            server.uploads[file_id] = {"fileName": body["fileName"], "fileInfo": body.get("fileInfo", {})}
+        self.send_json(200, {"fileId": file_id, "fileName": body["fileName"], "fileInfo": body.get("fileInfo", {})})
+
+    def get_upload_part_url(self):
+        if not self.authorized():
+            return
+        file_id = self.json_body()["fileId"]
+        self.send_json(200, {"fileId": file_id, "uploadUrl": f"{self.server.url}/upload_part/{file_id}",
+                             "authorizationToken": UPLOAD_TOKEN})
+
+    def upload_part(self, file_id):
+        server = self.server
+        if file_id not in server.large_files:
+            self.send_json(400, {"status": 400, "code": "bad_request", "message": "no such large file"})
+            return
+        if not self.check_upload():
+            return
+        part_number = int(self.headers["X-Bz-Part-Number"])
+        with server._lock:
+            server.large_files[file_id][part_number] = self.body
+        server.count("parts")
+        self.send_json(200, {"fileId": file_id, "partNumber": part_number, "contentLength": len(self.body),
+                             "contentSha1": self.headers["X-Bz-Content-Sha1"]})
+
+    def list_parts(self):
+        server = self.server
+        if not self.authorized():
+            return
+        with server._lock:
+            parts = server.large_files.get(self.json_body()["fileId"], {})
+            parts = [{"partNumber": n, "contentLength": len(parts[n]), "contentSha1": hashlib.sha1(parts[n]).hexdigest()}
+                     for n in sorted(parts)]
+        self.send_json(200, {"parts": parts, "nextPartNumber": None})
+
+    def finish_large_file(self):
+        server = self.server
+        if not self.authorized():
+            return
+        body = self.json_body()
+        file_id = body["fileId"]
+        with server._lock:
+            parts = server.large_files.get(file_id, {})
+            sha1s = [hashlib.sha1(parts[n]).hexdigest() for n in sorted(parts)]
+            if sorted(parts) != list(range(1, len(parts) + 1)) or sha1s != body["partSha1Array"]:
+                finished = False
+            else:
+                finished = True
+                del server.large_files[file_id]
+                server.files[file_id] = b"".join(parts[n] for n in sorted(parts))
+                server.sha1s[file_id] = hashlib.sha1(server.files[file_id]).hexdigest()
+        if not finished:
+            self.send_json(400, {"status": 400, "code": "bad_request", "message": "parts don't match"})
+            return
+        server.count("uploads")
+        self.send_json(200, {"fileId": file_id, "fileName": server.uploads[file_id]["fileName"],
+                             "contentLength": len(server.files[file_id]), "contentSha1": "none"})
+
+    def get_file_info(self):
+        server = self.server
+        if not self.authorized():
+            return
+        file_id = self.json_body()["fileId"]
+        if file_id not in server.files:
+            self.send_json(404, {"status": 404, "code": "not_found", "message": file_id})
+            return
+        upload = server.uploads.get(file_id, {"fileName": file_id, "fileInfo": {}})
+        # B2 only checks the SHA-1 of files uploaded whole
+        large = "large_file_sha1" in upload["fileInfo"]
+        self.send_json(200, {"fileId": file_id, "fileName": upload["fileName"], "fileInfo": upload["fileInfo"],
+                             "contentLength": len(server.files[file_id]),
+                             "contentSha1": "none" if large else server.sha1s[file_id]})
+
+    def download(self, file_id):
+        server = self.server
+        if not self.authorized():
+            return
+        if file_id not in server.files:
+            self.send_json(404, {"status": 404, "code": "not_found", "message": file_id})
+            return
+
+        server.count("downloads")
+        if server.roll(server.fail_rate):
+            server.count("failures")
+            self.send_json(503, {"status": 503, "code": "service_unavailable", "message": "injected failure"})
+            return
+
+        data = server.files[file_id]
+        start = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_json(416, {"status": 416, "code": "range_not_satisfiable", "message": "bad range"})
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("X-Bz-File-Id", file_id)
+        self.send_header("X-Bz-Content-Sha1", server.sha1s[file_id])
+        self.end_headers()
+
+        end = len(data)
+        if server.roll(server.drop_rate):
+            server.count("failures")
+            end = start + (end - start) // 2
+            self.close_connection = True
+
+        chunk_size = 64 * 1024
+        for offset in range(start, end, chunk_size):
+            chunk = data[offset:min(offset + chunk_size, end)]
+            self.wfile.write(chunk)
+            server.count("bytes_sent", len(chunk))
+            if server.throttle:
+                time.sleep(len(chunk) / server.throttle)
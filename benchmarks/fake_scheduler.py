@@ -0,0 +1,123 @@
+"""
+A local stand-in for the scheduler's station API: the /schedule feed,
+built from generated shows and episodes, and /station/status.
+"""
+
+import json
+import math
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+
+STATION_TOKEN = "fake-station-token"
+
+
+def make_wav(size, rate=8000):
+    """
+    A mono 16 bit WAV file of a 440 Hz tone, size bytes long, so that
+    downloads pass the puller's audio analysis.
+    """
+
+    frames = (size - 44) // 2
+    second = b"".join(struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / rate))) for i in range(rate))
+    samples = (second * (frames // rate + 1))[:frames * 2]
+    header = struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + len(samples), b"WAVE", b"fmt ", 16, 1, 1, rate,
+                         rate * 2, 2, 16, b"data", len(samples))
+    return header + samples
+
+
+def generate_schedule(shows, episodes_per_show, download_path):
+    """
+    shows shows with episodes_per_show weekly episodes each, starting an
+    hour from now. Each show's playout file is under download_path.
+
+    Returns (shows for the feed, file ids of the episodes).
+    """
+
+    now = int(time.time())
+    week = 7 * 24 * 60 * 60
+    feed = []
+    file_ids = []
+    for show_id in range(1, shows + 1):
+        first = now + 60 * 60 + (show_id * 60 * 60) % week
+        episodes = []
+        for n in range(episodes_per_show):
+            file_id = f"fake-file-{show_id}-{n}"
+            file_ids.append(file_id)
+            episodes.append({"id": show_id * 1000 + n, "title": f"episode {n}", "air_date": first + n * week,
+                             "file_id": file_id})
+        feed.append({"id": show_id, "title": f"show {show_id}", "file_path": f"{download_path}/playout-{show_id}.wav",
+                     "next_air_date": first, "episodes": episodes})
+    return feed, file_ids
+
+
+class FakeScheduler(ThreadingHTTPServer):
+    """
+    Serves shows, a /schedule feed list, with the ETag handling of the
+    real feed, and takes status reports.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, shows, port=0):
+        super().__init__(("127.0.0.1", port), FakeSchedulerHandler)
+        self.shows = shows
+        self.etag = f'"{len(shows)}-{int(time.time())}"'
+        self.reports = []
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "not_modified": 0, "reports": 0, "bytes_sent": 0}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, stat, n=1):
+        with self._lock:
+            self.stats[stat] += n
+
+
+class FakeSchedulerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count("bytes_sent", len(data))
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        if urlparse(self.path).path != "/schedule":
+            self.send_json(404, {"error": "not found"})
+        elif self.headers.get("If-None-Match") == server.etag:
+            server.count("not_modified")
+            self.send_json(304, None, [("ETag", server.etag)])
+        else:
+            self.send_json(200, {"cursor": 1, "full": True, "shows": server.shows}, [("ETag", server.etag)])
+
+    def do_POST(self):
+        server = self.server
+        server.count("requests")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlparse(self.path).path != "/station/status":
+            self.send_json(404, {"error": "not found"})
+        elif self.headers.get("Authorization") != f"Bearer {STATION_TOKEN}":
+            self.send_json(401, {"error": "invalid station token"})
+        else:
+            server.count("reports")
+            with server._lock:
+                server.reports.append(json.loads(body))
+            self.send_json(200, {"status": "stored"})
@@ -0,0 +1,212 @@
+"""
+Fill a scheduler database with generated DJs, shows and years of weekly
+episodes, bulk loaded with COPY, to see how the web app behaves at a
+given catalogue size. The database's tables are dropped and recreated.
+
+    python benchmarks/generate_data.py postgresql://localhost/kmgp_load --users 5000 --shows 2000 --years 5
+
+Every generated DJ can log in as dj<n>@example.com with the password
+"dj". Nearly all episodes are in the past, with a few weeks upcoming,
+and every aired episode has a download report from the station.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+from zoneinfo import ZoneInfo
+
+import psycopg2
+from werkzeug.security import generate_password_hash
+
+# the scheduler package, when run from a checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scheduler import create_app  # noqa: E402
+from scheduler.db import init_db  # noqa: E402
+
+PASSWORD = "dj"
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+STATION_TZ = ZoneInfo("America/Los_Angeles")
+SEED_RUN_ID = "generated"
+
+# rows buffered before each COPY round trip
+COPY_BATCH = 50000
+
+
+def copy_rows(cur, table, columns, rows):
+    """
+    COPY rows, an iterable of tuples, into table. Returns the row count.
+    """
+
+    statement = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % COPY_BATCH == 0:
+            buffer.seek(0)
+            cur.copy_expert(statement, buffer)
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        buffer.seek(0)
+        cur.copy_expert(statement, buffer)
+    return count
+
+
+def timeslot(show_id, shows):
+    """
+    A show's (day of week, start time), spread evenly over the week so
+    that no two shows share a slot.
+    """
+
+    minutes = (show_id - 1) * (7 * 24 * 60 // shows)
+    return WEEKDAYS[minutes // (24 * 60)], f"{minutes // 60 % 24:02}:{minutes % 60:02}"
+
+
+def show_djs(show_id, users, djs_per_show):
+    """
+    The user ids owning a show. Each DJ ends up with a similar number of
+    shows.
+    """
+
+    return [(show_id * djs_per_show + k) % users + 1 for k in range(djs_per_show)]
+
+
+def seed(conn, users=1000, shows=300, djs_per_show=3, years=5, upcoming_weeks=8):
+    """
+    Load generated data into conn's empty, freshly created schema.
+
+    :param users: DJ accounts
+    :param shows: shows, at most one per minute of the week
+    :param djs_per_show: DJs owning each show
+    :param years: years of weekly episodes that have already aired
+    :param upcoming_weeks: weeks of episodes scheduled from now on
+    :return: dict of table name to rows loaded
+    """
+
+    if shows > 7 * 24 * 60:
+        raise ValueError("at most one show per minute of the week")
+    if djs_per_show > users:
+        raise ValueError("more DJs per show than users")
+
+    password = generate_password_hash(PASSWORD)
+    now = datetime.now(tz=STATION_TZ)
+    week_start = datetime.combine(now.date() - timedelta(days=now.weekday()), datetime.min.time())
+    weeks = range(-52 * years, upcoming_weeks)
+
+    def episodes():
+        episode_id = 0
+        # a slot in the hour skipped when clocks spring forward lands on
+        # the same instant as the slot an hour later, which the app would
+        # refuse too
+        taken = set()
+        for show_id in range(1, shows + 1):
+            day_of_week, start_time = timeslot(show_id, shows)
+            hours, minutes = map(int, start_time.split(":"))
+            offset = timedelta(days=WEEKDAYS.index(day_of_week), hours=hours, minutes=minutes)
+            creator = show_djs(show_id, users, djs_per_show)[0]
+            for week in weeks:
+                air_date = (week_start + timedelta(weeks=week) + offset).replace(tzinfo=STATION_TZ)
+                if air_date.timestamp() in taken:
+                    continue
+                taken.add(air_date.timestamp())
+                episode_id += 1
+                yield (episode_id, show_id, f"episode {week}", air_date.isoformat(),
+                       f"file-{show_id}-{week}", f"show-{show_id}-{week}.mp3", "", creator, creator)
+
+    counts = {}
+    cur = conn.cursor()
+    counts["Users"] = copy_rows(cur, "Users", ("id", "name", "email", "password", "modified_by"), (
+        (i, f"dj {i}", f"dj{i}@example.com", password, i) for i in range(1, users + 1)))
+    counts["Shows"] = copy_rows(
+        cur, "Shows", ("id", "title", "day_of_week", "start_time", "description", "file_path",
+                       "created_by", "updated_by"),
+        ((i, f"show {i}", *timeslot(i, shows), f"show {i} description", f"/shows/{i}.mp3",
+          show_djs(i, users, djs_per_show)[0], show_djs(i, users, djs_per_show)[0])
+         for i in range(1, shows + 1)))
+    counts["UserShowsJoin"] = copy_rows(cur, "UserShowsJoin", ("user_id", "show_id"), (
+        (user_id, show_id) for show_id in range(1, shows + 1) for user_id in show_djs(show_id, users, djs_per_show)))
+    counts["Episodes"] = copy_rows(
+        cur, "Episodes", ("id", "show_id", "title", "air_date", "file_id", "original_filename", "description",
+                          "created_by", "updated_by"),
+        episodes())
+
+    # the rest is derived from what was just loaded
+    cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), max(id)) FROM Users", ("Users",))
+    cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), max(id)) FROM Shows", ("Shows",))
+    cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), max(id)) FROM Episodes", ("Episodes",))
+    cur.execute(
+        "INSERT INTO ScheduleChanges (operation, show_id, episode_id)"
+        " SELECT 'create_episode', show_id, id FROM Episodes ORDER BY id")
+    counts["ScheduleChanges"] = cur.rowcount
+    cur.execute(
+        "INSERT INTO StationRuns (id, started_at, finished_at, downloaded, failed)"
+        " VALUES (%s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0, 0)",
+        (SEED_RUN_ID,))
+    cur.execute(
+        "INSERT INTO DownloadReports (run_id, show_id, episode_id, file_id, status, bytes, seconds)"
+        " SELECT %s, show_id, id, file_id, 'downloaded', 100000000, 30"
+        " FROM Episodes WHERE air_date <= CURRENT_TIMESTAMP ORDER BY id",
+        (SEED_RUN_ID,))
+    counts["DownloadReports"] = cur.rowcount
+    conn.commit()
+
+    conn.autocommit = True
+    conn.cursor().execute("VACUUM ANALYZE")
+    conn.autocommit = False
+    return counts
+
+
+def reset_and_seed(database_url, **sizes):
+    """
+    Recreate the schema of the database at database_url and seed it.
+    Returns what seed() does.
+    """
+
+    app = create_app({"DATABASE_URL": database_url})
+    with app.app_context():
+        init_db()
+
+    conn = psycopg2.connect(database_url)
+    try:
+        return seed(conn, **sizes)
+    finally:
+        conn.close()
+
+
+def add_size_arguments(parser):
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--shows", type=int, default=300)
+    parser.add_argument("--djs-per-show", type=int, default=3)
+    parser.add_argument("--years", type=int, default=5, help="years of aired weekly episodes")
+    parser.add_argument("--upcoming-weeks", type=int, default=8)
+
+
+def sizes(args):
+    return {"users": args.users, "shows": args.shows, "djs_per_show": args.djs_per_show, "years": args.years,
+            "upcoming_weeks": args.upcoming_weeks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database_url", help="a scratch database; its tables are dropped")
+    add_size_arguments(parser)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = reset_and_seed(args.database_url, **sizes(args))
+    for table, count in counts.items():
+        print(f"{table}: {count} rows")
+    print(f"loaded in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""
+Replay a mix of DJ and station puller traffic against the scheduler web
+app, on a database filled by generate_data.py and with a local stand-in
+for B2, and report latency percentiles and queries per request for each
+endpoint.
+
+    python benchmarks/load_scheduler.py postgresql://localhost/kmgp_load --shows 2000 --requests 5000
+    python benchmarks/load_scheduler.py postgresql://localhost/kmgp_load --save-baseline
+    python benchmarks/load_scheduler.py postgresql://localhost/kmgp_load --compare
+
+Requests go through Flask's test client in this process, so latencies
+cover the app, its caches and the database but not a web server. The
+database is reloaded before every run unless --reuse-data is given, in
+which case the size options must match the ones it was generated with.
+
+--compare fails if any endpoint's p95 latency grew by more than
+--tolerance, if any of its requests ran more queries than the most the
+baseline saw, or if it answered with more errors.
+Baselines are only comparable on the same machine and data size.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+from fake_b2 import FakeB2
+from generate_data import PASSWORD
+from generate_data import STATION_TZ
+from generate_data import WEEKDAYS
+from generate_data import add_size_arguments
+from generate_data import show_djs
+from generate_data import sizes
+from generate_data import timeslot
+
+from flask import g
+
+from scheduler import create_app
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "scheduler.json")
+STATION_TOKEN = "load-test-station-token"
+
+# relative weights of what virtual users do: DJs mostly look at their
+# dashboard and upload the odd episode, the station puller polls the
+# schedule feed and reports its downloads
+MIX = {
+    "index": 30,
+    "index_next_page": 5,
+    "create_show_page": 2,
+    "update_show_page": 3,
+    "create_episode_page": 8,
+    "create_episode": 5,
+    "create_show": 1,
+    "schedule": 20,
+    "schedule_since": 3,
+    "shows": 3,
+    "episodes": 10,
+    "station_status": 2,
+}
+
+# response header the app reports each request's query count in
+QUERIES_HEADER = "X-Load-Test-Queries"
+
+# ignore p95 growth smaller than this many milliseconds, which is noise
+MIN_REGRESSION_MS = 2.0
+
+
+def percentile(samples, p):
+    """
+    The nearest-rank pth percentile of sorted samples.
+    """
+
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+class LoadTest:
+    """
+    Shared state of one run: the app, the generated data's shape and the
+    latency samples taken so far.
+    """
+
+    def __init__(self, app, sizes, requests, seed=0):
+        self.app = app
+        self.sizes = sizes
+        self.seed = seed
+        self.urls = app.url_map.bind("localhost")
+        self.samples = {}  # "<method> <endpoint>" -> latencies in seconds
+        self.queries = {}  # "<method> <endpoint>" -> queries run by each request
+        self.errors = {}  # "<method> <endpoint>" -> count of 5xx responses
+        self._lock = threading.Lock()
+        self._remaining = requests
+        self._new_slots = itertools.count()
+
+        now = datetime.now(tz=STATION_TZ)
+        self.week_start = now.date() - timedelta(days=now.weekday())
+
+    def take_request(self):
+        with self._lock:
+            self._remaining -= 1
+            return self._remaining >= 0
+
+    def request(self, client, method, path, **kwargs):
+        """
+        Make a request and record how long it took under its endpoint.
+        """
+
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        seconds = time.perf_counter() - start
+        endpoint = f"{method} {self.urls.match(path.split('?')[0], method)[0]}"
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            self.queries.setdefault(endpoint, []).append(int(response.headers[QUERIES_HEADER]))
+            if response.status_code >= 500:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return response
+
+    def air_date(self, show_id, week):
+        """
+        The date of a show's episode week weeks from now.
+        """
+
+        day_of_week, _ = timeslot(show_id, self.sizes["shows"])
+        return self.week_start + timedelta(weeks=week, days=WEEKDAYS.index(day_of_week))
+
+    def new_timeslot(self):
+        """
+        A timeslot no generated or previously created show uses, or None
+        if every minute of the week is taken.
+        """
+
+        step = 7 * 24 * 60 // self.sizes["shows"]
+        if step == 1:
+            return None
+        with self._lock:
+            n = next(self._new_slots)
+        minutes = n // (step - 1) * step + n % (step - 1) + 1
+        if minutes >= 7 * 24 * 60:
+            return None
+        return WEEKDAYS[minutes // (24 * 60)], f"{minutes // 60 % 24:02}:{minutes % 60:02}"
+
+
+class VirtualUser:
+    """
+    A DJ, logged in, who also plays the station puller's part.
+    """
+
+    def __init__(self, test, n, users):
+        self.test = test
+        self.random = random.Random(test.seed + n)
+        self.client = test.app.test_client()
+        self.puller = test.app.test_client()
+
+        shows = test.sizes["shows"]
+        self.show_id = self.random.randint(1, shows)
+        self.user_id = show_djs(self.show_id, test.sizes["users"], test.sizes["djs_per_show"])[0]
+        # weeks after the generated ones, not shared with other users
+        self.next_week = (test.sizes["upcoming_weeks"] + 1 + week for week in itertools.count(n, users))
+        self.next_page = None
+        self.etag = None
+        self.cursor = None
+        self.upcoming = []
+
+    def run(self):
+        test = self.test
+        test.request(self.client, "POST", "/auth/login",
+                     data={"email": f"dj{self.user_id}@example.com", "password": PASSWORD})
+        self.poll_schedule()
+
+        actions = list(MIX)
+        weights = list(MIX.values())
+        while test.take_request():
+            getattr(self, self.random.choices(actions, weights)[0])()
+
+    def index(self):
+        response = self.test.request(self.client, "GET", "/")
+        match = re.search(rb'href="/\?after=([^"]+)"', response.data)
+        self.next_page = match.group(1).decode() if match else None
+
+    def index_next_page(self):
+        if not self.next_page:
+            return self.index()
+        self.test.request(self.client, "GET", f"/?after={self.next_page}")
+
+    def create_show_page(self):
+        self.test.request(self.client, "GET", "/shows/create")
+
+    def update_show_page(self):
+        self.test.request(self.client, "GET", f"/shows/{self.show_id}/update")
+
+    def create_episode_page(self):
+        self.test.request(self.client, "GET", f"/shows/{self.show_id}/create_episode")
+
+    def create_episode(self):
+        air_date = self.test.air_date(self.show_id, next(self.next_week)).isoformat()
+        response = self.test.request(self.client, "POST", f"/shows/{self.show_id}/reserve_episode",
+                                     json={"air_date": air_date})
+        token = response.json.get("reservation_token")
+        if not token:
+            return
+        file_id = f"load-{uuid.uuid4()}"
+        self.test.request(self.client, "POST", f"/shows/{self.show_id}/create_episode", json={
+            "title": "load test episode",
+            "description": "",
+            "air_date": air_date,
+            "file_id": file_id,
+            "original_filename": f"{file_id}.mp3",
+            "reservation_token": token,
+        })
+
+    def create_show(self):
+        slot = self.test.new_timeslot()
+        if not slot:
+            return self.index()
+        self.test.request(self.client, "POST", "/shows/create", json={
+            "title": "load test show",
+            "day_of_week": slot[0],
+            "start_time": slot[1],
+            "djs": [self.user_id],
+            "description": "created by the load test",
+            "file_path": "/shows/load-test.mp3",
+        })
+
+    def poll_schedule(self):
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        response = self.test.request(self.puller, "GET", "/schedule", headers=headers)
+        if response.status_code == 200:
+            self.etag = response.headers["ETag"]
+            self.cursor = response.json["cursor"]
+            self.upcoming = [(show["id"], episode) for show in response.json["shows"]
+                             for episode in show["episodes"]]
+
+    def schedule(self):
+        self.poll_schedule()
+
+    def schedule_since(self):
+        self.test.request(self.puller, "GET", f"/schedule?since={max(0, (self.cursor or 0) - 10)}")
+
+    def shows(self):
+        self.test.request(self.puller, "GET", "/shows")
+
+    def episodes(self):
+        show_id = self.random.randint(1, self.test.sizes["shows"])
+        self.test.request(self.puller, "GET", f"/episodes?show_id={show_id}")
+
+    def station_status(self):
+        now = time.time()
+        downloads = self.random.sample(self.upcoming, min(5, len(self.upcoming)))
+        self.test.request(self.puller, "POST", "/station/status", headers={"Authorization": f"Bearer {STATION_TOKEN}"},
+                          json={
+                              "id": str(uuid.uuid4()),
+                              "started_at": now - 30,
+                              "finished_at": now,
+                              "downloads": [{"show_id": show_id, "episode_id": episode["id"],
+                                             "file_id": episode["file_id"], "status": "downloaded",
+                                             "bytes": 100000000, "seconds": 30.0} for show_id, episode in downloads],
+                              "placements": [{"show_id": show_id, "episode_id": episode["id"],
+                                              "file_id": episode["file_id"], "placed_at": now}
+                                             for show_id, episode in downloads[:1]],
+                          })
+
+
+def run(app, sizes, requests, users, seed):
+    """
+    Run the load test. Returns (results by endpoint, seconds taken).
+    """
+
+    test = LoadTest(app, sizes, requests, seed)
+    threads = [threading.Thread(target=VirtualUser(test, n, users).run) for n in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    results = {}
+    for endpoint, samples in sorted(test.samples.items()):
+        samples.sort()
+        results[endpoint] = {
+            "requests": len(samples),
+            "errors": test.errors.get(endpoint, 0),
+            "p50_ms": round(percentile(samples, 50) * 1000, 2),
+            "p95_ms": round(percentile(samples, 95) * 1000, 2),
+            "p99_ms": round(percentile(samples, 99) * 1000, 2),
+            "queries_per_request": round(sum(test.queries[endpoint]) / len(samples), 2),
+            "max_queries": max(test.queries[endpoint]),
+        }
+    return results, seconds
+
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions of results against a baseline's, as messages.
+    """
+
+    regressions = []
+    for endpoint, was in baseline["results"].items():
+        now = results.get(endpoint)
+        if not now:
+            continue
+        limit = max(was["p95_ms"] * (1 + tolerance), was["p95_ms"] + MIN_REGRESSION_MS)
+        if now["p95_ms"] > limit:
+            regressions.append(f"{endpoint}: p95 {now['p95_ms']}ms, was {was['p95_ms']}ms")
+        # the mean depends on cache hits, which depend on how writes
+        # interleave, but an uncached request always runs the same queries
+        if now["max_queries"] > was["max_queries"]:
+            regressions.append(f"{endpoint}: up to {now['max_queries']} queries per request, "
+                               f"was {was['max_queries']}")
+        if now["errors"] > was["errors"]:
+            regressions.append(f"{endpoint}: {now['errors']} errors, was {was['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database_url", help="a scratch database; its tables are dropped")
+    add_size_arguments(parser)
+    parser.add_argument("--reuse-data", action="store_true", help="don't reload the database first")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=4, help="virtual users making requests at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run's results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="fail on regressions against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="p95 growth allowed by --compare")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    data_sizes = sizes(args)
+    if not args.reuse_data:
+        # in its own process, since the app's connection pool is per
+        # process and would keep the loader's settings
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_data.py")
+        subprocess.run([sys.executable, generator, args.database_url]
+                       + [f"--{name.replace('_', '-')}={value}" for name, value in data_sizes.items()],
+                       stdout=sys.stderr, check=True)
+
+    b2 = FakeB2({})
+    threading.Thread(target=b2.serve_forever, daemon=True).start()
+    app = create_app({
+        "SECRET_KEY": "load test",
+        "DATABASE_URL": args.database_url,
+        "DB_POOL_MAX_SIZE": args.concurrency + 1,
+        "METRICS_ENABLED": True,
+        "B2_UPLOAD_KEY_ID": "fake-key-id",
+        "B2_UPLOAD_KEY": "fake-key",
+        "B2_BUCKET_ID": "fake-bucket",
+        "B2_REALM": b2.url,
+        "STATION_TOKEN": STATION_TOKEN,
+        # so a DJ's user row isn't reloaded part way through some runs but
+        # not others, which would make query counts differ between them
+        "USER_CACHE_TTL": 24 * 60 * 60,
+    })
+
+    @app.after_request
+    def count_queries(response):
+        # counted by the metrics cursor; only the connection's return to
+        # the pool comes after this
+        response.headers[QUERIES_HEADER] = str(g.get("metrics_queries", 0))
+        return response
+
+    results, seconds = run(app, data_sizes, args.requests, args.concurrency, args.seed)
+    b2.shutdown()
+    b2.server_close()
+    run_info = {
+        "date": date.today().isoformat(),
+        "sizes": data_sizes,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "requests_per_second": round(sum(r["requests"] for r in results.values()) / seconds, 1),
+        "results": results,
+    }
+
+    if args.json:
+        print(json.dumps(run_info, indent=2))
+    else:
+        print(f"{run_info['requests_per_second']} requests/s with {args.concurrency} virtual users")
+        print(f"{'endpoint':<40}{'requests':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'max':>5}{'errors':>8}")
+        for endpoint, result in results.items():
+            print(f"{endpoint:<40}{result['requests']:>9}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}"
+                  f"{result['p99_ms']:>9.2f}{result['queries_per_request']:>9}{result['max_queries']:>5}{result['errors']:>8}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(run_info, f, indent=2)
+            f.write("\n")
+        print(f"saved the baseline to {args.baseline}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["sizes"] != data_sizes or baseline["concurrency"] != args.concurrency:
+            print("warning: the baseline was taken with a different data size or concurrency", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("no regressions against the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Time how long the puller takes to start, which on the station's Windows
+box is most of a run with nothing to download.
+
+Each run starts a fresh interpreter, imports the puller and reports the
+time taken and whether b2sdk came along, which it shouldn't until there's
+something to download.
+
+requests is imported first and timed on its own. It's most of the
+import, but it stays eager: every run fetches the schedule with it, so
+importing it lazily would only move the cost, not save it.
+
+    python benchmarks/startup.py --runs 20 --max-ms 500
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+DOWNLOADER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "downloader")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import requests
+requests_done = time.perf_counter()
+import downloader
+print(json.dumps({"seconds": time.perf_counter() - start, "requests_seconds": requests_done - start,
+                  "b2sdk": "b2sdk" in sys.modules}))
+"""
+
+
+def time_startup():
+    """
+    Import the puller in a fresh interpreter. Returns (seconds, seconds of
+    that spent importing requests, whether b2sdk was imported).
+    """
+
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=DOWNLOADER_PATH, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output)
+    return result["seconds"], result["requests_seconds"], result["b2sdk"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters to time")
+    parser.add_argument("--max-ms", type=float, help="exit non-zero if the median is slower than this")
+    args = parser.parse_args()
+
+    times = []
+    requests_times = []
+    for _ in range(args.runs):
+        seconds, requests_seconds, b2sdk = time_startup()
+        times.append(seconds * 1000)
+        requests_times.append(requests_seconds * 1000)
+
+    median = statistics.median(times)
+    print(f"import downloader: median {median:.1f} ms, min {min(times):.1f} ms, max {max(times):.1f} ms "
+          f"over {args.runs} runs")
+    print(f"of which import requests, which every run needs: median {statistics.median(requests_times):.1f} ms")
+    print(f"b2sdk imported at startup: {'yes' if b2sdk else 'no'}")
+
+    if b2sdk or (args.max_ms is not None and median > args.max_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Run the puller against local stand-ins for B2 and the scheduler, and
+report how long it took, what went over the wire and its peak memory.
+
+Each scenario runs the puller once in a fresh process: "cold" against an
+empty download directory, then "warm" with nothing changed.
+
+    python benchmarks/sync.py --shows 50 --episodes 10 --file-size-kb 512
+    python benchmarks/sync.py --latency-ms 50 --fail-rate 0.05 --json > after.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_b2 import FakeB2
+from fake_scheduler import STATION_TOKEN
+from fake_scheduler import FakeScheduler
+from fake_scheduler import generate_schedule
+from fake_scheduler import make_wav
+
+DOWNLOADER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "downloader")
+
+# runs the puller and writes its peak memory, including that of its
+# analysis worker processes, to the file named by argv[1]
+RUNNER = """
+import runpy, sys
+out = sys.argv.pop(1)
+sys.argv = ["downloader.py"]
+try:
+    runpy.run_path("downloader.py", run_name="__main__")
+finally:
+    try:
+        import resource
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # kilobytes on Linux, bytes on macOS
+        peak_kb = peak // 1024 if sys.platform == "darwin" else peak
+    except ImportError:
+        peak_kb = None
+    with open(out, "w") as f:
+        f.write(str(peak_kb))
+"""
+
+
+def run_puller(env):
+    """
+    Run the puller once. Returns (seconds, peak memory in KB or None).
+    """
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "peak")
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", RUNNER, out], cwd=DOWNLOADER_PATH, env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        seconds = time.perf_counter() - start
+        if process.returncode:
+            sys.exit(f"the puller failed:\n{process.stderr}")
+        with open(out) as f:
+            peak = f.read()
+    return seconds, None if peak == "None" else int(peak)
+
+
+def snapshot(*servers):
+    return [dict(server.stats) for server in servers]
+
+
+def difference(after, before):
+    return {key: after[key] - before[key] for key in after}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shows", type=int, default=50)
+    parser.add_argument("--episodes", type=int, default=10, help="upcoming episodes per show")
+    parser.add_argument("--file-size-kb", type=int, default=256)
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every B2 request")
+    parser.add_argument("--throttle-kbps", type=float, help="per download bandwidth from B2")
+    parser.add_argument("--fail-rate", type=float, default=0, help="fraction of downloads answered with a 503")
+    parser.add_argument("--drop-rate", type=float, default=0, help="fraction of downloads cut off half way")
+    parser.add_argument("--workers", type=int, default=4, help="the puller's DOWNLOAD_WORKERS")
+    parser.add_argument("--json", action="store_true", help="print results as JSON, to compare runs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as download_path:
+        shows, file_ids = generate_schedule(args.shows, args.episodes, download_path)
+        # every file is the same, which doesn't matter to the puller
+        data = make_wav(args.file_size_kb * 1024)
+        b2 = FakeB2({file_id: data for file_id in file_ids}, latency=args.latency_ms / 1000,
+                    throttle=args.throttle_kbps * 1024 if args.throttle_kbps else None,
+                    fail_rate=args.fail_rate, drop_rate=args.drop_rate)
+        scheduler = FakeScheduler(shows)
+        for server in (b2, scheduler):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        env = dict(
+            os.environ,
+            SHOW_DOWNLOAD_PATH=download_path,
+            B2_DOWNLOAD_KEY_ID="fake-key-id",
+            B2_DOWNLOAD_KEY="fake-key",
+            B2_REALM=b2.url,
+            GET_SCHEDULE_URL=f"{scheduler.url}/schedule",
+            STATUS_URL=f"{scheduler.url}/station/status",
+            STATION_TOKEN=STATION_TOKEN,
+            DOWNLOAD_WORKERS=str(args.workers),
+            DOWNLOAD_BACKOFF_SECONDS="0.1",
+            # the generated episodes go out a few months
+            PREFETCH_DAYS="0",
+            ANALYSIS_MIN_SECONDS="1",
+        )
+
+        results = []
+        for scenario in ("cold", "warm"):
+            before = snapshot(b2, scheduler)
+            seconds, peak_kb = run_puller(env)
+            b2_stats, scheduler_stats = (difference(after, before)
+                                         for after, before in zip(snapshot(b2, scheduler), before))
+            results.append({
+                "scenario": scenario,
+                "seconds": round(seconds, 3),
+                "peak_memory_kb": peak_kb,
+                "bytes_downloaded": b2_stats["bytes_sent"],
+                "b2_requests": b2_stats["requests"],
+                "b2_authorizations": b2_stats["authorizations"],
+                "b2_failures": b2_stats["failures"],
+                "scheduler_requests": scheduler_stats["requests"],
+                "schedule_not_modified": scheduler_stats["not_modified"],
+            })
+
+        for server in (b2, scheduler):
+            server.shutdown()
+            server.server_close()
+
+    if args.json:
+        print(json.dumps({"args": vars(args), "results": results}, indent=2))
+        return
+
+    print(f"{args.shows} shows, {len(file_ids)} episodes of {args.file_size_kb} KB")
+    for result in results:
+        peak = f"{result['peak_memory_kb'] / 1024:.1f} MB" if result["peak_memory_kb"] is not None else "n/a"
+        print(f"{result['scenario']:>5}: {result['seconds']:.2f}s, {result['bytes_downloaded'] / 2 ** 20:.1f} MB "
+              f"downloaded, {result['b2_requests']} B2 requests ({result['b2_failures']} failed, "
+              f"{result['b2_authorizations']} authorizations), {result['scheduler_requests']} scheduler requests "
+              f"({result['schedule_not_modified']} not modified), peak memory {peak}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import math
+import os
+import struct
+
+# leading bytes of the formats the playout software takes besides WAV,
+# which are checked for but not decoded
+MAGIC = (
+    (b"ID3", "mp3"),
+    (b"\xff\xfb", "mp3"),
+    (b"\xff\xf3", "mp3"),
+    (b"\xff\xf2", "mp3"),
+    (b"fLaC", "flac"),
+    (b"OggS", "ogg"),
+)
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# silence is measured in windows of this many seconds
+SILENCE_WINDOW_SECONDS = 0.1
+
+
+def sniff_format(path):
+    """
+    The audio format of the file at path going by its first bytes: "wav",
+    one of the formats in MAGIC, or None.
+    """
+
+    with open(path, "rb") as f:
+        header = f.read(12)
+
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "wav"
+    if header[4:8] == b"ftyp":
+        return "mp4"
+    for magic, name in MAGIC:
+        if header.startswith(magic):
+            return name
+    return None
+
+
+def read_wav_header(path):
+    """
+    Find the sample format and the PCM data in the WAV file at path.
+
+    Returns a dict of "format" (WAVE_FORMAT_PCM or WAVE_FORMAT_IEEE_FLOAT),
+    "channels", "sample_rate", "bits", and the "data_offset" and
+    "data_size" of the samples as the header gives them. Raises ValueError
+    if the file isn't a WAV file we can read.
+    """
+
+    fmt = None
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            # RF64, for WAVs over 4 GB, isn't supported
+            raise ValueError("not a RIFF WAVE file")
+
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("no data chunk")
+            chunk_id, size = struct.unpack("<4sI", chunk)
+
+            if chunk_id == b"fmt ":
+                body = f.read(size)
+                if len(body) < 16:
+                    raise ValueError("fmt chunk too short")
+                format_tag, channels, sample_rate, _, _, bits = struct.unpack("<HHIIHH", body[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    # the real format is the first two bytes of the subformat GUID
+                    format_tag, = struct.unpack("<H", body[24:26])
+                fmt = {"format": format_tag, "channels": channels, "sample_rate": sample_rate, "bits": bits}
+                if size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise ValueError("data chunk before fmt chunk")
+                fmt.update(data_offset=f.tell(), data_size=size)
+                break
+            else:
+                # chunks are padded to an even size
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+    supported = {WAVE_FORMAT_PCM: (8, 16, 24, 32), WAVE_FORMAT_IEEE_FLOAT: (32, 64)}
+    if fmt["bits"] not in supported.get(fmt["format"], ()) or not fmt["channels"] or not fmt["sample_rate"]:
+        raise ValueError(f"unsupported sample format {fmt['format']:#06x} at {fmt['bits']} bits")
+    return fmt
+
+
+def _samples(np, path, fmt, frames):
+    """
+    Memory-map the samples of a WAV file as a (frames, channels) array,
+    or (frames, channels, 3) bytes for 24 bit audio.
+    """
+
+    channels = fmt["channels"]
+    if fmt["bits"] == 24:
+        return np.memmap(path, dtype=np.uint8, mode="r", offset=fmt["data_offset"], shape=(frames, channels, 3))
+
+    if fmt["format"] == WAVE_FORMAT_IEEE_FLOAT:
+        dtype = {32: "<f4", 64: "<f8"}[fmt["bits"]]
+    else:
+        dtype = {8: np.uint8, 16: "<i2", 32: "<i4"}[fmt["bits"]]
+    return np.memmap(path, dtype=dtype, mode="r", offset=fmt["data_offset"], shape=(frames, channels))
+
+
+def _to_float(np, block, fmt):
+    """
+    Scale a block of samples to floats in [-1, 1].
+    """
+
+    if fmt["format"] == WAVE_FORMAT_IEEE_FLOAT:
+        return block.astype(np.float32)
+    if fmt["bits"] == 8:
+        return (block.astype(np.float32) - 128) / 128
+    if fmt["bits"] == 24:
+        b = block.astype(np.int32)
+        value = b[..., 0] | (b[..., 1] << 8) | (b[..., 2] << 16)
+        value = np.where(value & 0x800000, value - 0x1000000, value)
+        return value.astype(np.float32) / 2 ** 23
+    return block.astype(np.float32) / 2 ** (fmt["bits"] - 1)
+
+
+def _db(level):
+    """
+    A level in [0, 1] in dBFS, or None for silence.
+    """
+
+    return round(20 * math.log10(level), 2) if level > 0 else None
+
+
+def analyze_wav(path, fmt, silence_db, block_seconds):
+    """
+    Measure the samples of a WAV file a block at a time, so a multi-hour
+    file never has to fit in memory.
+    """
+
+    import numpy as np
+
+    frame_size = fmt["channels"] * fmt["bits"] // 8
+    available = os.path.getsize(path) - fmt["data_offset"]
+    frames = min(fmt["data_size"], available) // frame_size
+    result = {"duration": frames / fmt["sample_rate"], "problems": []}
+    if fmt["data_size"] > available:
+        result["problems"].append(f"truncated, {available} of {fmt['data_size']} bytes of audio")
+    if not frames:
+        result["problems"].append("no audio")
+        return result
+
+    samples = _samples(np, path, fmt, frames)
+    window = max(1, int(fmt["sample_rate"] * SILENCE_WINDOW_SECONDS))
+    block = window * max(1, int(block_seconds / SILENCE_WINDOW_SECONDS))
+    peak = 0.0
+    sum_squares = 0.0
+    window_peaks = []
+    for start in range(0, frames, block):
+        levels = np.abs(_to_float(np, samples[start:start + block], fmt))
+        sum_squares += float(np.square(levels, dtype=np.float64).sum())
+        frame_peaks = levels.max(axis=1)
+        peak = max(peak, float(frame_peaks.max()))
+        # blocks are a whole number of windows, except maybe the last
+        whole = len(frame_peaks) // window * window
+        window_peaks.append(frame_peaks[:whole].reshape(-1, window).max(axis=1))
+        if whole < len(frame_peaks):
+            window_peaks.append(frame_peaks[whole:].max(keepdims=True))
+    del samples
+
+    window_peaks = np.concatenate(window_peaks)
+    loud = np.flatnonzero(window_peaks > 10 ** (silence_db / 20))
+    if len(loud):
+        result["leading_silence"] = round(float(loud[0]) * window / fmt["sample_rate"], 1)
+        result["trailing_silence"] = round(float(len(window_peaks) - 1 - loud[-1]) * window / fmt["sample_rate"], 1)
+    else:
+        result["leading_silence"] = result["trailing_silence"] = round(result["duration"], 1)
+        result["problems"].append(f"silent, peak below {silence_db} dBFS")
+
+    result["peak_db"] = _db(peak)
+    result["rms_db"] = _db(math.sqrt(sum_squares / (frames * fmt["channels"])))
+    return result
+
+
+def have_numpy():
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def analyze_file(path, min_duration=60, silence_db=-50.0, block_seconds=10):
+    """
+    Check that the file at path looks like it'll play on air.
+
+    WAV files are decoded and measured for duration, peak and RMS level
+    in dBFS, and leading and trailing silence; they fail if they're
+    truncated, shorter than min_duration seconds or silent throughout.
+    Other formats the playout software takes are only recognized, as is
+    WAV when NumPy isn't installed. Anything else fails.
+
+    Returns a dict with "ok", a list of "problems", "format", whether the
+    audio was "analyzed", and the measurements if it was. Runs in a worker
+    process, so it takes and returns only plain values.
+    """
+
+    result = {"format": sniff_format(path), "analyzed": False, "problems": []}
+    if result["format"] is None:
+        result["problems"].append("not a recognized audio format")
+    elif result["format"] == "wav":
+        try:
+            fmt = read_wav_header(path)
+        except (ValueError, struct.error) as e:
+            result["problems"].append(f"unreadable WAV file: {e}")
+        else:
+            result.update(channels=fmt["channels"], sample_rate=fmt["sample_rate"], bits=fmt["bits"])
+            if have_numpy():
+                result.update(analyze_wav(path, fmt, silence_db, block_seconds), analyzed=True)
+                if result["duration"] < min_duration:
+                    result["problems"].append(f"only {result['duration']:.1f} seconds long")
+
+    result["ok"] = not result["problems"]
+    return result
@@ -1,55 +1,479 @@
+import argparse
 import datetime
+import glob
+import hashlib
+import heapq
+import json
 import logging
 import os
+import random
+# most of the import time, but every run fetches the schedule with it, so
+# it isn't worth deferring; benchmarks/startup.py measures it
 import requests
 import shutil
-from b2sdk.v2 import InMemoryAccountInfo
-from b2sdk.v2 import B2Api
+import signal
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from dotenv import load_dotenv
 
+from analysis import analyze_file
+from analysis import have_numpy
+from events import ScheduleWatcher
+from manifest import Manifest
+from status import StatusReporter
 
-def b2_download_file(b2_api, b2_file_id, output_filename):
+
+class TokenBucket:
+    """
+    Limits the combined rate of the download threads to rate bytes per
+    second, allowing bursts of up to burst bytes.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def consume(self, n):
+        """
+        Take n bytes' worth of tokens, sleeping until the bucket has
+        refilled enough to pay for them. The bucket can go into debt, so
+        threads that come after wait their turn behind this one.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def b2_download_file(b2_api, b2_file_id, output_filename, http=requests, chunk_size=1024 * 1024, throttle=None,
+                     expected_sha1=None):
     """
     Download the file with b2_file_id to output_filename using b2_api.
+
+    The file is streamed to output_filename + ".part", hashing it on the
+    way, and a .part left by an interrupted download is picked up with a
+    Range request instead of starting over. Only once the whole file is
+    there and its SHA-1 matches is it fsynced and renamed into place, so
+    output_filename is never a partial or corrupt file.
+
+    The SHA-1 is checked against B2's and against expected_sha1, the one
+    the scheduler has for the file, whichever are known. Large files only
+    have one in B2 if their uploader set it.
+
+    throttle is a TokenBucket to limit the download rate with, or None.
+
+    Returns the file's (size, sha1).
     """
 
-    b2_api.download_file_by_id(b2_file_id).save_to(output_filename)
+    part_filename = output_filename + ".part"
+    sha1 = hashlib.sha1()
+    offset = 0
+    if os.path.exists(part_filename):
+        # the digest has to cover the bytes already downloaded too
+        with open(part_filename, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha1.update(chunk)
+                offset += len(chunk)
+
+    url = b2_api.get_download_url_for_fileid(b2_file_id)
+    headers = {"Authorization": b2_api.account_info.get_account_auth_token()}
+    if offset:
+        logging.info(f"resuming download of '{output_filename}' at byte {offset}")
+        headers["Range"] = f"bytes={offset}-"
+
+    with http.get(url, headers=headers, stream=True, timeout=(10, 60)) as r:
+        if r.status_code == 401:
+            # auth tokens last a day, which a daemon outlives; the retry
+            # picks up the new one
+            b2_api.authorize_automatically()
+            raise IOError(f"B2 auth token expired downloading '{output_filename}', re-authorized")
+
+        if r.status_code == 416:
+            # nothing past what we have: the .part is the whole file if
+            # it's the size in "Content-Range: bytes */<size>", and is
+            # checked and finished below, or else it's bad
+            if r.headers.get("Content-Range", "").rsplit("/", 1)[-1] != str(offset):
+                os.unlink(part_filename)
+                raise IOError(f"stale partial download '{part_filename}' discarded")
+            mode, size = None, offset
+        else:
+            r.raise_for_status()
+            if r.status_code == 206:
+                mode = "ab"
+                size = int(r.headers["Content-Range"].rsplit("/", 1)[1])
+            else:
+                # no Range sent, or the server ignored it
+                mode = "wb"
+                size = int(r.headers["Content-Length"])
+                sha1 = hashlib.sha1()
 
+        b2_sha1 = r.headers.get("X-Bz-Content-Sha1", "none").replace("unverified:", "")
+        if b2_sha1 == "none":
+            b2_sha1 = r.headers.get("X-Bz-Info-large_file_sha1")
 
-def get_shows(url):
+        if mode:
+            with open(part_filename, mode) as f:
+                for chunk in r.iter_content(chunk_size):
+                    f.write(chunk)
+                    sha1.update(chunk)
+                    if throttle is not None:
+                        throttle.consume(len(chunk))
+                f.flush()
+                os.fsync(f.fileno())
+
+    downloaded = os.path.getsize(part_filename)
+    if downloaded != size:
+        # keep the .part so the next attempt can resume it
+        raise IOError(f"download of '{output_filename}' stopped at {downloaded} of {size} bytes")
+
+    digest = sha1.hexdigest()
+    if not b2_sha1:
+        logging.warning(f"B2 has no SHA-1 for '{output_filename}'"
+                        + (", checking the scheduler's" if expected_sha1 else ", it can't be checked"))
+    for source, expected in (("B2", b2_sha1), ("the scheduler", expected_sha1)):
+        if expected and digest != expected:
+            os.unlink(part_filename)
+            raise IOError(f"'{output_filename}' has SHA-1 {digest}, {source} expected {expected}")
+
+    os.replace(part_filename, output_filename)
+    fsync_dir(os.path.dirname(output_filename))
+    return size, digest
+
+
+def fsync_dir(path):
     """
-    Get list of shows from the scheduler back-end at url.
+    Make a rename into the directory at path durable. A no-op on Windows,
+    which can't open directories.
     """
 
-    logging.debug(f"getting shows from scheduler @ '{url}'")
-    r = requests.get(url)
-    if r.status_code == 200:
-        json = r.json()
-        logging.debug(f"got {len(json['shows'])} shows")
-        return json["shows"]
-    else:
-        # best effort at logging the error
-        error = "unknown"
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def download_with_retry(b2_api, http, b2_file_id, output_filename, retries, backoff, throttle=None,
+                        expected_sha1=None):
+    """
+    Download a file like b2_download_file, retrying failures up to retries
+    times with exponential backoff and full jitter, starting at backoff
+    seconds. Each retry resumes where the last attempt stopped.
+    """
+
+    for attempt in range(1, retries + 1):
         try:
-            error = r.json()["error"]
-        except BaseException:
-            logging.exception("unable to extract 'error' key from response json")
+            return b2_download_file(b2_api, b2_file_id, output_filename, http=http, throttle=throttle,
+                                    expected_sha1=expected_sha1)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = random.uniform(0, backoff * 2 ** (attempt - 1))
+            logging.warning(f"download of '{output_filename}' failed ({e}), attempt {attempt} of {retries}, "
+                            f"retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def download_episode(b2_api, http, manifest, show, episode, output_filename, retries, backoff, throttle=None):
+    """
+    Download an episode and record it in the manifest. Returns a dict of
+    the file's "bytes" and "sha1", and the "seconds" the download took.
+    """
+
+    start = time.monotonic()
+    size, sha1 = download_with_retry(b2_api, http, episode["file_id"], output_filename, retries, backoff, throttle,
+                                     episode.get("sha1"))
+    manifest.record(episode["file_id"], episode, show["id"], output_filename, size, sha1)
+    return {"bytes": size, "sha1": sha1, "seconds": time.monotonic() - start}
+
+
+def download_episodes(b2, http, manifest, jobs, workers, retries, backoff, rehash=False, throttle=None,
+                      urgent_episode_ids=()):
+    """
+    Download episodes concurrently with a pool of worker threads, getting
+    the B2Api from the B2Connection b2 only if there's anything to download.
+
+    jobs is a list of (show, episode, output_filename), started in order.
+    Episodes the manifest says are already on disk are skipped; with rehash
+    their contents are checked against the recorded SHA-1 first. Each
+    download is retried on its own, and a failure doesn't stop the others.
+    If B2 can't be connected to, every job to download fails with that.
+    Downloads share the throttle, if any, except for the episodes in
+    urgent_episode_ids.
+
+    Returns a summary dict of "succeeded", "skipped" and "failed" job lists;
+    failed entries are (job, exception). "results" maps the episode id of
+    each succeeded job to what download_episode returned.
+    """
+
+    summary = {"succeeded": [], "skipped": [], "failed": [], "results": {}}
+    b2_api = None
+    b2_error = None
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+        futures = {}
+        for job in jobs:
+            show, episode, output_filename = job
+            if manifest.is_current(manifest.get(episode["file_id"]), output_filename, rehash=rehash):
+                logging.debug(f"already have [{show['title']}]:[{episode['title']}] at '{output_filename}'")
+                summary["skipped"].append(job)
+                continue
+
+            if b2_error is not None:
+                summary["failed"].append((job, b2_error))
+                continue
+            if b2_api is None:
+                try:
+                    b2_api = b2.get()
+                except IOError as e:
+                    # what's already on disk can still be placed
+                    logging.error(f"unable to connect to B2, not downloading anything this run: {e}")
+                    b2_error = e
+                    summary["failed"].append((job, e))
+                    continue
+            logging.info(f"downloading [{show['title']}]:[{episode['title']}] to '{output_filename}'")
+            futures[pool.submit(download_episode, b2_api, http, manifest, show, episode, output_filename,
+                                retries, backoff,
+                                None if episode["id"] in urgent_episode_ids else throttle)] = job
+
+        for future in as_completed(futures):
+            job = futures[future]
+            show, episode, output_filename = job
+            try:
+                summary["results"][episode["id"]] = future.result()
+            except Exception as e:
+                logging.error(f"giving up on [{show['title']}]:[{episode['title']}]: {e}")
+                summary["failed"].append((job, e))
+            else:
+                summary["succeeded"].append(job)
+
+    return summary
+
+
+def plan_placements(shows, upcoming, manifest, download_path, failed_episode_ids, now=None, grace=0):
+    """
+    Work out which shows need their next episode put in place for playout.
+
+    Shows whose file_path already holds their next episode, going by the
+    manifest, are left out, as are shows whose next episode failed to
+    download or failed analysis, or hasn't been downloaded at all, as when
+    it airs beyond the download horizon. So are shows whose placed episode
+    aired less than grace seconds before now, since it may still be
+    playing. Returns a list of (show, episode, source path).
+    """
+
+    placements = []
+    for show in shows:
+        episodes = upcoming[show["id"]]
+        if not episodes:
+            continue
+
+        next_episode = min(episodes, key=lambda ep: ep["air_date"])
+        if next_episode["id"] in failed_episode_ids:
+            logging.error(f"[{show['title']}]:[{next_episode['title']}] is scheduled next but failed to download "
+                          f"or failed analysis, leaving '{show['file_path']}' alone")
+            continue
+
+        if manifest.is_placed(show["file_path"], next_episode["file_id"]):
+            logging.debug(f"[{show['title']}]:[{next_episode['title']}] is already in place at '{show['file_path']}'")
+            continue
+
+        if now is not None and is_airing(manifest, show["file_path"], now, grace):
+            logging.info(f"'{show['file_path']}' may still be on air, placing "
+                         f"[{show['title']}]:[{next_episode['title']}] later")
+            continue
+
+        # where it was downloaded, which may be for another episode of the
+        # same audio
+        entry = manifest.get(next_episode["file_id"])
+        source = entry["path"] if entry else os.path.join(download_path, str(show["id"]), str(next_episode["id"]))
+        if entry is None and not os.path.exists(source):
+            # airing beyond the download horizon, or still to come
+            logging.debug(f"[{show['title']}]:[{next_episode['title']}] isn't downloaded yet, placing it later")
+            continue
+        placements.append((show, next_episode, source))
+
+    return placements
 
-        logging.error(f"error in get_shows; http status {r.status_code}, error: {error}")
-        return {}
 
+def is_airing(manifest, path, now, grace):
+    """
+    Whether the episode placed at path started airing less than grace
+    seconds before now.
+    """
+
+    placement = manifest.get_placement(path)
+    if placement is None:
+        return False
+    entry = manifest.get(placement["file_id"])
+    return entry is not None and entry["air_date"] <= now < entry["air_date"] + grace
+
+
+def place_file(source, target):
+    """
+    Replace target with the contents of source in one atomic rename, so
+    the playout software never opens a half-written file.
+
+    A hard link is tried first, which costs no copying. Otherwise the file
+    is copied to a temporary file beside target and fsynced first.
+    """
+
+    tmp = target + ".kmgp-tmp"
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+
+    os.replace(tmp, target)
+
+
+def apply_placements(placements, manifest):
+    """
+    Put each planned episode in place and record it in the manifest.
+    Returns the placements that were made.
+    """
+
+    applied = []
+    for show, episode, source in placements:
+        # copy the next episode of this show to where station playlist expects
+        # symlinks in windows are weird, so link or copy instead
+        logging.info(f"[{show['title']}]:[{episode['title']}] is scheduled next, placing '{source}' at '{show['file_path']}'")
+        try:
+            place_file(source, show["file_path"])
+        except OSError:
+            # e.g. the playout software has the file open on Windows;
+            # the next run will try again
+            logging.exception(f"unable to place '{source}' at '{show['file_path']}'")
+            continue
+        manifest.record_placement(show["file_path"], episode["file_id"], episode["id"])
+        applied.append((show, episode, source))
+
+    return applied
+
+
+def analyze_downloads(manifest, jobs, workers, min_duration, silence_db):
+    """
+    Analyze the downloaded episodes in jobs that haven't been analyzed yet
+    with analysis.analyze_file, in a pool of worker processes so several
+    long files are decoded at once, and record the results in the
+    manifest.
+
+    Returns a dict of episode id to analysis for every job that's on disk,
+    whether it was analyzed now or by an earlier run.
+    """
+
+    analyses = {}
+    pending = []
+    for job in jobs:
+        show, episode, output_filename = job
+        entry = manifest.get(episode["file_id"])
+        if entry is None or entry["path"] != output_filename:
+            continue
+        analysis = manifest.get_analysis(episode["file_id"])
+        if analysis is None:
+            pending.append(job)
+        else:
+            analyses[episode["id"]] = analysis
+
+    if not pending:
+        return analyses
+
+    if not have_numpy():
+        logging.warning("NumPy isn't installed, only checking the format of downloaded episodes")
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+        futures = {pool.submit(analyze_file, job[2], min_duration, silence_db): job for job in pending}
+        for future in as_completed(futures):
+            show, episode, output_filename = futures[future]
+            try:
+                analysis = future.result()
+            except Exception as e:
+                # not recorded, so it's tried again next run
+                logging.exception(f"unable to analyze '{output_filename}'")
+                analyses[episode["id"]] = {"ok": False, "problems": [f"analysis failed: {e}"]}
+                continue
+
+            manifest.record_analysis(episode["file_id"], analysis)
+            analyses[episode["id"]] = analysis
+            if not analysis["ok"]:
+                logging.error(f"[{show['title']}]:[{episode['title']}] failed analysis: "
+                              f"{'; '.join(analysis['problems'])}")
 
-def get_upcoming_episodes(url, show_id):
+    return analyses
+
+
+def get_schedule(http, url, cache_path):
     """
-    Get list of upcoming episodes for a given show_id from scheduler at url.
+    Get every show with its upcoming episodes from the scheduler's schedule
+    feed at url.
+
+    The last feed is kept in cache_path. Its ETag and cursor are sent
+    with the request, so an unchanged schedule costs a 304 and a changed
+    one returns only the shows that changed, which are merged into the
+    cached feed.
+
+    Returns (shows, changed), where changed is whether the schedule is
+    different from the cached one.
     """
 
-    logging.debug(f"getting episodes for show with id {show_id} from scheduler @ '{url}'")
-    r = requests.get(url, params={"show_id": show_id})
-    if r.status_code == 200:
-        json = r.json()
-        logging.debug(f"got {len(json['episodes'])} episodes for show id {show_id}")
-        return json["episodes"]
+    cached = None
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        logging.exception(f"ignoring unreadable schedule cache '{cache_path}'")
+
+    headers = {}
+    params = {}
+    if cached:
+        headers["If-None-Match"] = cached["etag"]
+        params["since"] = cached["cursor"]
+
+    logging.debug(f"getting schedule from scheduler @ '{url}'")
+    try:
+        r = http.get(url, headers=headers, params=params, timeout=(10, 60))
+    except requests.RequestException as e:
+        logging.error(f"unable to reach the scheduler @ '{url}': {e}")
+        # fall back to the last schedule we know about
+        return (cached["shows"] if cached else []), False
+
+    if r.status_code == 304:
+        logging.debug("schedule is unchanged")
+        return cached["shows"], False
+    elif r.status_code == 200:
+        feed = r.json()
+        shows = feed["shows"]
+        if not feed["full"]:
+            shows_by_id = {show["id"]: show for show in cached["shows"]}
+            shows_by_id.update({show["id"]: show for show in shows})
+            shows = sorted(shows_by_id.values(), key=lambda show: show["id"])
+        logging.debug(f"got {len(feed['shows'])} changed shows, {len(shows)} shows total")
+
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"etag": r.headers.get("ETag"), "cursor": feed["cursor"], "shows": shows}, f)
+        os.replace(tmp_path, cache_path)
+        return shows, True
     else:
         # best effort at logging the error
         error = "unknown"
@@ -58,72 +482,562 @@ def get_upcoming_episodes(url, show_id):
         except BaseException:
             logging.exception("unable to extract 'error' key from response json")
 
-        logging.error(f"error in get_upcoming_episodes; http status {r.status_code}, error: {error}")
-        return {}
+        logging.error(f"error in get_schedule; http status {r.status_code}, error: {error}")
+        # fall back to the last schedule we know about
+        return (cached["shows"] if cached else []), False
 
 
-def run_once():
+def load_settings():
     """
-    Run one iteration of the episode puller.
+    Read the puller's settings from the environment.
     """
 
-    logging.basicConfig(level=logging.INFO)
-    logging.info("starting episode puller")
-    load_dotenv()  # loads values from .env file into environment variables
-    DOWNLOAD_PATH = os.environ["SHOW_DOWNLOAD_PATH"]
-    B2_KEY_ID = os.environ["B2_DOWNLOAD_KEY_ID"]
-    B2_KEY = os.environ["B2_DOWNLOAD_KEY"]
-    GET_SHOWS_URL = os.environ["GET_SHOWS_URL"]
-    GET_EPISODES_URL = os.environ["GET_EPISODES_URL"]
+    return {
+        "DOWNLOAD_PATH": os.environ["SHOW_DOWNLOAD_PATH"],
+        "B2_KEY_ID": os.environ["B2_DOWNLOAD_KEY_ID"],
+        "B2_KEY": os.environ["B2_DOWNLOAD_KEY"],
+        # "production", or the URL of a stand-in like benchmarks/fake_b2.py
+        "B2_REALM": os.environ.get("B2_REALM", "production"),
+        "GET_SCHEDULE_URL": os.environ["GET_SCHEDULE_URL"],
+        # daemon mode only: the scheduler's stream of schedule changes, e.g.
+        # https://.../schedule/changes, to sync as soon as the schedule changes
+        "SCHEDULE_EVENTS_URL": os.environ.get("SCHEDULE_EVENTS_URL"),
+        "DOWNLOAD_WORKERS": int(os.environ.get("DOWNLOAD_WORKERS", 4)),
+        "DOWNLOAD_RETRIES": int(os.environ.get("DOWNLOAD_RETRIES", 4)),
+        "DOWNLOAD_BACKOFF": float(os.environ.get("DOWNLOAD_BACKOFF_SECONDS", 2)),
+        # "quick" trusts files whose size and mtime match the manifest,
+        # "full" also re-hashes them
+        "VERIFY_DOWNLOADS": os.environ.get("VERIFY_DOWNLOADS", "quick"),
+        # only download episodes airing in the next this many days, 0 for all
+        "PREFETCH_DAYS": float(os.environ.get("PREFETCH_DAYS", 14)),
+        # missing episodes airing this soon skip the bandwidth limit
+        "URGENT_HOURS": float(os.environ.get("URGENT_HOURS", 24)),
+        # combined download rate limit, 0 for none, to leave room for the
+        # station's live stream
+        "MAX_DOWNLOAD_KBPS": float(os.environ.get("MAX_DOWNLOAD_KBPS", 0)),
+        # downloads are checked for audio problems by this many processes
+        "ANALYSIS_WORKERS": int(os.environ.get("ANALYSIS_WORKERS", os.cpu_count() or 2)),
+        # episodes shorter than this or quieter than this throughout are
+        # rejected
+        "ANALYSIS_MIN_SECONDS": float(os.environ.get("ANALYSIS_MIN_SECONDS", 60)),
+        "ANALYSIS_SILENCE_DB": float(os.environ.get("ANALYSIS_SILENCE_DB", -50)),
+        # daemon mode only: schedule polling backs off from the min to the
+        # max interval while the schedule is unchanged
+        "POLL_MIN": float(os.environ.get("POLL_MIN_SECONDS", 60)),
+        "POLL_MAX": float(os.environ.get("POLL_MAX_SECONDS", 900)),
+        # how long to keep an episode after it airs
+        "RETENTION_GRACE": float(os.environ.get("RETENTION_GRACE_SECONDS", 24 * 60 * 60)),
+        # most space downloads may take up, 0 for no limit
+        "DISK_QUOTA": int(float(os.environ.get("DISK_QUOTA_MB", 0)) * 1024 * 1024),
+        # how long after an episode's air date it may still be playing
+        "PLAYOUT_GRACE": float(os.environ.get("PLAYOUT_GRACE_SECONDS", 2 * 60 * 60)),
+        # where run reports go; reporting is off unless both are set
+        "STATUS_URL": os.environ.get("STATUS_URL"),
+        "STATION_TOKEN": os.environ.get("STATION_TOKEN"),
+        # how often to report runs that didn't change anything
+        "STATUS_HEARTBEAT": float(os.environ.get("STATUS_HEARTBEAT_SECONDS", 15 * 60)),
+    }
+
+
+class B2Connection:
+    """
+    Authorizes with B2 the first time something needs to be downloaded.
+
+    The authorization is kept in a file in the download directory and
+    reused by later runs, until B2 rejects it. b2sdk itself is only
+    imported then too, since importing it takes longer than a whole run
+    with nothing to download.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._b2_api = None
+
+    def get(self):
+        """
+        The authorized B2Api. Raises IOError if B2 can't be reached or
+        rejects the key.
+        """
+
+        if self._b2_api is None:
+            from b2sdk.v2.exception import B2Error
+
+            try:
+                self._b2_api = self._connect()
+            except (B2Error, requests.RequestException) as e:
+                raise IOError(f"unable to authorize with B2: {e}") from e
+        return self._b2_api
+
+    def _connect(self):
+        from b2sdk.v2 import B2Api
+        from b2sdk.v2 import SqliteAccountInfo
+        from b2sdk.v2.exception import MissingAccountData
+
+        info = SqliteAccountInfo(file_name=os.path.join(self.settings["DOWNLOAD_PATH"], "b2_account_info.sqlite3"))
+        b2_api = B2Api(info)
+        try:
+            # saved auth for another key or realm is no good
+            authorized = (info.get_application_key_id() == self.settings["B2_KEY_ID"]
+                          and info.get_realm() == self.settings["B2_REALM"]
+                          and info.get_account_auth_token())
+        except MissingAccountData:
+            authorized = False
+
+        if authorized:
+            logging.debug("reusing saved B2 authorization")
+        else:
+            logging.info("authorizing with B2")
+            b2_api.authorize_account(self.settings["B2_REALM"], self.settings["B2_KEY_ID"], self.settings["B2_KEY"])
+        return b2_api
+
+
+def make_http_session(settings):
+    """
+    The HTTP session for the scheduler and for the download threads to
+    share.
+    """
 
-    info = InMemoryAccountInfo()
-    b2_api = B2Api(info)
-    b2_api.authorize_account("production", B2_KEY_ID, B2_KEY)
+    # one connection pool shared by the download threads
+    http = requests.Session()
+    http.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=settings["DOWNLOAD_WORKERS"]))
+    return http
 
-    shows = get_shows(GET_SHOWS_URL)
 
+def make_reporter(settings, http):
+    """
+    The StatusReporter for run reports, or None if reporting isn't set up.
+    """
+
+    if not settings["STATUS_URL"] or not settings["STATION_TOKEN"]:
+        logging.info("STATUS_URL or STATION_TOKEN not set, not reporting status")
+        return None
+    return StatusReporter(http, settings["STATUS_URL"], settings["STATION_TOKEN"],
+                          os.path.join(settings["DOWNLOAD_PATH"], "status-spool"),
+                          heartbeat=settings["STATUS_HEARTBEAT"])
+
+
+def build_report(run_id, started_at, shows, manifest, summary, analyses):
+    """
+    The status report of one run for the scheduler: the result of every
+    download attempted, with its analysis, and the episode placed for each
+    show.
+    """
+
+    downloads = []
+    for show, episode, path in summary["succeeded"]:
+        download = dict(summary["results"][episode["id"]], show_id=show["id"], episode_id=episode["id"],
+                        file_id=episode["file_id"], status="downloaded")
+        analysis = analyses.get(episode["id"])
+        if analysis is not None:
+            download["analysis"] = analysis
+            if not analysis["ok"]:
+                download.update(status="rejected", error="; ".join(analysis["problems"]))
+        downloads.append(download)
+    for (show, episode, path), e in summary["failed"]:
+        downloads.append({"show_id": show["id"], "episode_id": episode["id"], "file_id": episode["file_id"],
+                          "status": "failed", "error": str(e)})
+
+    placements = []
     for show in shows:
-        episodes = get_upcoming_episodes(GET_EPISODES_URL, show["id"])
-        show_path = os.path.join(DOWNLOAD_PATH, str(show["id"]))
+        placement = manifest.get_placement(show["file_path"])
+        if placement is not None:
+            placements.append({"show_id": show["id"], "episode_id": placement["episode_id"],
+                               "file_id": placement["file_id"], "placed_at": placement["placed_at"]})
+
+    return {"id": run_id, "started_at": started_at, "finished_at": time.time(),
+            "downloads": downloads, "placements": placements}
+
+
+def sync_once(settings, b2, http, manifest, reporter=None):
+    """
+    Get the schedule, evict downloads we don't need any more, download
+    upcoming episodes we don't have yet and put each show's next episode
+    in place, then report how that went with reporter, if given.
+
+    Returns (shows, changed) as get_schedule does.
+    """
+
+    run_id = uuid.uuid4().hex
+    started_at = time.time()
+    download_path = settings["DOWNLOAD_PATH"]
+    shows, changed = get_schedule(http, settings["GET_SCHEDULE_URL"], os.path.join(download_path, "schedule.json"))
+    now = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+
+    jobs = []
+    upcoming = {}
+    for show in shows:
+        # a cached schedule can still list episodes that have since aired
+        episodes = [episode for episode in show["episodes"] if episode["air_date"] > now]
+        upcoming[show["id"]] = episodes
+        show_path = os.path.join(download_path, str(show["id"]))
         os.makedirs(show_path, exist_ok=True)
 
         # download upcoming episode audio files
         for episode in episodes:
             episode_path = os.path.join(show_path, str(episode["id"]))
-            # TODO skip if already downloaded
-            logging.info(f"downloading [{show['title']}]:[{episode['title']}] to '{episode_path}'")
-            b2_download_file(b2_api, episode["file_id"], episode_path)
-            # TODO report back download status
+            jobs.append((show, episode, episode_path))
 
-        # copy the next episode of this show to where station playlist expects
-        # symlinks in windows are weird, so copy instead of linking
-        if episodes:
-            # TODO skip if it's the same file
-            next_episode = min(episodes, key=lambda ep: ep["air_date"])
-            next_episode_path = os.path.join(show_path, str(next_episode["id"]))
-            logging.info(f"[{show['title']}]:[{next_episode['title']}] is scheduled next, copying '{next_episode_path}' to '{show['file_path']}'")
-            shutil.copyfile(next_episode_path, show["file_path"])
-            # TODO report back next up status
-
-    # clean out old files
-    logging.info("cleaning up old files from download directory")
-    today = datetime.date.today()
-    a_month_ago = today - datetime.timedelta(days=30)
-    num_deleted = 0
-    for root, dirs, files in os.walk(DOWNLOAD_PATH):
-        for f in files:
-            f_path = os.path.join(root, f)
-            created_at = datetime.date.fromtimestamp(os.path.getctime(f_path))
-            if created_at < a_month_ago:
-                os.unlink(f_path)
-                num_deleted += 1
-
-    logging.info(f"deleted {num_deleted} old episodes")
-
-    # TODO report successful run for metrics
+    # partial downloads aren't in the manifest, so they're found on disk;
+    # those of episodes still in the schedule are kept to be resumed
+    partial_size = evict_partials(find_partials(download_path), {path for show, episode, path in jobs})
+
+    jobs, urgent_episode_ids = plan_downloads(jobs, manifest, now, settings["PREFETCH_DAYS"] * 24 * 60 * 60,
+                                              settings["URGENT_HOURS"] * 60 * 60)
+    # before evicting, since a rerun's earlier airing may be about to go
+    adopt_downloads(manifest, jobs)
+
+    # each show's next episode, which has to be on disk come what may
+    next_file_ids = {min(episodes, key=lambda ep: ep["air_date"])["file_id"]
+                     for episodes in upcoming.values() if episodes}
+    quota = settings["DISK_QUOTA"]
+    evict(manifest, plan_evictions(manifest, now, settings["RETENTION_GRACE"], quota, next_file_ids,
+                                   partial_size=partial_size))
+    if quota and manifest.total_size() + partial_size >= quota:
+        # don't download what the quota would evict on the next run
+        wanted = [job for job in jobs if job[1]["file_id"] in next_file_ids or job[1]["id"] in urgent_episode_ids
+                  or manifest.get(job[1]["file_id"])]
+        if len(wanted) < len(jobs):
+            logging.warning(f"download directory is at its quota, only getting next episodes; "
+                            f"{len(jobs) - len(wanted)} more are waiting")
+            jobs = wanted
+
+    rate = settings["MAX_DOWNLOAD_KBPS"] * 1024
+    summary = download_episodes(b2, http, manifest, jobs, settings["DOWNLOAD_WORKERS"],
+                                settings["DOWNLOAD_RETRIES"], settings["DOWNLOAD_BACKOFF"],
+                                rehash=settings["VERIFY_DOWNLOADS"] == "full",
+                                throttle=TokenBucket(rate) if rate else None,
+                                urgent_episode_ids=urgent_episode_ids)
+    failed_episode_ids = {episode["id"] for (show, episode, path), e in summary["failed"]}
+
+    analyses = analyze_downloads(manifest, jobs, settings["ANALYSIS_WORKERS"], settings["ANALYSIS_MIN_SECONDS"],
+                                 settings["ANALYSIS_SILENCE_DB"])
+    failed_episode_ids |= {episode_id for episode_id, analysis in analyses.items() if not analysis["ok"]}
+
+    placements = plan_placements(shows, upcoming, manifest, download_path, failed_episode_ids,
+                                 now=now, grace=settings["PLAYOUT_GRACE"])
+    applied = apply_placements(placements, manifest)
+
+    if jobs and len(summary["skipped"]) < len(jobs):
+        logging.info(f"downloads: {len(summary['succeeded'])} succeeded, {len(summary['skipped'])} skipped, "
+                     f"{len(summary['failed'])} failed")
+    for (show, episode, path), e in summary["failed"]:
+        logging.info(f"  failed: [{show['title']}]:[{episode['title']}]: {e}")
+
+    if reporter is not None:
+        report = build_report(run_id, started_at, shows, manifest, summary, analyses)
+        reporter.submit(report, quiet=not report["downloads"] and not applied)
+
+    return shows, changed
+
+
+def plan_downloads(jobs, manifest, now, horizon, urgent_window):
+    """
+    Order download jobs by air date, soonest first, leaving out episodes
+    airing more than horizon seconds from now (0 for no limit).
+
+    Episodes can share a file, when the same audio was scheduled more than
+    once, so only the soonest episode airing each file is kept.
+
+    Episodes airing within urgent_window seconds that aren't on disk yet
+    are urgent: they're logged, and downloaded without the bandwidth limit.
+
+    Returns (jobs, urgent episode ids).
+    """
+
+    if horizon:
+        jobs = [job for job in jobs if job[1]["air_date"] <= now + horizon]
+    jobs = sorted(jobs, key=lambda job: job[1]["air_date"])
+    soonest = {}
+    for job in jobs:
+        soonest.setdefault(job[1]["file_id"], job)
+    jobs = list(soonest.values())
+
+    urgent_episode_ids = set()
+    for show, episode, path in jobs:
+        if episode["air_date"] > now + urgent_window:
+            break
+        entry = manifest.get(episode["file_id"])
+        if not manifest.is_current(entry, entry["path"] if entry else path):
+            hours = (episode["air_date"] - now) / (60 * 60)
+            logging.warning(f"[{show['title']}]:[{episode['title']}] airs in {hours:.1f} hours and isn't here yet")
+            urgent_episode_ids.add(episode["id"])
+
+    return jobs, urgent_episode_ids
+
+
+def adopt_downloads(manifest, jobs):
+    """
+    Move files already downloaded for another episode, such as an earlier
+    airing of a rerun, to where jobs want them rather than downloading
+    them again. Returns the jobs whose files were moved.
+    """
+
+    adopted = []
+    for job in jobs:
+        show, episode, path = job
+        entry = manifest.get(episode["file_id"])
+        if entry is None or entry["path"] == path or not manifest.is_current(entry, entry["path"]):
+            continue
+
+        try:
+            os.replace(entry["path"], path)
+        except OSError:
+            logging.exception(f"unable to move '{entry['path']}' to '{path}'")
+            continue
+        manifest.move(episode["file_id"], episode, show["id"], path)
+        logging.info(f"[{show['title']}]:[{episode['title']}] was already downloaded, moved '{entry['path']}' "
+                     f"to '{path}'")
+        adopted.append(job)
+
+    return adopted
+
+
+def plan_evictions(manifest, now, grace, quota, protected_file_ids, partial_size=0):
+    """
+    Work out which downloaded episodes to delete, going by the manifest
+    rather than what's on disk.
+
+    Episodes that aired more than grace seconds before now go first. Then,
+    while the rest and partial_size bytes of partial downloads take up
+    more than quota bytes (0 for no quota), the episodes furthest from
+    airing go, since there's the most time to get them again. Episodes in
+    protected_file_ids, each show's next episode, are never evicted for
+    the quota.
+
+    Returns the manifest entries to evict.
+    """
+
+    evictions = list(manifest.aired_before(now - grace))
+    if not quota:
+        return evictions
+
+    evicted = {entry["file_id"] for entry in evictions}
+    usage = manifest.total_size() + partial_size - sum(entry["size"] for entry in evictions)
+    for entry in manifest.furthest_future():
+        if usage <= quota:
+            break
+        if entry["file_id"] in evicted or entry["file_id"] in protected_file_ids:
+            continue
+        evictions.append(entry)
+        usage -= entry["size"]
+
+    if usage > quota:
+        logging.warning(f"downloads take {usage} bytes even with only next episodes kept, over the {quota} byte quota")
+    return evictions
+
+
+def evict(manifest, evictions):
+    """
+    Delete evicted episodes' files, and any partial download left beside
+    them, and drop them from the manifest.
+    """
+
+    for entry in evictions:
+        for path in (entry["path"], entry["path"] + ".part"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.exception(f"unable to delete '{path}'")
+        manifest.remove(entry["file_id"])
+
+    if evictions:
+        logging.info(f"evicted {len(evictions)} downloaded episodes")
+
+
+def find_partials(download_path):
+    """
+    Find the partial downloads under download_path, which interrupted
+    downloads leave as <show id>/<episode id>.part.
+
+    Returns a dict of each one's path to its size.
+    """
+
+    partials = {}
+    for path in glob.glob(os.path.join(glob.escape(download_path), "*", "*.part")):
+        try:
+            partials[path] = os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+    return partials
+
+
+def evict_partials(partials, wanted_paths):
+    """
+    Delete the partial downloads, from find_partials, of episodes whose
+    paths aren't in wanted_paths, since they'll never be resumed.
+
+    Returns the bytes taken up by the partial downloads that are kept.
+    """
+
+    kept = 0
+    evicted = 0
+    for path, size in partials.items():
+        if path[:-len(".part")] in wanted_paths:
+            kept += size
+            continue
+        try:
+            os.unlink(path)
+            evicted += 1
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logging.exception(f"unable to delete '{path}'")
+            kept += size
+
+    if evicted:
+        logging.info(f"evicted {evicted} partial downloads")
+    return kept
+
+
+# uploads close this long before a show airs, see create_episode in the
+# scheduler
+UPLOAD_CUTOFF_SECONDS = 60 * 60
+
+
+def plan_wakeups(shows, manifest, now, grace, margin=60):
+    """
+    Work out when the daemon next needs to run, other than to poll.
+
+    That's just after the episode placed for each show is done airing, to
+    swap in the next one, and just after uploads close for each show's
+    next timeslot, to pick up last-minute uploads. Returns a heap of
+    (time, reason) later than now.
+    """
+
+    wakeups = []
+    for show in shows:
+        placement = manifest.get_placement(show["file_path"])
+        entry = manifest.get(placement["file_id"]) if placement else None
+        if entry is not None and entry["air_date"] + grace + margin > now:
+            wakeups.append((entry["air_date"] + grace + margin, f"[{show['title']}] is done airing"))
+
+        next_air_date = show.get("next_air_date")
+        if next_air_date is not None:
+            # a cached schedule's slot may have passed; slots are weekly
+            while next_air_date - UPLOAD_CUTOFF_SECONDS + margin <= now:
+                next_air_date += 7 * 24 * 60 * 60
+            wakeups.append((next_air_date - UPLOAD_CUTOFF_SECONDS + margin, f"uploads closed for [{show['title']}]"))
+
+    heapq.heapify(wakeups)
+    return wakeups
+
+
+def run_once(settings):
+    """
+    Run one iteration of the episode puller.
+    """
+
+    http = make_http_session(settings)
+    os.makedirs(settings["DOWNLOAD_PATH"], exist_ok=True)
+    manifest = Manifest(os.path.join(settings["DOWNLOAD_PATH"], "manifest.sqlite3"))
+    try:
+        sync_once(settings, B2Connection(settings), http, manifest, make_reporter(settings, http))
+    finally:
+        manifest.close()
+
+
+def load_schedule_cursor(cache_path):
+    """
+    The change log cursor of the schedule feed cached by get_schedule, or
+    None.
+    """
+
+    try:
+        with open(cache_path) as f:
+            return json.load(f)["cursor"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def run_daemon(settings):
+    """
+    Run the episode puller until it's told to stop with SIGINT or SIGTERM.
+
+    B2 auth and HTTP connections are kept between syncs. The schedule is
+    polled every POLL_MIN seconds, backing off to POLL_MAX while it stays
+    unchanged, and the puller also wakes up for the air dates and upload
+    deadlines from plan_wakeups. With SCHEDULE_EVENTS_URL set, it syncs
+    whenever the scheduler streams a change, and polls at POLL_MAX while
+    the stream is up. A signal lets the sync in progress finish; an
+    interrupted download would be resumed anyway.
+    """
+
+    stop = threading.Event()
+    # set to sync again early, by a schedule change or a signal
+    wake = threading.Event()
+
+    def handle_signal(signum, frame):
+        logging.info(f"got signal {signum}, stopping after this sync")
+        stop.set()
+        wake.set()
+
+    for name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        # SIGBREAK is Ctrl-Break on Windows
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), handle_signal)
+
+    b2 = B2Connection(settings)
+    http = make_http_session(settings)
+    os.makedirs(settings["DOWNLOAD_PATH"], exist_ok=True)
+    manifest = Manifest(os.path.join(settings["DOWNLOAD_PATH"], "manifest.sqlite3"))
+    reporter = make_reporter(settings, http)
+    watcher = None
+    poll = settings["POLL_MIN"]
+    shows = []
+    try:
+        while not stop.is_set():
+            # changes streamed during the sync get another one right after
+            wake.clear()
+            try:
+                shows, changed = sync_once(settings, b2, http, manifest, reporter)
+            except Exception:
+                logging.exception("sync failed")
+                changed = False
+            poll = settings["POLL_MIN"] if changed else min(poll * 2, settings["POLL_MAX"])
+
+            if watcher is None and settings["SCHEDULE_EVENTS_URL"]:
+                # picking up from the schedule just synced
+                cursor = load_schedule_cursor(os.path.join(settings["DOWNLOAD_PATH"], "schedule.json"))
+                watcher = ScheduleWatcher(make_http_session(settings), settings["SCHEDULE_EVENTS_URL"],
+                                          lambda event: wake.set(), last_id=cursor)
+                watcher.start()
+            if watcher is not None and watcher.connected:
+                poll = settings["POLL_MAX"]
+
+            now = time.time()
+            wake_at, reason = now + poll, "polling the schedule"
+            wakeups = plan_wakeups(shows, manifest, now, settings["PLAYOUT_GRACE"])
+            if wakeups and wakeups[0][0] < wake_at:
+                wake_at, reason = wakeups[0]
+            logging.debug(f"sleeping {wake_at - now:.0f}s until {reason}")
+            wake.wait(wake_at - now)
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        manifest.close()
+
+    logging.info("episode puller stopped")
 
 # TODO send logs somewhere (might be external stuff, idk)
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Download upcoming episodes and put them in place for playout.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running, syncing as the schedule and air dates require")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.info("starting episode puller")
+    load_dotenv()  # loads values from .env file into environment variables
+    settings = load_settings()
+    if args.daemon:
+        run_daemon(settings)
+    else:
+        run_once(settings)
+
+
 if __name__ == "__main__":
-    run_once()
+    main()
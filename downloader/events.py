@@ -0,0 +1,98 @@
+import json
+import logging
+import threading
+
+import requests
+
+
+def parse_events(lines):
+    """
+    Parse server-sent events from the lines of a stream, yielding a dict
+    of each event's fields with its "data" decoded from JSON. Comments
+    and events without data, such as retry hints, are skipped.
+    """
+
+    event = {}
+    for line in lines:
+        if not line:
+            if "data" in event:
+                event["data"] = json.loads(event["data"])
+                yield event
+            event = {}
+        elif not line.startswith(":"):
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            event[field] = event[field] + "\n" + value if field == "data" and "data" in event else value
+
+
+class ScheduleWatcher:
+    """
+    Follows the scheduler's stream of schedule changes in a thread of its
+    own, calling on_change with each change as it comes in, so a late
+    upload is picked up right away rather than at the next poll.
+
+    The stream ends every so often and is reconnected with the id of the
+    last change seen, so none made in between are missed. While the
+    scheduler can't be reached, reconnecting backs off from reconnect_min
+    to reconnect_max seconds.
+    """
+
+    def __init__(self, http, url, on_change, last_id=None, reconnect_min=1, reconnect_max=300):
+        """
+        last_id is the id of the last change already synced; with None,
+        only changes from when the stream first connects are followed.
+        """
+
+        self.http = http
+        self.url = url
+        self.on_change = on_change
+        self.last_id = last_id
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.connected = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="schedule-watcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        delay = self.reconnect_min
+        while not self._stop.is_set():
+            try:
+                self.follow()
+            except (requests.RequestException, ValueError) as e:
+                if self.connected:
+                    logging.warning(f"lost the schedule change stream, polling until it's back: {e}")
+                self.connected = False
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.reconnect_max)
+            else:
+                delay = self.reconnect_min
+                self._stop.wait(self.reconnect_min)
+
+    def follow(self):
+        """
+        Read one connection's worth of the change stream.
+        """
+
+        headers = {"Accept": "text/event-stream"}
+        if self.last_id is not None:
+            headers["Last-Event-ID"] = str(self.last_id)
+
+        # the scheduler sends a heartbeat well within the read timeout
+        with self.http.get(self.url, headers=headers, stream=True, timeout=(10, 60)) as r:
+            r.raise_for_status()
+            if not self.connected:
+                logging.info(f"following schedule changes from '{self.url}'")
+            self.connected = True
+            for event in parse_events(r.iter_lines(decode_unicode=True)):
+                if self._stop.is_set():
+                    return
+                if event.get("id"):
+                    self.last_id = int(event["id"])
+                logging.debug(f"schedule change: {event['data']}")
+                self.on_change(event)
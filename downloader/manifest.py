@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def file_sha1(path, chunk_size=1024 * 1024):
+    """
+    SHA-1 hex digest of the file at path, read in chunks.
+    """
+
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class Manifest:
+    """
+    Record of the episode files the puller has downloaded, kept in a SQLite
+    file next to them and keyed by B2 file id.
+
+    Safe to share between download threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                " file_id TEXT PRIMARY KEY,"
+                " episode_id INTEGER NOT NULL,"
+                " show_id INTEGER NOT NULL,"
+                " path TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " sha1 TEXT,"
+                " mtime_ns INTEGER NOT NULL,"
+                " air_date INTEGER NOT NULL,"
+                " downloaded_at INTEGER NOT NULL,"
+                " analysis TEXT)")
+            columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(downloads)")]
+            if "analysis" not in columns:
+                # manifests from before files were analyzed
+                self._conn.execute("ALTER TABLE downloads ADD COLUMN analysis TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS downloads_air_date ON downloads (air_date)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS placements ("
+                " path TEXT PRIMARY KEY,"
+                " file_id TEXT NOT NULL,"
+                " episode_id INTEGER NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " placed_at INTEGER NOT NULL)")
+
+    def get(self, file_id):
+        """
+        The manifest entry for file_id, or None.
+        """
+
+        with self._lock:
+            return self._conn.execute("SELECT * FROM downloads WHERE file_id = ?", (file_id,)).fetchone()
+
+    def record(self, file_id, episode, show_id, path, size, sha1):
+        """
+        Record a file just downloaded to path, replacing whatever entry was
+        there for path before. The file's mtime is taken from disk now.
+        """
+
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM downloads WHERE path = ? AND file_id != ?", (path, file_id))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO downloads"
+                " (file_id, episode_id, show_id, path, size, sha1, mtime_ns, air_date, downloaded_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_id, episode["id"], show_id, path, size, sha1, mtime_ns, episode["air_date"], int(time.time())))
+
+    def move(self, file_id, episode, show_id, path):
+        """
+        Record that the file with file_id, already on disk, was moved to
+        path for another episode, replacing whatever entry was there for
+        path before. What's known about its contents is kept.
+        """
+
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM downloads WHERE path = ? AND file_id != ?", (path, file_id))
+            self._conn.execute(
+                "UPDATE downloads SET episode_id = ?, show_id = ?, path = ?, air_date = ? WHERE file_id = ?",
+                (episode["id"], show_id, path, episode["air_date"], file_id))
+
+    def record_analysis(self, file_id, analysis):
+        """
+        Record the result of analyzing the file with file_id, a dict from
+        analysis.analyze_file.
+        """
+
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE downloads SET analysis = ? WHERE file_id = ?", (json.dumps(analysis), file_id))
+
+    def get_analysis(self, file_id):
+        """
+        The recorded analysis of the file with file_id, or None if it
+        hasn't been analyzed.
+        """
+
+        entry = self.get(file_id)
+        if entry is None or entry["analysis"] is None:
+            return None
+        return json.loads(entry["analysis"])
+
+    def remove(self, file_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM downloads WHERE file_id = ?", (file_id,))
+
+    def aired_before(self, before):
+        """
+        Entries for episodes that aired before the timestamp before, oldest
+        first.
+        """
+
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM downloads WHERE air_date < ? ORDER BY air_date", (before,)).fetchall()
+
+    def furthest_future(self):
+        """
+        Every entry, the furthest from airing first.
+        """
+
+        with self._lock:
+            return self._conn.execute("SELECT * FROM downloads ORDER BY air_date DESC").fetchall()
+
+    def total_size(self):
+        """
+        Bytes taken up by the files in the manifest.
+        """
+
+        with self._lock:
+            return self._conn.execute("SELECT coalesce(sum(size), 0) FROM downloads").fetchone()[0]
+
+    def is_current(self, entry, path, rehash=False):
+        """
+        Whether the file at path is still the one entry describes.
+
+        Compares size and mtime, which costs one stat. With rehash, the file
+        is also read back and checked against the recorded SHA-1.
+        """
+
+        if entry is None or entry["path"] != path:
+            return False
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]:
+            return False
+
+        if rehash and entry["sha1"]:
+            return file_sha1(path) == entry["sha1"]
+
+        return True
+
+    def get_placement(self, path):
+        """
+        What was last placed at the playout path, or None.
+        """
+
+        with self._lock:
+            return self._conn.execute("SELECT * FROM placements WHERE path = ?", (path,)).fetchone()
+
+    def record_placement(self, path, file_id, episode_id):
+        """
+        Record that the file with file_id was just placed at path.
+        """
+
+        stat = os.stat(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO placements (path, file_id, episode_id, size, mtime_ns, placed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (path, file_id, episode_id, stat.st_size, stat.st_mtime_ns, int(time.time())))
+
+    def is_placed(self, path, file_id):
+        """
+        Whether path still holds the file with file_id that we put there,
+        going by the size and mtime recorded when it was placed.
+        """
+
+        placement = self.get_placement(path)
+        if placement is None or placement["file_id"] != file_id:
+            return False
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+
+        return stat.st_size == placement["size"] and stat.st_mtime_ns == placement["mtime_ns"]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
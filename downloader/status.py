@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import time
+
+import requests
+
+
+class StatusReporter:
+    """
+    Sends run status reports to the scheduler, by way of a spool directory
+    so that reports made while the scheduler is unreachable are sent once
+    it's back, oldest first.
+    """
+
+    def __init__(self, http, url, token, spool_path, heartbeat=15 * 60, max_spooled=500):
+        """
+        Reports with nothing new in them are only sent every heartbeat
+        seconds. At most max_spooled unsent reports are kept; older ones
+        are dropped.
+        """
+
+        self.http = http
+        self.url = url
+        self.token = token
+        self.spool_path = spool_path
+        self.heartbeat = heartbeat
+        self.max_spooled = max_spooled
+        self._last_sent = None
+        os.makedirs(spool_path, exist_ok=True)
+
+    def submit(self, report, quiet=False):
+        """
+        Spool a run's report and send every spooled report. Quiet reports,
+        those of runs that didn't download or place anything, are dropped
+        unless a heartbeat is due.
+        """
+
+        if not quiet or self._last_sent is None or time.monotonic() - self._last_sent >= self.heartbeat:
+            # named so that they sort oldest first
+            name = f"{int(report['finished_at'] * 1000):015d}-{report['id']}.json"
+            tmp_path = os.path.join(self.spool_path, name + ".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(report, f)
+            os.replace(tmp_path, os.path.join(self.spool_path, name))
+            self._last_sent = time.monotonic()
+
+        self.flush()
+
+    def spooled(self):
+        return sorted(name for name in os.listdir(self.spool_path) if name.endswith(".json"))
+
+    def flush(self):
+        """
+        Send spooled reports until one fails. Returns how many were sent.
+        """
+
+        names = self.spooled()
+        for name in names[:-self.max_spooled]:
+            logging.warning(f"dropping old status report '{name}', the spool is full")
+            os.unlink(os.path.join(self.spool_path, name))
+        names = names[-self.max_spooled:]
+
+        sent = 0
+        for name in names:
+            path = os.path.join(self.spool_path, name)
+            with open(path) as f:
+                report = json.load(f)
+
+            try:
+                r = self.http.post(self.url, json=report, headers={"Authorization": f"Bearer {self.token}"},
+                                   timeout=(10, 60))
+            except requests.RequestException as e:
+                logging.warning(f"unable to send status reports, {len(names) - sent} spooled: {e}")
+                return sent
+
+            if r.status_code == 400:
+                # resending it won't help
+                logging.error(f"scheduler rejected status report '{name}': {r.text}")
+                os.unlink(path)
+                continue
+            if r.status_code != 200:
+                logging.warning(f"unable to send status reports, http status {r.status_code}, "
+                                f"{len(names) - sent} spooled")
+                return sent
+
+            os.unlink(path)
+            sent += 1
+
+        return sent
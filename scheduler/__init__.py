@@ -8,11 +8,30 @@ def create_app(test_config=None):
     app = Flask(__name__)
     app.config.from_object('scheduler.config.Config')
 
+    if test_config:
+        # load the test config if passed in
+        app.config.update(test_config)
+
+    # instrument requests before anything else hooks into them
+    from scheduler import metrics
+
+    metrics.init_app(app)
+
     # register the database commands
     from scheduler import db
 
     db.init_app(app)
 
+    # register the upload commands
+    from scheduler import upload
+
+    upload.init_app(app)
+
+    # set up the response cache
+    from scheduler import cache
+
+    cache.init_app(app)
+
     # apply the blueprints to the app
     from scheduler import auth, scheduler
 
@@ -1,4 +1,6 @@
 import functools
+import threading
+import time
 
 from flask import Blueprint
 from flask import current_app
@@ -30,18 +32,75 @@ def login_required(view):
     return wrapped_view
 
 
+def skip_user_lookup(view):
+    """View decorator for endpoints that never look at ``g.user``, such
+    as the JSON feeds polled by the station, so requests to them don't
+    load the logged in user."""
+    view.skip_user_lookup = True
+    return view
+
+
+# columns of Users loaded into g.user; never the password hash
+USER_COLUMNS = ("id", "name", "email", "superuser")
+
+_user_cache = {}  # user id -> (user dict, monotonic expiry time)
+_user_cache_lock = threading.Lock()
+
+
+def cache_user(user):
+    """Put a user into the logged in user cache."""
+    user = {column: user[column] for column in USER_COLUMNS}
+    expires = time.monotonic() + current_app.config["USER_CACHE_TTL"]
+    with _user_cache_lock:
+        _user_cache[user["id"]] = (user, expires)
+    return user
+
+
+def invalidate_user(user_id):
+    """Drop a user from the logged in user cache. Call this whenever a
+    Users row changes.
+
+    The cache is per process, so other workers can keep serving the old
+    row for up to ``USER_CACHE_TTL`` seconds.
+    """
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+
+def get_user(user_id):
+    """Get a user by id, from the cache if it's fresh enough.
+
+    :return: a dict of ``USER_COLUMNS``, or ``None`` if there's no such user
+    """
+    with _user_cache_lock:
+        user, expires = _user_cache.get(user_id, (None, 0))
+    if user and expires > time.monotonic():
+        return user
+
+    cur = get_db().cursor()
+    cur.execute(
+        "SELECT " + ", ".join(USER_COLUMNS) + " FROM Users WHERE id = %s",
+        (user_id,))
+    user = cur.fetchone()
+
+    if not user:
+        invalidate_user(user_id)
+        return None
+
+    return cache_user(user)
+
+
 @bp.before_app_request
 def load_logged_in_user():
     """If a user id is stored in the session, load the user object from
-    the database into ``g.user``."""
+    the database (or the short lived user cache) into ``g.user``."""
     user_id = session.get("user_id")
+    view = current_app.view_functions.get(request.endpoint)
 
-    if not user_id:
+    if not user_id or request.endpoint == "static" or getattr(view, "skip_user_lookup", False):
         g.user = None
     else:
-        cur = get_db().cursor()
-        cur.execute("SELECT * FROM Users WHERE id = %s", (user_id,))
-        g.user = cur.fetchone()
+        g.user = get_user(user_id)
 
 
 @bp.route("/register", methods=("GET", "POST"))
@@ -107,6 +166,7 @@ def login():
             # store the user id in a new session and return to the index
             session.clear()
             session["user_id"] = user["id"]
+            cache_user(user)
             return redirect(url_for("index"))
 
         flash(error)
@@ -117,5 +177,7 @@ def login():
 @bp.route("/logout")
 def logout():
     """Clear the current session, including the stored user id."""
+    if g.user:
+        invalidate_user(g.user["id"])
     session.clear()
     return redirect(url_for("index"))
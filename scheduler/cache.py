@@ -0,0 +1,199 @@
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class MemoryBackend:
+    """A bounded LRU cache with per entry expiry, local to one process.
+
+    Also stands in for :class:`RedisBackend` in tests.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, monotonic expiry or None)
+
+    def get_many(self, keys):
+        """Get several values at once, ``None`` for missing ones."""
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                value, expires = self._entries.get(key, (None, None))
+                if expires is not None and expires <= now:
+                    del self._entries[key]
+                    value = None
+                elif value is not None:
+                    self._entries.move_to_end(key)
+                values.append(value)
+        return values
+
+    def set(self, key, value, timeout=None):
+        """Store a value, for ``timeout`` seconds or until evicted."""
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """A cache shared by every process and dyno, stored in Redis.
+
+    Requires the ``redis`` package. Values are pickled.
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+
+    def get_many(self, keys):
+        return [pickle.loads(value) if value is not None else None
+                for value in self._redis.mget(keys)]
+
+    def set(self, key, value, timeout=None):
+        self._redis.set(key, pickle.dumps(value), ex=int(timeout) if timeout else None)
+
+    def clear(self):
+        self._redis.flushdb()
+
+
+class Cache:
+    """A cache of values tagged with what they were computed from.
+
+    Every tag has a version token stored in the backend. Entries record
+    the versions of their tags when they are stored, and
+    :meth:`invalidate` gives a tag a new version, so a write only has to
+    name the tags it touched to retire every entry that depends on them.
+    A tag evicted from the backend also gets a new version, which only
+    costs misses, never stale hits.
+    """
+
+    def __init__(self, backend, default_timeout=300):
+        self.backend = backend
+        self.default_timeout = default_timeout
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def _tag_versions(self, tags):
+        keys = [f"tag:{tag}" for tag in tags]
+        versions = self.backend.get_many(keys)
+        for i, version in enumerate(versions):
+            if version is None:
+                versions[i] = uuid.uuid4().hex
+                self.backend.set(keys[i], versions[i])
+        return dict(zip(tags, versions))
+
+    def get(self, key):
+        """Get a cached value, or ``None`` if it's missing or one of its
+        tags was invalidated since it was stored."""
+        entry, = self.backend.get_many([key])
+        if entry is not None:
+            value, versions = entry
+            if not versions or self._tag_versions(list(versions)) == versions:
+                self._count("hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def set(self, key, value, tags=(), timeout=None):
+        """Store a value under key, tagged with what it depends on.
+
+        The tags' versions are read now, so a write that invalidated them
+        while the value was being computed goes unnoticed; use
+        :meth:`get_or_compute` for values read from the database.
+        """
+        versions = self._tag_versions(list(tags)) if tags else {}
+        self.backend.set(key, (value, versions), timeout or self.default_timeout)
+
+    def get_or_compute(self, key, compute, tags=(), more_tags=None, timeout=None):
+        """Get a cached value, or compute and store it if it's missing.
+
+        The tags' versions are read before ``compute`` runs. Writes
+        invalidate their tags after they commit, so one that lands while
+        the value is computed leaves it stored already stale, rather
+        than cached as current until the next write.
+
+        :param compute: function returning the value
+        :param more_tags: function returning more tags the value depends
+            on, called on a miss once the versions of ``tags`` are read;
+            for tags found in data a tag in ``tags`` covers, like the
+            shows a user owns
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        versions = self._tag_versions(list(tags)) if tags else {}
+        if more_tags:
+            versions.update(self._tag_versions(list(more_tags())))
+        value = compute()
+        self.backend.set(key, (value, versions), timeout or self.default_timeout)
+        return value
+
+    def invalidate(self, *tags):
+        """Retire every entry tagged with any of tags."""
+        for tag in tags:
+            self.backend.set(f"tag:{tag}", uuid.uuid4().hex)
+        self._count("invalidations", len(tags))
+
+    def stats(self):
+        """Return a snapshot of the hit, miss and invalidation counters."""
+        with self._lock:
+            return dict(self._stats)
+
+
+def show_tag(show_id):
+    """Tag for anything that shows a show or its episodes."""
+    return f"show:{show_id}"
+
+
+def user_tag(user_id):
+    """Tag for anything listing the shows a user owns."""
+    return f"user:{user_id}"
+
+
+# tag for anything listing every show
+SHOWS_TAG = "shows"
+
+
+def get_cache():
+    """Get the app's response cache."""
+    return current_app.extensions["cache"]
+
+
+def init_app(app):
+    """Set up the app's response cache. This is called by the application
+    factory.
+
+    ``CACHE_URL`` picks a Redis server shared by all dynos; without it
+    each process keeps its own in-memory cache, which other processes'
+    writes can't invalidate before ``CACHE_DEFAULT_TIMEOUT``.
+    """
+    if app.config["CACHE_URL"]:
+        backend = RedisBackend(app.config["CACHE_URL"])
+    else:
+        backend = MemoryBackend(app.config["CACHE_MAX_ENTRIES"])
+        if app.config["WEB_CONCURRENCY"] > 1:
+            app.logger.warning(
+                "CACHE_URL isn't set, so each of the %d workers caches in memory "
+                "and may serve pages up to %d seconds stale after another's writes",
+                app.config["WEB_CONCURRENCY"], app.config["CACHE_DEFAULT_TIMEOUT"])
+
+    app.extensions["cache"] = Cache(backend, app.config["CACHE_DEFAULT_TIMEOUT"])
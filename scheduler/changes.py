@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from flask import current_app
+
+from scheduler.db import get_pool
+
+log = logging.getLogger(__name__)
+
+# the channel ScheduleChanges inserts are announced on, by the
+# notify_schedule_change trigger in schema.sql
+CHANNEL = "schedule_changes"
+
+# how long an EventSource waits before reconnecting after a stream ends
+RETRY_MS = 1000
+
+
+class ChangeListener:
+    """LISTENs for schedule changes on a database connection of its own,
+    and wakes every change stream in this process when one is committed.
+
+    Notifications carry no payload: streams read the change log itself,
+    so a notification lost while the connection was down only delays
+    them until their next heartbeat.
+    """
+
+    def __init__(self, dsn, poll=5.0, reconnect_after=5.0):
+        """
+        :param dsn: libpq connection string or URL
+        :param poll: seconds between checks that the connection is alive
+        :param reconnect_after: seconds to wait before reconnecting after
+            the connection fails
+        """
+        self.dsn = dsn
+        self.poll = poll
+        self.reconnect_after = reconnect_after
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._thread = threading.Thread(target=self._run, name="schedule-change-listener", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    @property
+    def generation(self):
+        """A counter bumped for every batch of notifications."""
+        with self._cond:
+            return self._generation
+
+    def wait(self, generation, timeout):
+        """Wait up to ``timeout`` seconds for notifications after
+        ``generation``.
+
+        :return: the current generation, which is ``generation`` if
+            nothing changed
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._generation != generation, timeout)
+            return self._generation
+
+    def _wake(self):
+        with self._cond:
+            self._generation += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            try:
+                conn = psycopg2.connect(self.dsn)
+                try:
+                    conn.autocommit = True
+                    conn.cursor().execute(f"LISTEN {CHANNEL}")
+                    # changes committed while nothing was listening
+                    self._wake()
+                    while True:
+                        if select.select([conn], [], [], self.poll) == ([], [], []):
+                            # raises if the connection has gone away
+                            conn.cursor().execute("SELECT 1")
+                            continue
+                        conn.poll()
+                        if conn.notifies:
+                            conn.notifies.clear()
+                            self._wake()
+                finally:
+                    conn.close()
+            except Exception:
+                log.exception("schedule change listener lost its database connection")
+            time.sleep(self.reconnect_after)
+
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def get_change_listener():
+    """Get this process's :class:`ChangeListener`, starting it on first
+    use."""
+    global _listener, _listener_pid
+
+    if _listener is None or _listener_pid != os.getpid():
+        with _listener_lock:
+            if _listener is None or _listener_pid != os.getpid():
+                _listener = ChangeListener(current_app.config["DATABASE_URL"])
+                _listener.start()
+                _listener_pid = os.getpid()
+    return _listener
+
+
+def query_changes(sql, vars):
+    """Run a change log query on a pooled connection held only for the
+    query, rather than for the whole stream as ``get_db`` would."""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute(sql, vars)
+        return cur.fetchall()
+    finally:
+        pool.putconn(conn)
+
+
+def get_latest_change_id():
+    """Get the id of the newest schedule change, 0 if there are none."""
+    return query_changes("SELECT COALESCE(max(id), 0) FROM ScheduleChanges", ())[0][0]
+
+
+def get_changes(after, limit=500):
+    """Get the schedule changes after id ``after``, oldest first."""
+    return query_changes(
+        "SELECT id, operation, show_id, episode_id FROM ScheduleChanges WHERE id > %s ORDER BY id LIMIT %s",
+        (after, limit))
+
+
+def format_event(data, id=None, event=None):
+    """Format one server-sent event."""
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_changes(after, duration, heartbeat, limit=500):
+    """Generate server-sent events for the schedule changes after id
+    ``after``, then for each one committed until ``duration`` seconds
+    have passed.
+
+    Each event's id is the change's id, so a client reconnecting with
+    ``Last-Event-ID`` picks up where it left off. A client whose id is
+    ahead of the change log, as after the database was reset, gets a
+    ``reset`` event with the latest id and should refetch everything.
+
+    Change ids are drawn in commit order (see
+    ``serialize_schedule_changes`` in schema.sql), so no change can
+    commit below the latest id and starting from it misses nothing.
+
+    :param after: id of the last change the client has, or ``None`` for
+        only changes from now on
+    :param heartbeat: seconds between comments sent while there are no
+        changes, to keep proxies from closing the stream
+    """
+    listener = get_change_listener()
+    generation = listener.generation
+    deadline = time.monotonic() + duration
+    latest = get_latest_change_id()
+    yield f"retry: {RETRY_MS}\n\n"
+
+    if after is None or after > latest:
+        if after is not None:
+            yield format_event({"cursor": latest}, id=latest, event="reset")
+        after = latest
+
+    while True:
+        changes = get_changes(after, limit)
+        for change in changes:
+            after = change["id"]
+            yield format_event(
+                {"id": change["id"], "operation": change["operation"], "show_id": change["show_id"],
+                 "episode_id": change["episode_id"]},
+                id=change["id"])
+        if len(changes) == limit:
+            continue
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        current = listener.wait(generation, min(remaining, heartbeat))
+        if current == generation:
+            yield ": heartbeat\n\n"
+        generation = current
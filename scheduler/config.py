@@ -14,3 +14,62 @@ class Config:
     B2_UPLOAD_KEY_ID = os.environ.get("B2_UPLOAD_KEY_ID")
     B2_UPLOAD_KEY = os.environ.get("B2_UPLOAD_KEY")
     B2_BUCKET_ID = os.environ.get("B2_BUCKET_ID")
+    B2_REALM = os.environ.get("B2_REALM", "production")
+    # upload URLs fetched ahead of time so the create episode page doesn't
+    # wait on B2
+    B2_UPLOAD_URL_POOL_SIZE = int(os.environ.get("B2_UPLOAD_URL_POOL_SIZE", 4))
+
+    # dashboard paging: shows per page, and upcoming episodes listed per show
+    INDEX_SHOWS_PER_PAGE = int(os.environ.get("INDEX_SHOWS_PER_PAGE", 20))
+    INDEX_EPISODES_PER_SHOW = int(os.environ.get("INDEX_EPISODES_PER_SHOW", 10))
+
+    # per-process database connection pool. gunicorn runs one process per
+    # worker with WEB_THREADS threads each (see the Procfile), and every
+    # thread can hold a connection, so the pool defaults to one per thread.
+    # The database sees up to WEB_CONCURRENCY * DB_POOL_MAX_SIZE
+    # connections; keep that under the Postgres plan's connection limit
+    WEB_THREADS = int(os.environ.get("WEB_THREADS", 8))
+    DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+    DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", WEB_THREADS))
+    DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+    DB_POOL_PING_AFTER = float(os.environ.get("DB_POOL_PING_AFTER", 30))
+
+    # seconds a logged in user's row is cached between requests
+    USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 30))
+
+    # response cache; set CACHE_URL to a redis:// URL to share it between
+    # dynos, otherwise each process caches in memory. Without Redis, a
+    # write only invalidates the cache of the process that handled it, so
+    # with more than one worker (WEB_CONCURRENCY) the others can serve
+    # stale pages for up to CACHE_DEFAULT_TIMEOUT seconds
+    WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+    CACHE_URL = os.environ.get("CACHE_URL")
+    CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get("CACHE_DEFAULT_TIMEOUT", 300))
+    # pages listing upcoming episodes go stale as episodes air
+    INDEX_CACHE_TIMEOUT = int(os.environ.get("INDEX_CACHE_TIMEOUT", 60))
+
+    # request/SQL/B2 timing and the /metrics endpoint
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+    # queries taking at least this many seconds go to the slow query log
+    SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", 0.25))
+
+    # audio files larger than one part are uploaded as B2 large files, in
+    # parts of this many bytes (at least 5 MB), a few parts at a time
+    B2_PART_SIZE = int(os.environ.get("B2_PART_SIZE", 25 * 1024 * 1024))
+    B2_UPLOAD_CONCURRENCY = int(os.environ.get("B2_UPLOAD_CONCURRENCY", 4))
+
+    # seconds an episode timeslot stays reserved without the upload page
+    # renewing it
+    EPISODE_RESERVATION_TTL = int(os.environ.get("EPISODE_RESERVATION_TTL", 30 * 60))
+
+    # schedule change streams to the station end after this many seconds,
+    # and the puller reconnects with the id of the last change it got.
+    # Each open stream holds a worker thread, so gunicorn must run threaded
+    # workers (see the Procfile); a sync worker would serve nothing else
+    SCHEDULE_STREAM_SECONDS = float(os.environ.get("SCHEDULE_STREAM_SECONDS", 25))
+    SCHEDULE_STREAM_HEARTBEAT = float(os.environ.get("SCHEDULE_STREAM_HEARTBEAT", 10))
+
+    # shared secret the station puller sends as a bearer token with its
+    # status reports; reports are refused while it's unset
+    STATION_TOKEN = os.environ.get("STATION_TOKEN")
@@ -1,5 +1,12 @@
+import os
+import threading
+import time
+
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
 from psycopg2.extras import DictCursor
+from psycopg2.pool import PoolError
 
 import click
 from flask import current_app
@@ -7,24 +14,326 @@ from flask import g
 from flask.cli import with_appcontext
 
 
+class ConnectionPool:
+    """A thread safe pool of database connections.
+
+    Callers wait up to ``timeout`` seconds for a connection when all
+    ``maxconn`` are checked out. Connections are rolled back when they
+    are returned, and closed or broken connections are replaced with
+    fresh ones rather than handed out again.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=4, timeout=5.0, ping_after=30.0, cursor_factory=DictCursor):
+        """
+        :param dsn: libpq connection string or URL
+        :param minconn: connections to open up front by ``prefill``
+        :param maxconn: most connections checked out at once
+        :param timeout: seconds to wait for a free connection
+        :param ping_after: seconds a connection can sit idle before it is
+            checked with a round trip on checkout
+        :param cursor_factory: cursor class for the pool's connections
+        """
+        self.dsn = dsn
+        self.cursor_factory = cursor_factory
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = []  # (connection, time it was returned)
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "exhausted": 0,
+            "connects": 0,
+            "discards": 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=self.cursor_factory)
+        with self._lock:
+            self._stats["connects"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats["discards"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_usable(self, conn, idle_since):
+        """Check a connection coming out of the idle list."""
+        if conn.closed:
+            return False
+
+        if time.monotonic() - idle_since < self.ping_after:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def getconn(self):
+        """Check out a connection, waiting for one if the pool is empty.
+
+        :raise PoolError: if no connection became free within ``timeout``
+        """
+        if not self._slots.acquire(blocking=False):
+            start = time.monotonic()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            with self._lock:
+                self._stats["waits"] += 1
+                self._stats["wait_seconds"] += time.monotonic() - start
+                if not acquired:
+                    self._stats["exhausted"] += 1
+            if not acquired:
+                raise PoolError(f"no database connection free after {self.timeout}s")
+
+        try:
+            while True:
+                with self._lock:
+                    conn, idle_since = self._idle.pop() if self._idle else (None, None)
+                if not conn:
+                    conn = self._connect()
+                    break
+                if self._is_usable(conn, idle_since):
+                    break
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+        return conn
+
+    def _reset_session(self, conn):
+        """Put a connection's session back the way it was when it was
+        opened, dropping any settings, temporary tables and prepared
+        statements the last user left behind."""
+        # DISCARD ALL can't run inside a transaction
+        conn.autocommit = True
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute("DISCARD ALL")
+        finally:
+            conn.autocommit = False
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool, rolling back any transaction
+        left open and resetting the session. Broken connections are
+        closed instead of kept.
+        """
+        try:
+            if not close and not conn.closed:
+                status = conn.info.transaction_status
+                if status == TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                else:
+                    try:
+                        if status != TRANSACTION_STATUS_IDLE:
+                            conn.rollback()
+                        self._reset_session(conn)
+                    except psycopg2.Error:
+                        close = True
+
+            if close or conn.closed:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def prefill(self):
+        """Open connections until ``minconn`` are idle."""
+        while True:
+            with self._lock:
+                if len(self._idle) >= self.minconn:
+                    return
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    def closeall(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        """Return a snapshot of the pool counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = len(self._idle)
+        stats["size"] = self.maxconn
+        return stats
+
+
+_pools = {}  # DSN -> ConnectionPool
+_pools_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Get this process's connection pool for the app's database,
+    creating it on first use.
+
+    Pools are kept per process id so that each gunicorn worker forked
+    from the master opens its own connections, and per DSN so that apps
+    with different databases in one process don't share one.
+    """
+    global _pools_pid
+    from scheduler import metrics
+
+    dsn = current_app.config["DATABASE_URL"]
+    pool = _pools.get(dsn) if _pools_pid == os.getpid() else None
+    if pool is None:
+        with _pool_lock:
+            if _pools_pid != os.getpid():
+                _pools.clear()
+                _pools_pid = os.getpid()
+            pool = _pools.get(dsn)
+            if pool is None:
+                config = current_app.config
+                pool = _pools[dsn] = ConnectionPool(
+                    dsn,
+                    minconn=config["DB_POOL_MIN_SIZE"],
+                    maxconn=config["DB_POOL_MAX_SIZE"],
+                    timeout=config["DB_POOL_TIMEOUT"],
+                    ping_after=config["DB_POOL_PING_AFTER"],
+                    cursor_factory=metrics.TimedCursor)
+                # open DB_POOL_MIN_SIZE connections now, so the first
+                # requests after a deploy don't each pay for a connect
+                pool.prefill()
+    return pool
+
+
 def get_db():
     """Connect to the application's configured database. The connection
-    is unique for each request and will be reused if this is called
-    again.
+    is checked out of the process's pool once per request and will be
+    reused if this is called again.
     """
     if "db" not in g:
-        g.db = psycopg2.connect(current_app.config['DATABASE_URL'], cursor_factory=DictCursor)
+        g.db = get_pool().getconn()
     return g.db
 
 
 def close_db(e=None):
-    """If this request connected to the database, close the
-    connection.
+    """If this request connected to the database, return the connection
+    to the pool.
     """
     db = g.pop("db", None)
 
     if db:
-        db.close()
+        get_pool().putconn(db)
+
+
+def get_migrations():
+    """List the migrations in the package's migrations directory.
+
+    :return: ``(version, name, path)`` tuples, oldest first
+    """
+    path = os.path.join(current_app.root_path, "migrations")
+    migrations = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".sql"):
+            migrations.append((name.split("_", 1)[0], name, os.path.join(path, name)))
+    return migrations
+
+
+def split_statements(script):
+    """Split a migration script into statements at lines ending in ``;``.
+
+    Only meant for ``no-transaction`` migrations, which must not contain
+    function bodies or other statements with semicolons at line ends.
+    """
+    statements = []
+    statement = []
+    for line in script.splitlines():
+        statement.append(line)
+        if line.rstrip().endswith(";"):
+            statements.append("\n".join(statement))
+            statement = []
+
+    # drop comment-only leftovers
+    return [s for s in statements
+            if any(line.strip() and not line.strip().startswith("--") for line in s.splitlines())]
+
+
+# arbitrary key for the advisory lock serializing migration runs
+MIGRATION_LOCK_ID = 0x6b6d6770
+
+
+def migrate_db(dry_run=False):
+    """Apply migrations that haven't been applied to the database yet.
+
+    Migrations run in version order, each in its own transaction unless
+    its first line is ``-- migrate: no-transaction``. Those are run one
+    statement at a time outside a transaction, as ``CREATE INDEX
+    CONCURRENTLY`` requires, and should be safe to re-run if they fail
+    part way through. Migrations are forward-only.
+
+    Uses its own connection rather than the request pool, since it
+    switches the connection into autocommit mode.
+
+    :param dry_run: only list the pending migrations
+    :return: names of the migrations applied (or pending, for a dry run)
+    """
+    conn = psycopg2.connect(current_app.config["DATABASE_URL"], cursor_factory=DictCursor)
+    conn.autocommit = True
+    applied_now = []
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS SchemaMigrations ("
+            " version TEXT PRIMARY KEY,"
+            " name TEXT NOT NULL,"
+            " applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+        cur.execute("SELECT version FROM SchemaMigrations")
+        applied = {row["version"] for row in cur.fetchall()}
+
+        for version, name, path in get_migrations():
+            if version in applied:
+                continue
+
+            applied_now.append(name)
+            if dry_run:
+                continue
+
+            with open(path, encoding="utf8") as f:
+                script = f.read()
+
+            if script.startswith("-- migrate: no-transaction"):
+                for statement in split_statements(script):
+                    cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO SchemaMigrations (version, name) VALUES (%s, %s)",
+                    (version, name))
+            else:
+                conn.autocommit = False
+                with conn:
+                    cur.execute(script)
+                    cur.execute(
+                        "INSERT INTO SchemaMigrations (version, name) VALUES (%s, %s)",
+                        (version, name))
+                conn.autocommit = True
+    finally:
+        conn.close()
+
+    return applied_now
 
 
 def init_db():
@@ -32,6 +341,11 @@ def init_db():
     with current_app.open_resource("schema.sql") as f, get_db() as db:
         cur = db.cursor()
         cur.execute(f.read().decode("utf8"))
+        # schema.sql is already the fully migrated schema
+        for version, name, _ in get_migrations():
+            cur.execute(
+                "INSERT INTO SchemaMigrations (version, name) VALUES (%s, %s)",
+                (version, name))
         db.commit()
 
 
@@ -43,9 +357,22 @@ def init_db_command():
     click.echo("Initialized the database.")
 
 
+@click.command("migrate-db")
+@click.option("--dry-run", is_flag=True, help="List pending migrations without applying them.")
+@with_appcontext
+def migrate_db_command(dry_run):
+    """Apply pending schema migrations."""
+    migrations = migrate_db(dry_run=dry_run)
+    for name in migrations:
+        click.echo(f"{'Pending' if dry_run else 'Applied'} {name}")
+    if not migrations:
+        click.echo("The database is up to date.")
+
+
 def init_app(app):
     """Register database functions with the Flask app. This is called by
     the application factory.
     """
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
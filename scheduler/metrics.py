@@ -0,0 +1,252 @@
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g
+from flask import has_request_context
+from flask import request
+from psycopg2.extras import DictCursor
+
+from scheduler.auth import skip_user_lookup
+
+slow_query_log = logging.getLogger("scheduler.slow_queries")
+
+# request latency histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# set by init_app; everything here is a no-op until then
+enabled = False
+slow_query_seconds = None
+
+
+class Registry:
+    """Counters and histograms for one process.
+
+    gunicorn workers each keep their own, so /metrics reports on the
+    worker that served it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # endpoint -> request stats
+        self.b2_calls = {}  # call name -> [count, seconds]
+
+    def observe_request(self, endpoint, seconds, queries, sql_seconds, b2_seconds):
+        with self._lock:
+            stats = self.requests.get(endpoint)
+            if not stats:
+                stats = self.requests[endpoint] = {
+                    "buckets": [0] * len(BUCKETS),
+                    "count": 0,
+                    "seconds": 0.0,
+                    "queries": 0,
+                    "sql_seconds": 0.0,
+                    "b2_seconds": 0.0,
+                }
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["queries"] += queries
+            stats["sql_seconds"] += sql_seconds
+            stats["b2_seconds"] += b2_seconds
+
+    def observe_b2_call(self, call, seconds):
+        with self._lock:
+            stats = self.b2_calls.setdefault(call, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            requests = {endpoint: dict(stats, buckets=list(stats["buckets"]))
+                        for endpoint, stats in self.requests.items()}
+            return requests, {call: list(stats) for call, stats in self.b2_calls.items()}
+
+
+registry = Registry()
+
+
+def normalize_sql(query):
+    """Collapse a query's whitespace and replace its literals with ``?``,
+    so that one query shape is logged the same way every time."""
+    if isinstance(query, bytes):
+        query = query.decode("utf8", "replace")
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"\b\d+\b", "?", query)
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def _observe_sql(query, seconds):
+    if has_request_context():
+        g.metrics_queries = g.get("metrics_queries", 0) + 1
+        g.metrics_sql_seconds = g.get("metrics_sql_seconds", 0.0) + seconds
+
+    if seconds >= slow_query_seconds:
+        slow_query_log.warning("slow query (%.3fs): %s", seconds, normalize_sql(query))
+
+
+class TimedCursor(DictCursor):
+    """A DictCursor that times every query it runs while metrics are
+    enabled.
+
+    Pooled connections outlive any one app, so they always use this
+    cursor and it checks ``enabled`` on each query, rather than the pool
+    fixing the choice when it's created.
+    """
+
+    def execute(self, query, vars=None):
+        if not enabled:
+            return super().execute(query, vars)
+
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _observe_sql(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        if not enabled:
+            return super().executemany(query, vars_list)
+
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _observe_sql(query, time.perf_counter() - start)
+
+
+@contextmanager
+def timed_b2_call(call):
+    """Time a call to the B2 API, charging it to the current request if
+    there is one."""
+    if not enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        registry.observe_b2_call(call, seconds)
+        if has_request_context():
+            g.metrics_b2_seconds = g.get("metrics_b2_seconds", 0.0) + seconds
+
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+
+
+def finish_request(e=None):
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return
+
+    registry.observe_request(
+        request.endpoint or "<unmatched>",
+        time.perf_counter() - start,
+        g.pop("metrics_queries", 0),
+        g.pop("metrics_sql_seconds", 0.0),
+        g.pop("metrics_b2_seconds", 0.0))
+
+
+def _format_labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def render_prometheus(extra=()):
+    """Render the registry in the Prometheus text exposition format.
+
+    :param extra: ``(name, type, help, {labels tuple: value})`` metrics
+        to include as well
+    """
+    requests, b2_calls = registry.snapshot()
+    lines = []
+
+    def metric(name, type_, help_):
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} {type_}")
+
+    metric("kmgp_request_duration_seconds", "histogram", "Request latency by endpoint.")
+    for endpoint, stats in sorted(requests.items()):
+        for bound, count in zip(BUCKETS, stats["buckets"]):
+            lines.append(f"kmgp_request_duration_seconds_bucket"
+                         f"{_format_labels({'endpoint': endpoint, 'le': bound})} {count}")
+        lines.append(f"kmgp_request_duration_seconds_bucket"
+                     f"{_format_labels({'endpoint': endpoint, 'le': '+Inf'})} {stats['count']}")
+        lines.append(f"kmgp_request_duration_seconds_sum{_format_labels({'endpoint': endpoint})} {stats['seconds']}")
+        lines.append(f"kmgp_request_duration_seconds_count{_format_labels({'endpoint': endpoint})} {stats['count']}")
+
+    for name, key, help_ in (
+            ("kmgp_request_queries_total", "queries", "SQL queries run by endpoint."),
+            ("kmgp_request_sql_seconds_total", "sql_seconds", "Time spent in SQL by endpoint."),
+            ("kmgp_request_b2_seconds_total", "b2_seconds", "Time spent calling B2 by endpoint.")):
+        metric(name, "counter", help_)
+        for endpoint, stats in sorted(requests.items()):
+            lines.append(f"{name}{_format_labels({'endpoint': endpoint})} {stats[key]}")
+
+    metric("kmgp_b2_calls_total", "counter", "B2 API calls, including background ones.")
+    for call, (count, _) in sorted(b2_calls.items()):
+        lines.append(f"kmgp_b2_calls_total{_format_labels({'call': call})} {count}")
+    metric("kmgp_b2_call_seconds_total", "counter", "Time spent in B2 API calls.")
+    for call, (_, seconds) in sorted(b2_calls.items()):
+        lines.append(f"kmgp_b2_call_seconds_total{_format_labels({'call': call})} {seconds}")
+
+    for name, type_, help_, values in extra:
+        metric(name, type_, help_)
+        for labels, value in values.items():
+            lines.append(f"{name}{_format_labels(dict(labels)) if labels else ''} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+@skip_user_lookup
+def metrics_view():
+    """Serve this process's metrics to Prometheus."""
+    from scheduler.cache import get_cache
+    from scheduler.db import get_pool
+
+    pool = get_pool().stats()
+    cache = get_cache().stats()
+    extra = [
+        ("kmgp_db_pool_checkouts_total", "counter", "Connections checked out of the pool.",
+         {(): pool["checkouts"]}),
+        ("kmgp_db_pool_waits_total", "counter", "Checkouts that had to wait for a connection.",
+         {(): pool["waits"]}),
+        ("kmgp_db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.",
+         {(): pool["wait_seconds"]}),
+        ("kmgp_db_pool_exhausted_total", "counter", "Checkouts that timed out with the pool empty.",
+         {(): pool["exhausted"]}),
+        ("kmgp_db_pool_connects_total", "counter", "Database connections opened.",
+         {(): pool["connects"]}),
+        ("kmgp_db_pool_idle", "gauge", "Idle pooled connections.",
+         {(): pool["idle"]}),
+        ("kmgp_cache_requests_total", "counter", "Response cache lookups.",
+         {(("result", "hit"),): cache["hits"], (("result", "miss"),): cache["misses"]}),
+        ("kmgp_cache_invalidations_total", "counter", "Response cache tags invalidated.",
+         {(): cache["invalidations"]}),
+    ]
+    return render_prometheus(extra), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+def init_app(app):
+    """Turn on instrumentation if ``METRICS_ENABLED`` is set. This is
+    called by the application factory.
+
+    When it's off, no hooks or routes are installed and cursors skip
+    their timing, so requests pay next to nothing for it.
+    """
+    global enabled, slow_query_seconds
+
+    enabled = app.config["METRICS_ENABLED"]
+    slow_query_seconds = app.config["SLOW_QUERY_SECONDS"]
+    if not enabled:
+        return
+
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
+    app.add_url_rule("/metrics", endpoint="metrics", view_func=metrics_view)
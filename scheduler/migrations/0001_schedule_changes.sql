@@ -0,0 +1,10 @@
+-- Change log behind the /schedule feed's ETags and cursors.
+
+CREATE TABLE IF NOT EXISTS ScheduleChanges (
+  id BIGSERIAL PRIMARY KEY,
+  operation TEXT NOT NULL,
+  show_id INTEGER NOT NULL,
+  episode_id INTEGER,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (show_id) REFERENCES Shows (id)
+);
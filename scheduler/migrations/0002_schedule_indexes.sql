@@ -0,0 +1,11 @@
+-- migrate: no-transaction
+-- Indexes for the dashboard, schedule feed and show owner lookups.
+-- Built concurrently so writes to a live database aren't blocked. A
+-- concurrent build that fails leaves an INVALID index behind, which
+-- IF NOT EXISTS would then skip; drop it before re-running.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_episodes_show_id_air_date ON Episodes (show_id, air_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_usershowsjoin_user_id ON UserShowsJoin (user_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_usershowsjoin_show_id ON UserShowsJoin (show_id);
@@ -0,0 +1,11 @@
+-- Timeslots held for an episode while its audio uploads.
+
+CREATE TABLE IF NOT EXISTS EpisodeReservations (
+  token TEXT PRIMARY KEY,
+  show_id INTEGER NOT NULL,
+  air_date TIMESTAMP WITH TIME ZONE UNIQUE NOT NULL,
+  created_by INTEGER NOT NULL,
+  expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  FOREIGN KEY (show_id) REFERENCES Shows (id),
+  FOREIGN KEY (created_by) REFERENCES Users (id)
+);
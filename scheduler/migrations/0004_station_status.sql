@@ -0,0 +1,43 @@
+-- Status reports from the station puller.
+
+-- Runs of the station puller, as it reported them. ids come from the
+-- puller so a report it resends after a lost response is only stored once
+CREATE TABLE IF NOT EXISTS StationRuns (
+  id TEXT PRIMARY KEY,
+  started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  finished_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  downloaded INTEGER NOT NULL,
+  failed INTEGER NOT NULL,
+  received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_stationruns_received_at ON StationRuns (received_at);
+
+-- Every episode download the puller attempted. Episodes can be deleted
+-- after they were downloaded, so episode_id is not a foreign key
+CREATE TABLE IF NOT EXISTS DownloadReports (
+  id BIGSERIAL PRIMARY KEY,
+  run_id TEXT NOT NULL,
+  show_id INTEGER NOT NULL,
+  episode_id INTEGER NOT NULL,
+  file_id TEXT NOT NULL,
+  status TEXT NOT NULL,
+  bytes BIGINT,
+  seconds REAL,
+  sha1 TEXT,
+  error TEXT,
+  FOREIGN KEY (run_id) REFERENCES StationRuns (id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_downloadreports_episode_id ON DownloadReports (episode_id, id);
+
+-- The episode in each show's playout file at the station
+CREATE TABLE IF NOT EXISTS StationPlacements (
+  show_id INTEGER PRIMARY KEY,
+  episode_id INTEGER NOT NULL,
+  file_id TEXT NOT NULL,
+  placed_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  run_id TEXT NOT NULL,
+  FOREIGN KEY (show_id) REFERENCES Shows (id),
+  FOREIGN KEY (run_id) REFERENCES StationRuns (id)
+);
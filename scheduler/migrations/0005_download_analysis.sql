@@ -0,0 +1,3 @@
+-- The puller's audio analysis of each downloaded file.
+
+ALTER TABLE DownloadReports ADD COLUMN IF NOT EXISTS analysis JSONB;
@@ -0,0 +1,10 @@
+-- Audio already stored in B2, by the SHA-1 of its contents.
+
+CREATE TABLE IF NOT EXISTS AudioFiles (
+  sha1 TEXT PRIMARY KEY,
+  file_id TEXT NOT NULL,
+  size BIGINT NOT NULL,
+  uploaded_by INTEGER NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (uploaded_by) REFERENCES Users (id)
+);
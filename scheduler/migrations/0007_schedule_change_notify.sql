@@ -0,0 +1,13 @@
+-- Announce committed schedule changes to the web processes streaming
+-- them to the station.
+
+CREATE OR REPLACE FUNCTION notify_schedule_change() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('schedule_changes', '');
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS schedule_changes_notify ON ScheduleChanges;
+CREATE TRIGGER schedule_changes_notify AFTER INSERT ON ScheduleChanges
+  FOR EACH STATEMENT EXECUTE FUNCTION notify_schedule_change();
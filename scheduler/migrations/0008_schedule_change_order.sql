@@ -0,0 +1,14 @@
+-- Give ScheduleChanges ids in commit order, by having its writers take
+-- turns from before their ids are drawn until they commit.
+
+CREATE OR REPLACE FUNCTION serialize_schedule_changes() RETURNS trigger AS $$
+BEGIN
+  -- arbitrary key, held until the transaction ends
+  PERFORM pg_advisory_xact_lock(1802332017);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS schedule_changes_serialize ON ScheduleChanges;
+CREATE TRIGGER schedule_changes_serialize BEFORE INSERT ON ScheduleChanges
+  FOR EACH STATEMENT EXECUTE FUNCTION serialize_schedule_changes();
@@ -0,0 +1,10 @@
+-- B2 large files a DJ started uploading for a show.
+
+CREATE TABLE IF NOT EXISTS LargeFileUploads (
+  file_id TEXT PRIMARY KEY,
+  show_id INTEGER NOT NULL,
+  created_by INTEGER NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (show_id) REFERENCES Shows (id),
+  FOREIGN KEY (created_by) REFERENCES Users (id)
+);
@@ -0,0 +1,6 @@
+-- migrate: no-transaction
+-- Look up audio by B2 file id, for the SHA-1s in the schedule feed.
+-- Built concurrently; drop an INVALID index left by a failed build before
+-- re-running.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_audiofiles_file_id ON AudioFiles (file_id);
@@ -1,62 +1,215 @@
+import os
+import queue
+import re
+import secrets
+import threading
 from datetime import datetime, date, time, timedelta, timezone
 from zoneinfo import ZoneInfo
 
 from flask import Blueprint
 from flask import current_app
 from flask import g
+from flask import jsonify
 from flask import render_template
 from flask import redirect
 from flask import request
+from flask import stream_with_context
 from flask import url_for
+from markupsafe import Markup
 from werkzeug.exceptions import abort
 
-from b2sdk.v2 import InMemoryAccountInfo
-from b2sdk.session import B2Session
-
 from scheduler.auth import login_required
+from scheduler.auth import skip_user_lookup
+from scheduler.cache import SHOWS_TAG
+from scheduler.cache import get_cache
+from scheduler.cache import show_tag
+from scheduler.cache import user_tag
+from scheduler.changes import stream_changes
 from scheduler.db import get_db
+from scheduler.storage import get_upload_cache
 
 import psycopg2  # for psycopg2.Error
 from psycopg2 import sql
+from psycopg2.extras import Json
+from psycopg2.extras import execute_values
 
 bp = Blueprint("scheduler", __name__)
 
 
-@bp.route("/")
-@login_required
-def index():
-    """Show all the shows and episodes, most recent first."""
-    # TODO don't get old ones
+def parse_show_cursor(cursor):
+    """Split an index page cursor into its (created_at, id) keyset.
+
+    :param cursor: the ``after`` query arg, as made by :func:`make_show_cursor`
+    :return: a ``(created_at, id)`` tuple, or ``None`` for the first page
+    :raise 400: if the cursor is malformed
+    """
+    if not cursor:
+        return None
+
+    try:
+        created_at, show_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(created_at), int(show_id)
+    except ValueError:
+        abort(400, f"Invalid page cursor {cursor!r}.")
+
+
+def make_show_cursor(show):
+    """Build the cursor for the page of shows following ``show``."""
+    return f"{show['created_at'].isoformat()}_{show['id']}"
+
+
+def get_user_shows_page(user_id, after=None, page_size=20, episode_limit=10):
+    """Get a page of a user's shows along with their upcoming episodes.
+
+    Shows are keyset paginated newest first on ``(created_at, id)``, and
+    each show's episodes come from a LATERAL join capped at
+    ``episode_limit``, so a page always costs a single query no matter
+    how many shows or episodes the user has. The station's sync state
+    comes along in the same query: the episode placed for playout for
+    each show, and its latest download report for each episode.
+
+    :param user_id: id of the DJ whose shows to get
+    :param after: ``(created_at, id)`` of the last show on the previous page
+    :param page_size: maximum number of shows to return
+    :param episode_limit: maximum number of upcoming episodes per show
+    :return: ``(shows, episodes, next_cursor)`` where ``episodes`` maps
+        show id to that show's upcoming episodes, soonest first
+    """
+    keyset = ""
+    if after:
+        keyset = " AND (s.created_at, s.id) < (%(after_created_at)s, %(after_id)s)"
+
     db = get_db()
     cur = db.cursor()
     cur.execute(
         "SELECT s.id, s.title, s.start_time, s.day_of_week, s.description, s.created_at, s.updated_at,"
-        " creator.name AS creator, updater.name as updater"
-        " FROM Shows s"
-        " JOIN UserShowsJoin j ON j.show_id = s.id"
+        " creator.name AS creator, updater.name AS updater,"
+        " sp.episode_id AS placed_episode_id, sp.placed_at,"
+        " e.id AS episode_id, e.title AS episode_title, e.air_date,"
+        " e.description AS episode_description, e.original_filename,"
+        " e.created_at AS episode_created_at, e.updated_at AS episode_updated_at,"
+        " e.creator AS episode_creator, e.updater AS episode_updater, e.upcoming_count,"
+        " e.sync_status, e.sync_error"
+        " FROM ("
+        "   SELECT s.*"
+        "   FROM Shows s"
+        "   JOIN UserShowsJoin j ON j.show_id = s.id"
+        "   WHERE j.user_id = %(user_id)s" + keyset +
+        "   ORDER BY s.created_at DESC, s.id DESC"
+        "   LIMIT %(show_limit)s"
+        " ) s"
         " JOIN Users creator ON s.created_by = creator.id"
         " JOIN Users updater ON s.updated_by = updater.id"
-        " WHERE j.user_id = %s"
-        " ORDER BY s.created_at DESC",
-        (g.user["id"],))
-    shows = cur.fetchall()
-
+        " LEFT JOIN StationPlacements sp ON sp.show_id = s.id"
+        " LEFT JOIN LATERAL ("
+        "   SELECT e.id, e.title, e.air_date, e.description, e.original_filename, e.created_at, e.updated_at,"
+        "   ep_creator.name AS creator, ep_updater.name AS updater,"
+        "   count(*) OVER () AS upcoming_count,"
+        "   dr.status AS sync_status, dr.error AS sync_error"
+        "   FROM Episodes e"
+        "   JOIN Users ep_creator ON e.created_by = ep_creator.id"
+        "   JOIN Users ep_updater ON e.updated_by = ep_updater.id"
+        # the station's latest attempt at downloading the episode
+        "   LEFT JOIN LATERAL ("
+        "     SELECT dr.status, dr.error FROM DownloadReports dr"
+        "     WHERE dr.episode_id = e.id"
+        "     ORDER BY dr.id DESC"
+        "     LIMIT 1"
+        "   ) dr ON true"
+        "   WHERE e.show_id = s.id"
+        "   AND e.air_date >= CURRENT_TIMESTAMP"
+        "   ORDER BY e.air_date ASC"
+        "   LIMIT %(episode_limit)s"
+        " ) e ON true"
+        " ORDER BY s.created_at DESC, s.id DESC, e.air_date ASC",
+        {
+            "user_id": user_id,
+            "after_created_at": after[0] if after else None,
+            "after_id": after[1] if after else None,
+            # fetch one extra show to find out if there's another page
+            "show_limit": page_size + 1,
+            "episode_limit": episode_limit,
+        })
+
+    shows = []
     episodes = {}
-    for show in shows:
-        cur.execute(
-            "SELECT e.id, e.title, e.air_date, e.description, e.original_filename, e.created_at, e.updated_at,"
-            " creator.name as creator, updater.name as updater"
-            " FROM Episodes e"
-            " JOIN Users creator ON e.created_by = creator.id"
-            " JOIN Users updater ON e.updated_by = updater.id"
-            " WHERE e.show_id = %s"
-            " AND e.air_date >= CURRENT_TIMESTAMP"
-            " ORDER BY air_date ASC",
-            (show["id"],),
-        )
-        episodes[show["id"]] = cur.fetchall()
+    for row in cur.fetchall():
+        if row["id"] not in episodes:
+            shows.append({
+                "id": row["id"],
+                "title": row["title"],
+                "start_time": row["start_time"],
+                "day_of_week": row["day_of_week"],
+                "description": row["description"],
+                "created_at": row["created_at"],
+                "updated_at": row["updated_at"],
+                "creator": row["creator"],
+                "updater": row["updater"],
+                "upcoming_count": row["upcoming_count"] or 0,
+                "next_episode": None,
+                "placed_episode_id": row["placed_episode_id"],
+                "placed_at": row["placed_at"],
+            })
+            episodes[row["id"]] = []
+
+        if row["episode_id"] is None:
+            continue
+
+        episode = {
+            "id": row["episode_id"],
+            "title": row["episode_title"],
+            "air_date": row["air_date"],
+            "description": row["episode_description"],
+            "original_filename": row["original_filename"],
+            "created_at": row["episode_created_at"],
+            "updated_at": row["episode_updated_at"],
+            "creator": row["episode_creator"],
+            "updater": row["episode_updater"],
+            "sync_status": row["sync_status"],
+            "sync_error": row["sync_error"],
+        }
+        if not episodes[row["id"]]:
+            shows[-1]["next_episode"] = episode
+        episodes[row["id"]].append(episode)
+
+    next_cursor = None
+    if len(shows) > page_size:
+        del episodes[shows.pop()["id"]]
+        next_cursor = make_show_cursor(shows[-1])
+
+    return shows, episodes, next_cursor
 
-    return render_template("scheduler/index.html", shows=shows, episodes=episodes)
+
+@bp.route("/")
+@login_required
+def index():
+    """Show a page of the user's shows and their upcoming episodes, most
+    recently created shows first."""
+    after = request.args.get("after")
+    user_id = g.user["id"]
+
+    def render_show_list():
+        shows, episodes, next_cursor = get_user_shows_page(
+            user_id,
+            after=parse_show_cursor(after),
+            page_size=current_app.config["INDEX_SHOWS_PER_PAGE"],
+            episode_limit=current_app.config["INDEX_EPISODES_PER_SHOW"])
+        return render_template("scheduler/show_list.html", shows=shows, episodes=episodes, next_cursor=next_cursor)
+
+    def show_tags():
+        # every show the user has, not just those on the page, as the
+        # tags have to be known before the page is read
+        cur = get_db().cursor()
+        cur.execute("SELECT show_id FROM UserShowsJoin WHERE user_id = %s", (user_id,))
+        return [show_tag(row["show_id"]) for row in cur.fetchall()]
+
+    # episodes drop off the page as they air, which no write marks, so
+    # keep this fragment for a short time only
+    show_list = get_cache().get_or_compute(
+        f"index:{user_id}:{after}", render_show_list, tags=[user_tag(user_id)], more_tags=show_tags,
+        timeout=current_app.config["INDEX_CACHE_TIMEOUT"])
+
+    return render_template("scheduler/index.html", show_list=Markup(show_list))
 
 
 def get_all_djs():
@@ -144,45 +297,330 @@ def get_episode(id):
 
 
 @bp.route("/shows")
+@skip_user_lookup
 def get_shows():
-    db = get_db()
-    cur = db.cursor()
+    def query_shows():
+        db = get_db()
+        cur = db.cursor()
 
-    cur.execute(
-        "SELECT id, title, file_path FROM Shows"
-    )
-    cols = [desc[0] for desc in cur.description]
-    vals = cur.fetchall()
-    ret = []
-    for val in vals:
-        ret.append({c: v for c, v in zip(cols, val)})
+        cur.execute(
+            "SELECT id, title, file_path FROM Shows"
+        )
+        cols = [desc[0] for desc in cur.description]
+        vals = cur.fetchall()
+        ret = []
+        for val in vals:
+            ret.append({c: v for c, v in zip(cols, val)})
+
+        return {"shows": ret}
 
-    return {"shows": ret}
+    return get_cache().get_or_compute("shows", query_shows, tags=[SHOWS_TAG])
 
 
 @bp.route("/episodes")
+@skip_user_lookup
 def get_upcoming_episodes():
-    show_id = request.args.get("show_id")
+    show_id = request.args.get("show_id", type=int)
+    if show_id is None:
+        return ({"error": "show_id must be an integer"}, 400)
+
+    def query_episodes():
+        db = get_db()
+        cur = db.cursor()
+
+        cur.execute(
+            "SELECT id, title, air_date, file_id"
+            " FROM Episodes"
+            " WHERE show_id = %s"
+            " AND air_date > CURRENT_TIMESTAMP",
+            (show_id,)
+        )
+
+        cols = [desc[0] for desc in cur.description]
+        vals = cur.fetchall()
+        ret = []
+        for val in vals:
+            ep = {c: v for c, v in zip(cols, val)}
+            ep["air_date"] = int(ep["air_date"].replace(tzinfo=timezone.utc).timestamp())
+            ret.append(ep)
+
+        return {"show_id": show_id, "episodes": ret}
+
+    return get_cache().get_or_compute(f"episodes:{show_id}", query_episodes, tags=[show_tag(show_id)],
+                                      timeout=current_app.config["INDEX_CACHE_TIMEOUT"])
+
+
+def record_schedule_change(cur, operation, show_id, episode_id=None):
+    """Add an entry to the schedule change log.
+
+    Must be called with the cursor of the write it describes, so the
+    change is committed (or rolled back) along with it. Other writers of
+    the change log wait from here until this transaction ends, which
+    keeps change ids in commit order, so call it after the rest of the
+    write's work rather than before.
+
+    :param cur: cursor of the transaction making the change
+    :param operation: what changed, e.g. ``"create_episode"``
+    :param show_id: id of the show that changed
+    :param episode_id: id of the episode that changed, if any
+    """
+    cur.execute(
+        "INSERT INTO ScheduleChanges (operation, show_id, episode_id)"
+        " VALUES (%s, %s, %s)",
+        (operation, show_id, episode_id))
+
+
+def get_schedule_version():
+    """Get the current schedule cursor and ETag.
+
+    The cursor is the newest change log id. Change ids are handed out
+    in commit order (see schema.sql), so no change with a lower id can
+    commit after a poller has seen this one. The ETag also includes the
+    count of upcoming episodes, since the feed changes when an episode
+    airs even though nothing was written. Both come from indexes, so
+    this is cheap enough to run on every poll.
+
+    :return: ``(cursor, etag)``
+    """
     db = get_db()
     cur = db.cursor()
+    cur.execute(
+        "SELECT (SELECT COALESCE(max(id), 0) FROM ScheduleChanges) AS cursor,"
+        " (SELECT count(*) FROM Episodes WHERE air_date > CURRENT_TIMESTAMP) AS upcoming")
+    version = cur.fetchone()
+
+    return version["cursor"], f"{version['cursor']}-{version['upcoming']}"
+
+
+def get_next_air_date(show, now):
+    """Get the next time a show's weekly timeslot starts.
+
+    :param show: the show, with its ``day_of_week`` and ``start_time``
+    :param now: time to look from, in the station's time zone
+    :return: the slot's start, no earlier than now
+    """
+    days_offset = (WEEKDAY_TO_ISOWEEKDAY[show["day_of_week"]] - now.isoweekday()) % 7
+    air_date = datetime.combine(now.date() + timedelta(days=days_offset), show["start_time"], tzinfo=now.tzinfo)
+    if air_date < now:
+        air_date = datetime.combine(air_date.date() + timedelta(days=7), show["start_time"], tzinfo=now.tzinfo)
+    return air_date
+
+
+def get_schedule_shows(show_ids=None):
+    """Get shows with their upcoming episodes, soonest first, in one query.
+
+    Episodes carry the SHA-1 of their audio when it's in AudioFiles, so
+    the puller can check downloads B2 gives no SHA-1 for.
+
+    :param show_ids: only get these shows, or all shows if ``None``
+    :return: list of show dicts, each with an ``episodes`` list
+    """
+    where = ""
+    if show_ids is not None:
+        if not show_ids:
+            return []
+        where = " WHERE s.id = ANY(%(show_ids)s)"
 
+    db = get_db()
+    cur = db.cursor()
     cur.execute(
-        "SELECT id, title, air_date, file_id"
-        " FROM Episodes"
-        " WHERE show_id = %s"
-        " AND air_date > CURRENT_TIMESTAMP",
-        (show_id,)
-    )
+        "SELECT s.id, s.title, s.file_path, s.day_of_week, s.start_time,"
+        " e.id AS episode_id, e.title AS episode_title, e.air_date, e.file_id, a.sha1"
+        " FROM Shows s"
+        " LEFT JOIN Episodes e ON e.show_id = s.id AND e.air_date > CURRENT_TIMESTAMP"
+        " LEFT JOIN AudioFiles a ON a.file_id = e.file_id" + where +
+        " ORDER BY s.id, e.air_date",
+        {"show_ids": list(show_ids or ())})
+
+    now = datetime.now(tz=ZoneInfo("America/Los_Angeles"))
+    shows = []
+    for row in cur.fetchall():
+        if not shows or shows[-1]["id"] != row["id"]:
+            shows.append({
+                "id": row["id"],
+                "title": row["title"],
+                "file_path": row["file_path"],
+                # when the show's timeslot next comes around, episode or not
+                "next_air_date": int(get_next_air_date(row, now).timestamp()),
+                "episodes": [],
+            })
+
+        if row["episode_id"] is not None:
+            shows[-1]["episodes"].append({
+                "id": row["episode_id"],
+                "title": row["episode_title"],
+                "air_date": int(row["air_date"].replace(tzinfo=timezone.utc).timestamp()),
+                "file_id": row["file_id"],
+                # the audio's SHA-1 once B2 has vouched for it, else None
+                "sha1": row["sha1"],
+            })
+
+    return shows
+
+
+@bp.route("/schedule")
+@skip_user_lookup
+def get_schedule():
+    """Every show with its upcoming episodes, for the station puller.
+
+    Responses carry a strong ETag, so a poller sending If-None-Match gets
+    a 304 without the feed being queried. Passing ``since=<cursor>`` from
+    a previous response returns only the shows changed after that
+    cursor, each with its complete list of upcoming episodes, for the
+    client to replace its copies with.
+    """
+    since = request.args.get("since", type=int)
+    cursor, etag = get_schedule_version()
+
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    # the version is read before the feed, so a write landing in between
+    # only means the next poll refetches data the client already has
+    full = since is None or since > cursor
+    if full:
+        # the ETag changes with every write and every airing, so the full
+        # feed can be cached under it without any invalidation
+        shows = get_cache().get_or_compute(f"schedule:{etag}", get_schedule_shows)
+    else:
+        db = get_db()
+        cur = db.cursor()
+        cur.execute(
+            "SELECT DISTINCT show_id FROM ScheduleChanges WHERE id > %s AND id <= %s",
+            (since, cursor))
+        shows = get_schedule_shows([row["show_id"] for row in cur.fetchall()])
+
+    response = jsonify({"cursor": cursor, "full": full, "shows": shows})
+    response.set_etag(etag)
+    return response
+
+
+@bp.route("/schedule/changes")
+@skip_user_lookup
+def stream_schedule_changes():
+    """Stream schedule changes to the station puller as server-sent
+    events, as they're committed.
+
+    Each event's data is the change log entry, ``{id, operation,
+    show_id, episode_id}``, and its id is the entry's id. The stream
+    starts after the change given by the ``Last-Event-ID`` header or the
+    ``after`` query arg, so a reconnecting client catches up on what it
+    missed, or with only new changes if neither is given. Streams end
+    after ``SCHEDULE_STREAM_SECONDS``; clients reconnect to carry on.
+    """
+    after = request.headers.get("Last-Event-ID", request.args.get("after"))
+    try:
+        after = int(after) if after else None
+    except ValueError:
+        return ({"error": "invalid change id"}, 400)
 
-    cols = [desc[0] for desc in cur.description]
-    vals = cur.fetchall()
-    ret = []
-    for val in vals:
-        ep = {c: v for c, v in zip(cols, val)}
-        ep["air_date"] = int(ep["air_date"].replace(tzinfo=timezone.utc).timestamp())
-        ret.append(ep)
+    config = current_app.config
+    events = stream_changes(after, config["SCHEDULE_STREAM_SECONDS"], config["SCHEDULE_STREAM_HEARTBEAT"])
+    return current_app.response_class(stream_with_context(events), mimetype="text/event-stream",
+                                      headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-    return {"show_id": show_id, "episodes": ret}
+
+# what the station puller can report about an episode download
+DOWNLOAD_STATUSES = ("downloaded", "failed", "rejected")
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_valid_status_report(run, downloads, placements):
+    """Check the types of a station status report's fields, so a bad
+    report gets a 400 rather than failing in the database."""
+    return (isinstance(run[0], str) and is_number(run[1]) and is_number(run[2])
+            and all(is_int(d[0]) and is_int(d[1]) and isinstance(d[2], str)
+                    and all(v is None or is_number(v) for v in d[4:6]) for d in downloads)
+            and all(is_int(p[0]) and is_int(p[1]) and isinstance(p[2], str) and is_number(p[3])
+                    for p in placements))
+
+
+@bp.route("/station/status", methods=("POST",))
+@skip_user_lookup
+def ingest_station_status():
+    """Store the status report from one run of the station puller.
+
+    The report is a JSON object with the run's ``id``, ``started_at`` and
+    ``finished_at`` (epoch seconds), a ``downloads`` list of
+    ``{show_id, episode_id, file_id, status, bytes, seconds, sha1,
+    error, analysis}`` and a ``placements`` list of ``{show_id, episode_id,
+    file_id, placed_at}``, one per show. Requests must carry
+    ``STATION_TOKEN`` as a bearer token.
+
+    Reports are stored with one bulk insert per table, and a report
+    whose run was already stored is accepted without storing it again,
+    so the puller can safely resend reports it isn't sure arrived.
+    """
+    token = current_app.config["STATION_TOKEN"]
+    if not token or not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return {"error": "invalid station token"}, 401
+
+    report = request.get_json(silent=True)
+    try:
+        downloads = [(
+            d["show_id"], d["episode_id"], d["file_id"], d["status"],
+            d.get("bytes"), d.get("seconds"), d.get("sha1"), d.get("error"),
+            Json(d["analysis"]) if d.get("analysis") is not None else None,
+        ) for d in report["downloads"]]
+        placements = [(p["show_id"], p["episode_id"], p["file_id"], p["placed_at"]) for p in report["placements"]]
+        run = (report["id"], report["started_at"], report["finished_at"])
+    except (TypeError, KeyError):
+        return {"error": "malformed status report"}, 400
+
+    if not is_valid_status_report(run, downloads, placements):
+        return {"error": "malformed status report"}, 400
+    if any(d[3] not in DOWNLOAD_STATUSES for d in downloads):
+        return {"error": f"download status must be one of {', '.join(DOWNLOAD_STATUSES)}"}, 400
+
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO StationRuns (id, started_at, finished_at, downloaded, failed)"
+            " VALUES (%s, to_timestamp(%s), to_timestamp(%s), %s, %s)"
+            " ON CONFLICT (id) DO NOTHING"
+            " RETURNING id",
+            run + (sum(d[3] == "downloaded" for d in downloads), sum(d[3] != "downloaded" for d in downloads)))
+        if cur.fetchone() is None:
+            db.rollback()
+            return {"status": "duplicate"}
+
+        execute_values(
+            cur,
+            "INSERT INTO DownloadReports"
+            " (run_id, show_id, episode_id, file_id, status, bytes, seconds, sha1, error, analysis) VALUES %s",
+            [(run[0],) + d for d in downloads])
+        execute_values(
+            cur,
+            "INSERT INTO StationPlacements (run_id, show_id, episode_id, file_id, placed_at)"
+            " SELECT v.run_id, v.show_id, v.episode_id, v.file_id, to_timestamp(v.placed_at)"
+            " FROM (VALUES %s) v (run_id, show_id, episode_id, file_id, placed_at)"
+            " JOIN Shows s ON s.id = v.show_id"
+            " ON CONFLICT (show_id) DO UPDATE SET"
+            " episode_id = EXCLUDED.episode_id, file_id = EXCLUDED.file_id,"
+            " placed_at = EXCLUDED.placed_at, run_id = EXCLUDED.run_id"
+            " WHERE StationPlacements.placed_at <= EXCLUDED.placed_at",
+            [(run[0],) + p for p in placements])
+    except (psycopg2.DataError, psycopg2.IntegrityError):
+        # out of range values, or ids that don't fit the schema
+        db.rollback()
+        return {"error": "malformed status report"}, 400
+    db.commit()
+
+    show_ids = {d[0] for d in downloads} | {p[0] for p in placements}
+    if show_ids:
+        get_cache().invalidate(*[show_tag(show_id) for show_id in show_ids])
+
+    return {"status": "stored"}
 
 
 @bp.route("/shows/create", methods=("GET", "POST"))
@@ -239,6 +677,7 @@ def create_show():
                         "show_id": show_id
                     })
 
+            record_schedule_change(cur, "create_show", show_id)
             db.commit()
         except psycopg2.errors.UniqueViolation as e:
             if e.diag.constraint_name == "uidx_show_timeslot":
@@ -246,6 +685,7 @@ def create_show():
         except psycopg2.Error as e:
             return ({"error": e.diag.message_detail}, 400)
 
+        get_cache().invalidate(SHOWS_TAG, *(user_tag(user) for user in post["djs"]))
         return {"redirect": url_for("scheduler.index")}
 
     # GET request
@@ -253,6 +693,218 @@ def create_show():
     return render_template("scheduler/create_show.html", djs=djs)
 
 
+WEEKDAY_TO_ISOWEEKDAY = {
+    "Monday": 1,
+    "Tuesday": 2,
+    "Wednesday": 3,
+    "Thursday": 4,
+    "Friday": 5,
+    "Saturday": 6,
+    "Sunday": 7
+}
+
+
+def get_air_date(show, air_date, allow_past=False):
+    """Get the air time of a show's episode on a given date, checking it
+    fits the show's schedule.
+
+    :param show: the show
+    :param air_date: date of the episode
+    :param allow_past: accept dates that have aired, for archives
+    :return: ``(air time, error)``, where error is a message for the DJ
+        if the date can't be used
+    """
+    # validate that air date matches show schedule
+    if WEEKDAY_TO_ISOWEEKDAY[show["day_of_week"]] != air_date.isoweekday():
+        return None, "air date does not match schedule"
+    air_date = datetime.combine(air_date,
+                                show["start_time"],
+                                tzinfo=ZoneInfo("America/Los_Angeles"))
+
+    # allow uploads up to one hour before air
+    if not allow_past and air_date < datetime.now(tz=ZoneInfo("America/Los_Angeles")) + timedelta(hours=1):
+        return None, "air date is in the past"
+
+    return air_date, None
+
+
+def is_sha1(value):
+    """Check that a value is a hex SHA-1, as the upload page sends them."""
+    return isinstance(value, str) and re.fullmatch(r"[0-9a-f]{40}", value) is not None
+
+
+def get_audio_file(cur, sha1, size):
+    """Get the B2 file id of audio already uploaded with this SHA-1 and
+    size, or ``None``."""
+    cur.execute("SELECT file_id FROM AudioFiles WHERE sha1 = %s AND size = %s", (sha1, size))
+    row = cur.fetchone()
+    return row["file_id"] if row else None
+
+
+def verify_audio_file(file_id, sha1, size, user_id):
+    """Check with B2 that a file the user uploaded holds the audio they
+    say it does, before it's offered to anyone uploading the same audio.
+
+    B2 checked the SHA-1 of files uploaded whole; large files only carry
+    the ``large_file_sha1`` their uploader gave, which is taken on trust
+    from the DJ named in ``uploader-uid``.
+
+    :return: whether B2's record of the file matches
+    """
+    try:
+        info = get_upload_cache().get_file_info(file_id)
+    except Exception:
+        current_app.logger.exception("unable to get B2 file info for %s", file_id)
+        return False
+
+    file_info = info.get("fileInfo") or {}
+    content_sha1 = info.get("contentSha1", "").removeprefix("unverified:")
+    return (info.get("contentLength") == size
+            and sha1 in (content_sha1, file_info.get("large_file_sha1"))
+            and file_info.get("uploader-uid") == str(user_id))
+
+
+def record_audio_file(cur, sha1, file_id, size, user_id):
+    """Add uploaded audio to AudioFiles, unless the same audio is already
+    there."""
+    cur.execute(
+        "INSERT INTO AudioFiles (sha1, file_id, size, uploaded_by) VALUES (%s, %s, %s, %s)"
+        " ON CONFLICT (sha1) DO NOTHING",
+        (sha1, file_id, size, user_id))
+
+
+class AudioFileVerifier:
+    """Checks audio new to AudioFiles with B2 in a thread of its own, and
+    records it once B2 vouches for it, so creating an episode never waits
+    on B2.
+
+    Audio still waiting when the process exits is never recorded; later
+    uploads of it are only sent again in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="audio-file-verifier", daemon=True)
+        self._thread.start()
+
+    def submit(self, file_id, sha1, size, user_id):
+        """Queue an uploaded file to be checked and recorded."""
+        self._queue.put((file_id, sha1, size, user_id))
+
+    def join(self):
+        """Wait until every file queued so far has been handled."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            file_id, sha1, size, user_id = self._queue.get()
+            try:
+                with self.app.app_context():
+                    db = get_db()
+                    cur = db.cursor()
+                    if get_audio_file(cur, sha1, size) is None and verify_audio_file(file_id, sha1, size, user_id):
+                        record_audio_file(cur, sha1, file_id, size, user_id)
+                    db.commit()
+            except Exception:
+                self.app.logger.exception("unable to record audio file %s", sha1)
+            finally:
+                self._queue.task_done()
+
+
+_verifier_lock = threading.Lock()
+
+
+def get_audio_file_verifier():
+    """Get this process's :class:`AudioFileVerifier` for the app,
+    starting it on first use."""
+    extensions = current_app.extensions
+    verifier = extensions.get("audio_file_verifier")
+    if verifier is None or verifier.pid != os.getpid():
+        with _verifier_lock:
+            verifier = extensions.get("audio_file_verifier")
+            if verifier is None or verifier.pid != os.getpid():
+                verifier = extensions["audio_file_verifier"] = AudioFileVerifier(current_app._get_current_object())
+    return verifier
+
+
+@bp.route("/audio_files/<sha1>")
+@login_required
+def find_audio_file(sha1):
+    """Look up audio already uploaded to B2 by its SHA-1 and size, so the
+    upload page can skip sending it again."""
+    size = request.args.get("size", type=int)
+    if not is_sha1(sha1) or size is None:
+        return ({"error": "a hex sha1 and size are required"}, 400)
+
+    db = get_db()
+    cur = db.cursor()
+    file_id = get_audio_file(cur, sha1, size)
+    db.rollback()
+    if not file_id:
+        return ({"error": "no audio file with this sha1"}, 404)
+    return {"file_id": file_id}
+
+
+@bp.route("/shows/<int:id>/reserve_episode", methods=("POST",))
+@login_required
+def reserve_episode(id):
+    """Check an episode's air date and hold the timeslot while its audio
+    uploads, so the DJ hears about a problem before sending any bytes.
+
+    Reserving a slot the same DJ already holds extends the reservation,
+    which the upload page does periodically for long uploads. Expired
+    reservations are cleared out on every call.
+
+    :return: ``{"reservation_token": ...}`` for the create_episode POST
+    """
+    show = get_show(id)
+    try:
+        air_date = datetime.strptime(request.json["air_date"], "%Y-%m-%d")
+    except KeyError as e:
+        error = f"{e.args[0].replace('_', ' ')} is required"
+        return ({"error": error}, 400)
+    except ValueError as e:
+        return ({"error": str(e)}, 400)
+
+    air_date, error = get_air_date(show, air_date)
+    if error:
+        return ({"error": error}, 400)
+
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("DELETE FROM EpisodeReservations WHERE expires_at < CURRENT_TIMESTAMP")
+    cur.execute("SELECT 1 FROM Episodes WHERE air_date = %s", (air_date,))
+    if cur.fetchone():
+        db.rollback()
+        return ({"error": "another episode already exists in this timeslot"}, 400)
+
+    cur.execute(
+        """
+        INSERT INTO EpisodeReservations (token, show_id, air_date, created_by, expires_at)
+        VALUES (%(token)s, %(show_id)s, %(air_date)s, %(user)s, CURRENT_TIMESTAMP + %(ttl)s * interval '1 second')
+        ON CONFLICT (air_date) DO UPDATE SET expires_at = EXCLUDED.expires_at
+        WHERE EpisodeReservations.created_by = EXCLUDED.created_by
+        AND EpisodeReservations.show_id = EXCLUDED.show_id
+        RETURNING token;
+        """,
+        {
+            "token": secrets.token_urlsafe(),
+            "show_id": id,
+            "air_date": air_date,
+            "user": g.user["id"],
+            "ttl": current_app.config["EPISODE_RESERVATION_TTL"],
+        })
+    reservation = cur.fetchone()
+    db.commit()
+
+    if not reservation:
+        return ({"error": "another DJ is uploading an episode for this timeslot"}, 400)
+
+    return {"reservation_token": reservation["token"]}
+
+
 @bp.route("/shows/<int:id>/create_episode", methods=("GET", "POST"))
 @login_required
 def create_episode(id):
@@ -263,27 +915,12 @@ def create_episode(id):
 
     # local to the station in Seattle
     now = datetime.now(tz=ZoneInfo("America/Los_Angeles"))
-    weekday_to_isoweekday = {
-        "Monday": 1,
-        "Tuesday": 2,
-        "Wednesday": 3,
-        "Thursday": 4,
-        "Friday": 5,
-        "Saturday": 6,
-        "Sunday": 7
-    }
-    days_offset = weekday_to_isoweekday[show["day_of_week"]] - now.isoweekday()
+    days_offset = WEEKDAY_TO_ISOWEEKDAY[show["day_of_week"]] - now.isoweekday()
     days_offset = days_offset if days_offset >= 0 else days_offset + 7
     next_episode = now + timedelta(days=days_offset)
     if days_offset == 0 and (now + timedelta(hours=1)).time() > show["start_time"]:  # allow uploads up to one hour before air
         next_episode += timedelta(days=7)
 
-    # Get the upload url for B2 cloud storage
-    info = InMemoryAccountInfo()  # store credentials, tokens and cache in memory
-    session = B2Session(info)
-    session.authorize_account("production", current_app.config["B2_UPLOAD_KEY_ID"], current_app.config["B2_UPLOAD_KEY"])
-    upload = session.get_upload_url(current_app.config["B2_BUCKET_ID"])
-
     if request.method == "POST":
         post = {}
         required_fields = ("title", "air_date", "file_id", "original_filename")
@@ -293,6 +930,10 @@ def create_episode(id):
             post["air_date"] = datetime.strptime(request.json["air_date"], "%Y-%m-%d")
             post["file_id"] = request.json["file_id"]
             post["original_filename"] = request.json["original_filename"]
+            post["reservation_token"] = request.json.get("reservation_token")
+            # the audio's SHA-1 and size, when the upload page sends them
+            post["sha1"] = request.json.get("sha1")
+            post["size"] = request.json.get("size")
         except KeyError as e:
             error = f"{e.args[0].replace('_', ' ')} is required"
             return ({"error": error}, 400)
@@ -304,21 +945,32 @@ def create_episode(id):
                 error = f"{field.replace('_', ' ')} is required"
                 return ({"error": error}, 400)
 
-        # validate that air date matches show schedule
-        if weekday_to_isoweekday[show["day_of_week"]] != post["air_date"].isoweekday():
-            return ({"error": "air date does not match schedule"}, 400)
-        air_date = datetime.combine(post["air_date"],
-                                    show["start_time"],
-                                    tzinfo=ZoneInfo("America/Los_Angeles"))
+        air_date, error = get_air_date(show, post["air_date"])
+        if error:
+            return ({"error": error}, 400)
 
-        if air_date < datetime.now(tz=ZoneInfo("America/Los_Angeles")) + timedelta(hours=1):
-            return ({"error": "air date is in the past"}, 400)
+        # reused audio already has a row
+        new_audio_file = (is_sha1(post["sha1"]) and isinstance(post["size"], int)
+                          and get_audio_file(cur, post["sha1"], post["size"]) is None)
 
         try:
+            # redeem this user's reservation of the slot; anyone else's
+            # unexpired one means they're uploading for it right now
+            cur.execute(
+                "DELETE FROM EpisodeReservations"
+                " WHERE air_date = %(air_date)s"
+                " AND (expires_at < CURRENT_TIMESTAMP OR token = %(token)s OR created_by = %(user)s)",
+                {"air_date": air_date, "token": post["reservation_token"], "user": g.user["id"]})
+            cur.execute("SELECT 1 FROM EpisodeReservations WHERE air_date = %s", (air_date,))
+            if cur.fetchone():
+                db.rollback()
+                return ({"error": "another DJ is uploading an episode for this timeslot"}, 400)
+
             cur.execute(
                 """
             INSERT INTO Episodes (show_id, title, air_date, file_id, original_filename, description, created_by, updated_by)
-            VALUES (%(show_id)s, %(title)s, %(air_date)s, %(file_id)s, %(original_filename)s, %(description)s, %(user)s, %(user)s);
+            VALUES (%(show_id)s, %(title)s, %(air_date)s, %(file_id)s, %(original_filename)s, %(description)s, %(user)s, %(user)s)
+            RETURNING id;
             """,
                 {
                     "show_id": id,
@@ -330,6 +982,7 @@ def create_episode(id):
                     "user": g.user["id"]
                 },
             )
+            record_schedule_change(cur, "create_episode", id, cur.fetchone()["id"])
             db.commit()
         except psycopg2.errors.UniqueViolation as e:
             if e.diag.constraint_name == "episodes_air_date_key":
@@ -337,9 +990,116 @@ def create_episode(id):
         except psycopg2.Error as e:
             return ({"error": e.diag.message_detail}, 400)
 
+        get_cache().invalidate(show_tag(id))
+        if new_audio_file:
+            # B2 checks the audio off the request, before it's offered to
+            # anyone uploading the same audio
+            get_audio_file_verifier().submit(post["file_id"], post["sha1"], post["size"], g.user["id"])
         return {"redirect": url_for("scheduler.index")}
 
-    return render_template("scheduler/create_episode.html", next_episode=next_episode, show=show, upload=upload)
+    # Get the upload url for B2 cloud storage; the browser uploads the audio
+    # before POSTing the form, so only the page itself needs one
+    upload = get_upload_cache().get_upload_url()
+
+    return render_template("scheduler/create_episode.html", next_episode=next_episode, show=show, upload=upload,
+                           part_size=current_app.config["B2_PART_SIZE"],
+                           upload_concurrency=current_app.config["B2_UPLOAD_CONCURRENCY"])
+
+
+# X-Bz-Info-* keys the upload page may store with a large file; the rest
+# are set here
+UPLOAD_FILE_INFO_KEYS = ("original-filename", "show-title", "episode-title", "air-date")
+
+
+@bp.route("/shows/<int:id>/uploads", methods=("POST",))
+@login_required
+def start_upload(id):
+    """Start a B2 large file for an episode of show with id `id`, which
+    the browser then uploads in parts.
+
+    The file is recorded against the user and show, and only the user
+    who started it can upload its parts or finish it.
+    """
+    get_show(id)
+    try:
+        file_name = request.json["file_name"]
+        content_type = request.json.get("content_type") or "b2/x-auto"
+        file_info = request.json.get("file_info", {})
+        sha1 = request.json.get("sha1")
+    except KeyError as e:
+        error = f"{e.args[0].replace('_', ' ')} is required"
+        return ({"error": error}, 400)
+
+    if not isinstance(file_info, dict) or not all(
+            key in UPLOAD_FILE_INFO_KEYS and isinstance(value, str) for key, value in file_info.items()):
+        return ({"error": f"file info may only have string {', '.join(UPLOAD_FILE_INFO_KEYS)}"}, 400)
+    if sha1 is not None and not is_sha1(sha1):
+        return ({"error": "sha1 must be a hex SHA-1"}, 400)
+
+    file_info = dict(file_info)
+    file_info["uploader-uid"] = str(g.user["id"])
+    if sha1:
+        # B2 can't check a large file's SHA-1, so it's the uploader's word
+        file_info["large_file_sha1"] = sha1
+    large_file = get_upload_cache().start_large_file(file_name, content_type, file_info)
+
+    db = get_db()
+    db.cursor().execute(
+        "INSERT INTO LargeFileUploads (file_id, show_id, created_by) VALUES (%s, %s, %s)",
+        (large_file["fileId"], id, g.user["id"]))
+    db.commit()
+    return {"file_id": large_file["fileId"]}
+
+
+def check_large_file_upload(file_id):
+    """Check that the current user started the large file with id
+    `file_id`.
+
+    :raise 404: if they didn't, so as not to give away whether it exists
+    """
+    cur = get_db().cursor()
+    cur.execute(
+        "SELECT 1 FROM LargeFileUploads WHERE file_id = %s AND created_by = %s",
+        (file_id, g.user["id"]))
+    if not cur.fetchone():
+        abort(404, f"No upload {file_id} of yours.")
+
+
+@bp.route("/uploads/<file_id>/part_url", methods=("POST",))
+@login_required
+def get_upload_part_url(file_id):
+    """Get a URL to upload parts of a large file to. Each concurrent
+    part uploader needs its own."""
+    check_large_file_upload(file_id)
+    upload = get_upload_cache().get_upload_part_url(file_id)
+    return {"upload_url": upload["uploadUrl"], "authorization_token": upload["authorizationToken"]}
+
+
+@bp.route("/uploads/<file_id>/parts")
+@login_required
+def get_upload_parts(file_id):
+    """List the parts of a large file already uploaded, so an interrupted
+    upload can carry on where it left off."""
+    check_large_file_upload(file_id)
+    parts = get_upload_cache().list_parts(file_id)
+    return {"parts": [{"part_number": part["partNumber"],
+                       "content_length": part["contentLength"],
+                       "content_sha1": part["contentSha1"]} for part in parts]}
+
+
+@bp.route("/uploads/<file_id>/finish", methods=("POST",))
+@login_required
+def finish_upload(file_id):
+    """Assemble a large file from its uploaded parts."""
+    check_large_file_upload(file_id)
+    try:
+        part_sha1_array = request.json["part_sha1_array"]
+    except KeyError as e:
+        error = f"{e.args[0].replace('_', ' ')} is required"
+        return ({"error": error}, 400)
+
+    large_file = get_upload_cache().finish_large_file(file_id, part_sha1_array)
+    return {"file_id": large_file["fileId"]}
 
 
 @bp.route("/shows/<int:id>/update", methods=("GET", "POST"))
@@ -390,11 +1150,13 @@ def update_show(id):
             cur.execute(
                 """
                 DELETE FROM UserShowsJoin
-                WHERE show_id = %(show_id)s;
+                WHERE show_id = %(show_id)s
+                RETURNING user_id;
                 """,
                 {
                     "show_id": id,
                 })
+            old_djs = [row["user_id"] for row in cur.fetchall()]
 
             for user in post["djs"]:
                 cur.execute(
@@ -407,6 +1169,7 @@ def update_show(id):
                         "show_id": show_id
                     })
 
+            record_schedule_change(cur, "update_show", show_id)
             db.commit()
         except psycopg2.errors.UniqueViolation as e:
             if e.diag.constraint_name == "uidx_show_timeslot":
@@ -414,6 +1177,7 @@ def update_show(id):
         except psycopg2.Error as e:
             return ({"error": e.diag.message_detail}, 400)
 
+        get_cache().invalidate(SHOWS_TAG, show_tag(id), *(user_tag(user) for user in set(old_djs) | set(post["djs"])))
         return {"redirect": url_for("scheduler.index")}
 
     # GET request
@@ -430,9 +1194,11 @@ def delete_episode(id):
     """
     Delete an episode.
     """
-    get_episode(id)
+    episode = get_episode(id)
     db = get_db()
     cur = db.cursor()
     cur.execute("DELETE FROM Episodes WHERE id = %s", (id,))
+    record_schedule_change(cur, "delete_episode", episode["show_id"], id)
     db.commit()
+    get_cache().invalidate(show_tag(episode["show_id"]))
     return redirect(url_for("scheduler.index"))
@@ -1,10 +1,22 @@
 -- Initialize the database.
 -- Drop any existing data and create empty tables.
+--
+-- This is the complete current schema. Changes to it also need a
+-- migration in migrations/ so that `flask migrate-db` can bring a live
+-- database up to date; `flask init-db` marks every migration as applied.
 
 DROP TABLE IF EXISTS Users CASCADE;
 DROP TABLE IF EXISTS UserShowsJoin CASCADE;
 DROP TABLE IF EXISTS Shows CASCADE;
 DROP TABLE IF EXISTS Episodes CASCADE;
+DROP TABLE IF EXISTS ScheduleChanges CASCADE;
+DROP TABLE IF EXISTS SchemaMigrations CASCADE;
+DROP TABLE IF EXISTS EpisodeReservations CASCADE;
+DROP TABLE IF EXISTS LargeFileUploads CASCADE;
+DROP TABLE IF EXISTS StationRuns CASCADE;
+DROP TABLE IF EXISTS DownloadReports CASCADE;
+DROP TABLE IF EXISTS StationPlacements CASCADE;
+DROP TABLE IF EXISTS AudioFiles CASCADE;
 DROP TYPE IF EXISTS Weekday CASCADE;
 
 SET TIMEZONE = "UTC";
@@ -67,6 +79,9 @@ CREATE TABLE UserShowsJoin (
   FOREIGN KEY (show_id) REFERENCES Shows (id)
 );
 
+CREATE INDEX idx_usershowsjoin_user_id ON UserShowsJoin (user_id);
+CREATE INDEX idx_usershowsjoin_show_id ON UserShowsJoin (show_id);
+
 CREATE TABLE Episodes (
   id SERIAL PRIMARY KEY,
   show_id INTEGER NOT NULL,
@@ -83,3 +98,129 @@ CREATE TABLE Episodes (
   FOREIGN KEY (created_by) REFERENCES Users (id),
   FOREIGN KEY (updated_by) REFERENCES Users (id)
 );
+
+CREATE INDEX idx_episodes_show_id_air_date ON Episodes (show_id, air_date);
+
+-- Append-only log of writes to the schedule, so the station puller can
+-- ask for what changed since its last poll
+CREATE TABLE ScheduleChanges (
+  id BIGSERIAL PRIMARY KEY,
+  operation TEXT NOT NULL,
+  show_id INTEGER NOT NULL,
+  episode_id INTEGER,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (show_id) REFERENCES Shows (id)
+);
+
+-- Writers of ScheduleChanges take turns from before their ids are drawn
+-- until they commit, so ids are in commit order and a reader that has
+-- seen one id has seen every lower one. The puller's cursors rely on it
+CREATE OR REPLACE FUNCTION serialize_schedule_changes() RETURNS trigger AS $$
+BEGIN
+  -- arbitrary key, held until the transaction ends
+  PERFORM pg_advisory_xact_lock(1802332017);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER schedule_changes_serialize BEFORE INSERT ON ScheduleChanges
+  FOR EACH STATEMENT EXECUTE FUNCTION serialize_schedule_changes();
+
+-- Announce committed schedule changes to the web processes streaming
+-- them to the station. One notification per statement is enough, since
+-- listeners read the change log itself
+CREATE OR REPLACE FUNCTION notify_schedule_change() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('schedule_changes', '');
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER schedule_changes_notify AFTER INSERT ON ScheduleChanges
+  FOR EACH STATEMENT EXECUTE FUNCTION notify_schedule_change();
+
+-- Audio already stored in B2, by the SHA-1 of its contents, so a file
+-- aired more than once is only uploaded once
+CREATE TABLE AudioFiles (
+  sha1 TEXT PRIMARY KEY,
+  file_id TEXT NOT NULL,
+  size BIGINT NOT NULL,
+  uploaded_by INTEGER NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (uploaded_by) REFERENCES Users (id)
+);
+
+CREATE INDEX idx_audiofiles_file_id ON AudioFiles (file_id);
+
+-- Timeslots held for an episode while its audio uploads
+CREATE TABLE EpisodeReservations (
+  token TEXT PRIMARY KEY,
+  show_id INTEGER NOT NULL,
+  air_date TIMESTAMP WITH TIME ZONE UNIQUE NOT NULL,
+  created_by INTEGER NOT NULL,
+  expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  FOREIGN KEY (show_id) REFERENCES Shows (id),
+  FOREIGN KEY (created_by) REFERENCES Users (id)
+);
+
+-- B2 large files a DJ started uploading for a show, so only they can
+-- upload its parts and finish it
+CREATE TABLE LargeFileUploads (
+  file_id TEXT PRIMARY KEY,
+  show_id INTEGER NOT NULL,
+  created_by INTEGER NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (show_id) REFERENCES Shows (id),
+  FOREIGN KEY (created_by) REFERENCES Users (id)
+);
+
+-- Runs of the station puller, as it reported them. ids come from the
+-- puller so a report it resends after a lost response is only stored once
+CREATE TABLE StationRuns (
+  id TEXT PRIMARY KEY,
+  started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  finished_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  downloaded INTEGER NOT NULL,
+  failed INTEGER NOT NULL,
+  received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_stationruns_received_at ON StationRuns (received_at);
+
+-- Every episode download the puller attempted. Episodes can be deleted
+-- after they were downloaded, so episode_id is not a foreign key
+CREATE TABLE DownloadReports (
+  id BIGSERIAL PRIMARY KEY,
+  run_id TEXT NOT NULL,
+  show_id INTEGER NOT NULL,
+  episode_id INTEGER NOT NULL,
+  file_id TEXT NOT NULL,
+  status TEXT NOT NULL,
+  bytes BIGINT,
+  seconds REAL,
+  sha1 TEXT,
+  error TEXT,
+  -- the puller's audio analysis of the downloaded file
+  analysis JSONB,
+  FOREIGN KEY (run_id) REFERENCES StationRuns (id)
+);
+
+CREATE INDEX idx_downloadreports_episode_id ON DownloadReports (episode_id, id);
+
+-- The episode in each show's playout file at the station
+CREATE TABLE StationPlacements (
+  show_id INTEGER PRIMARY KEY,
+  episode_id INTEGER NOT NULL,
+  file_id TEXT NOT NULL,
+  placed_at TIMESTAMP WITH TIME ZONE NOT NULL,
+  run_id TEXT NOT NULL,
+  FOREIGN KEY (show_id) REFERENCES Shows (id),
+  FOREIGN KEY (run_id) REFERENCES StationRuns (id)
+);
+
+-- Migrations from migrations/ that have been applied to this database
+CREATE TABLE SchemaMigrations (
+  version TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,214 @@
+import logging
+import os
+import threading
+import time
+
+from b2sdk.v2 import InMemoryAccountInfo
+from b2sdk.session import B2Session
+
+from flask import current_app
+
+from scheduler.metrics import timed_b2_call
+
+log = logging.getLogger(__name__)
+
+
+class B2UploadCache:
+    """Process wide B2 authorization and a pool of pre-fetched upload URLs.
+
+    B2 account authorizations and upload URLs are both good for 24
+    hours, so there's no need to ask for new ones on every page view.
+    An upload URL must only be used by one uploader at a time, so each
+    one is handed out once and the pool is topped back up in a
+    background thread.
+    """
+
+    def __init__(self, key_id, key, bucket_id, realm="production", pool_size=4,
+                 auth_ttl=23 * 60 * 60, url_ttl=23 * 60 * 60):
+        """
+        :param key_id: B2 application key id
+        :param key: B2 application key
+        :param bucket_id: bucket to get upload URLs for
+        :param realm: B2 realm name or URL
+        :param pool_size: number of upload URLs to keep on hand
+        :param auth_ttl: seconds to reuse an account authorization
+        :param url_ttl: seconds to keep an upload URL before dropping it
+        """
+        self.key_id = key_id
+        self.key = key
+        self.bucket_id = bucket_id
+        self.realm = realm
+        self.pool_size = pool_size
+        self.auth_ttl = auth_ttl
+        self.url_ttl = url_ttl
+
+        self._lock = threading.Lock()
+        self._auth_lock = threading.Lock()
+        self._session = None
+        self._authorized_at = None
+        self._urls = []  # (upload url dict, time fetched)
+        self._refill_wanted = threading.Event()
+        self._refiller = None
+
+    @property
+    def session(self):
+        """An authorized :class:`B2Session`, re-authorized when the cached
+        authorization is about to expire.
+
+        B2 is only called outside the cache lock, so handing out pooled
+        upload URLs never waits on it. One thread re-authorizes at a time;
+        the others carry on with the old authorization, which B2 honors
+        for a while past ``auth_ttl``, or wait if there isn't one yet.
+        """
+        with self._lock:
+            session = self._session
+            if session and time.monotonic() - self._authorized_at <= self.auth_ttl:
+                return session
+
+        if not self._auth_lock.acquire(blocking=not session):
+            return session
+        try:
+            with self._lock:
+                # another thread may have just re-authorized
+                if self._session and time.monotonic() - self._authorized_at <= self.auth_ttl:
+                    return self._session
+
+            session = B2Session(InMemoryAccountInfo())
+            with timed_b2_call("authorize_account"):
+                session.authorize_account(self.realm, self.key_id, self.key)
+            with self._lock:
+                self._session = session
+                self._authorized_at = time.monotonic()
+            return session
+        finally:
+            self._auth_lock.release()
+
+    def _fetch_upload_url(self):
+        session = self.session
+        with timed_b2_call("get_upload_url"):
+            return session.get_upload_url(self.bucket_id), time.monotonic()
+
+    def get_upload_url(self):
+        """Hand out an upload URL for a single uploader.
+
+        :return: B2's ``b2_get_upload_url`` response, with
+            ``uploadUrl`` and ``authorizationToken``
+        """
+        upload = None
+        with self._lock:
+            while self._urls:
+                url, fetched_at = self._urls.pop()
+                if time.monotonic() - fetched_at < self.url_ttl:
+                    upload = url
+                    break
+
+        if not upload:
+            upload, _ = self._fetch_upload_url()
+
+        self._request_refill()
+        return upload
+
+    def _request_refill(self):
+        with self._lock:
+            if not self._refiller or not self._refiller.is_alive():
+                self._refiller = threading.Thread(target=self._refill_loop, name="b2-upload-url-refill", daemon=True)
+                self._refiller.start()
+        self._refill_wanted.set()
+
+    def _refill_loop(self):
+        while True:
+            self._refill_wanted.wait()
+            self._refill_wanted.clear()
+            try:
+                self.refill()
+            except Exception:
+                log.exception("unable to refill B2 upload URL pool")
+
+    def start_large_file(self, file_name, content_type, file_info):
+        """Start a B2 large file, to be uploaded in parts.
+
+        :return: B2's ``b2_start_large_file`` response, with ``fileId``
+        """
+        session = self.session
+        with timed_b2_call("start_large_file"):
+            return session.start_large_file(
+                self.bucket_id, file_name, content_type, file_info)
+
+    def get_upload_part_url(self, file_id):
+        """Get a URL for uploading parts of a large file, one at a time.
+
+        :return: B2's ``b2_get_upload_part_url`` response, with
+            ``uploadUrl`` and ``authorizationToken``
+        """
+        session = self.session
+        with timed_b2_call("get_upload_part_url"):
+            return session.get_upload_part_url(file_id)
+
+    def list_parts(self, file_id):
+        """List the parts of an unfinished large file uploaded so far.
+
+        :return: part dicts with ``partNumber``, ``contentLength`` and
+            ``contentSha1``, in part number order
+        """
+        session = self.session
+        parts = []
+        start_part_number = None
+        while True:
+            with timed_b2_call("list_parts"):
+                response = session.list_parts(file_id, start_part_number, 1000)
+            parts.extend(response["parts"])
+            start_part_number = response.get("nextPartNumber")
+            if not start_part_number:
+                return parts
+
+    def finish_large_file(self, file_id, part_sha1_array):
+        """Assemble an uploaded large file from its parts.
+
+        :return: B2's ``b2_finish_large_file`` response
+        """
+        session = self.session
+        with timed_b2_call("finish_large_file"):
+            return session.finish_large_file(file_id, part_sha1_array)
+
+    def get_file_info(self, file_id):
+        """Get what B2 stored about an uploaded file.
+
+        :return: B2's ``b2_get_file_info`` response, with ``fileName``,
+            ``contentLength``, ``contentSha1`` and ``fileInfo``
+        """
+        session = self.session
+        with timed_b2_call("get_file_info"):
+            return session.get_file_info_by_id(file_id)
+
+    def refill(self):
+        """Fetch upload URLs until the pool is full."""
+        while True:
+            with self._lock:
+                if len(self._urls) >= self.pool_size:
+                    return
+            url = self._fetch_upload_url()
+            with self._lock:
+                self._urls.append(url)
+
+
+_upload_cache = None
+_upload_cache_pid = None
+_upload_cache_lock = threading.Lock()
+
+
+def get_upload_cache():
+    """Get this process's :class:`B2UploadCache`, creating it on first use."""
+    global _upload_cache, _upload_cache_pid
+
+    if _upload_cache is None or _upload_cache_pid != os.getpid():
+        with _upload_cache_lock:
+            if _upload_cache is None or _upload_cache_pid != os.getpid():
+                config = current_app.config
+                _upload_cache = B2UploadCache(
+                    config["B2_UPLOAD_KEY_ID"],
+                    config["B2_UPLOAD_KEY"],
+                    config["B2_BUCKET_ID"],
+                    realm=config["B2_REALM"],
+                    pool_size=config["B2_UPLOAD_URL_POOL_SIZE"])
+                _upload_cache_pid = os.getpid()
+    return _upload_cache
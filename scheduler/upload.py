@@ -1,31 +1,353 @@
+import hashlib
+import logging
+import math
 import os
-from b2sdk.v2 import InMemoryAccountInfo
-from b2sdk.session import B2Session
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import nullcontext
+from datetime import date
+from urllib.parse import quote
+
+import click
+import psycopg2
 import requests
-from hashlib import sha1
-from dotenv import load_dotenv
-
-load_dotenv() # loads values from .env file into environment variables
-B2_ID = os.environ["B2_UPLOAD_KEY_ID"]
-B2_KEY = os.environ["B2_UPLOAD_KEY"]
-B2_BUCKET_ID = os.environ["B2_BUCKET_ID"]
-
-info = InMemoryAccountInfo()  # store credentials, tokens and cache in memory
-session = B2Session(info)
-session.authorize_account("production", B2_ID, B2_KEY)
-upload = session.get_upload_url(B2_BUCKET_ID)
-print(upload)
-
-content = "this is the payload"
-sha1 = sha1(content.encode()).hexdigest()
-headers = {
-    "Authorization": upload["authorizationToken"],
-    "X-Bz-File-Name": "foo",
-    "Content-Type": "b2/x-auto",
-    "X-Bz-Content-Sha1": sha1
-    }
-
-rsp = requests.post(upload["uploadUrl"], headers=headers, data=content)
-
-print(rsp.status_code)
-print(rsp.text)
+from flask import current_app
+from flask.cli import with_appcontext
+from requests.adapters import HTTPAdapter
+
+from scheduler.cache import get_cache
+from scheduler.cache import show_tag
+from scheduler.db import get_db
+from scheduler.db import get_pool
+from scheduler.storage import get_upload_cache
+
+log = logging.getLogger(__name__)
+
+# how much of a file is read at once while hashing it
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+# B2 allows at most 10000 parts per large file, each at least 5 MB but
+# the last
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 1000 * 1000
+
+# upload responses after which B2 wants a new upload URL tried
+RETRY_STATUSES = (401, 408, 429, 500, 502, 503, 504)
+
+
+def sha1_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """Get the hex SHA-1 of a file without reading it all into memory."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class UploadError(Exception):
+    """An upload B2 refused, or that kept failing."""
+
+
+class UploadClient:
+    """Uploads files to B2 the way the upload page does, named by their
+    SHA-1, with large files sent as parts a few at a time.
+
+    Safe to share between threads. Each thread keeps the upload URL it
+    was last given, since B2 takes one upload at a time per URL, and
+    gets a new one when an upload through it fails. Connections are
+    pooled in one HTTP session.
+    """
+
+    def __init__(self, upload_cache, part_size=25 * 1024 * 1024, part_concurrency=4, retries=5, backoff=1.0):
+        """
+        :param upload_cache: :class:`~scheduler.storage.B2UploadCache` to
+            get authorization and upload URLs from
+        :param part_size: files larger than this are uploaded in parts of
+            this many bytes
+        :param part_concurrency: parts of one file uploaded at once
+        :param retries: attempts at each file or part before giving up
+        :param backoff: seconds to wait after the first failed attempt,
+            doubling after each one
+        """
+        self.upload_cache = upload_cache
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.part_concurrency = part_concurrency
+        self.retries = retries
+        self.backoff = backoff
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, part_concurrency * 4))
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        self._local = threading.local()
+
+    def _post(self, get_url, headers, data):
+        """POST data to an upload URL, retrying with a fresh URL from
+        ``get_url`` after failures B2 says are worth retrying.
+
+        :param data: bytes, or the path of a file to stream
+        :return: B2's JSON response
+        :raise UploadError: if B2 refused the upload or it kept failing
+        """
+        for attempt in range(1, self.retries + 1):
+            upload = getattr(self._local, "upload", None) or get_url()
+            self._local.upload = upload
+            try:
+                with open(data, "rb") if isinstance(data, str) else nullcontext(data) as body:
+                    response = self.http.post(
+                        upload["uploadUrl"],
+                        headers=dict(headers, Authorization=upload["authorizationToken"]),
+                        data=body)
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                error = f"status {response.status_code}: {response.text[:200]}"
+                if response.status_code not in RETRY_STATUSES:
+                    raise UploadError(error)
+
+            # a URL that failed may be busy or expired
+            self._local.upload = None
+            log.warning("upload attempt %d of %d failed: %s", attempt, self.retries, error)
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        raise UploadError(f"upload failed after {self.retries} attempts: {error}")
+
+    def upload_file(self, path, content_type="b2/x-auto", file_info=None, sha1=None):
+        """Upload a file, as a large file if it's bigger than one part.
+
+        :param path: file to upload
+        :param content_type: MIME type to store it with
+        :param file_info: ``X-Bz-Info-*`` values to store with it, already
+            percent-encoded as B2 requires
+        :param sha1: the file's hex SHA-1, if already known
+        :return: dict of ``file_id``, ``sha1`` and ``size``
+        :raise UploadError: if the file couldn't be uploaded
+        """
+        size = os.path.getsize(path)
+        sha1 = sha1 or sha1_file(path)
+        file_info = dict(file_info or {})
+
+        if size > self.part_size:
+            file_id = self._upload_large_file(path, size, sha1, content_type, file_info)
+        else:
+            headers = {
+                "X-Bz-File-Name": sha1,
+                "Content-Type": content_type,
+                "Content-Length": str(size),
+                "X-Bz-Content-Sha1": sha1,
+            }
+            headers.update({f"X-Bz-Info-{key}": value for key, value in file_info.items()})
+            file_id = self._post(self.upload_cache.get_upload_url, headers, path)["fileId"]
+
+        return {"file_id": file_id, "sha1": sha1, "size": size}
+
+    def _upload_large_file(self, path, size, sha1, content_type, file_info):
+        # grow the parts rather than go over B2's part limit
+        part_size = max(self.part_size, math.ceil(size / MAX_PARTS))
+        num_parts = math.ceil(size / part_size)
+        file_info["large_file_sha1"] = sha1
+        file_id = self.upload_cache.start_large_file(sha1, content_type, file_info)["fileId"]
+
+        def upload_part(part_number):
+            with open(path, "rb") as f:
+                f.seek((part_number - 1) * part_size)
+                data = f.read(part_size)
+            part_sha1 = hashlib.sha1(data).hexdigest()
+            headers = {
+                "X-Bz-Part-Number": str(part_number),
+                "Content-Length": str(len(data)),
+                "X-Bz-Content-Sha1": part_sha1,
+            }
+            self._post(lambda: self.upload_cache.get_upload_part_url(file_id), headers, data)
+            return part_sha1
+
+        # each of these threads holds a part URL of this file only, and
+        # goes away with it
+        with ThreadPoolExecutor(self.part_concurrency) as executor:
+            part_sha1s = list(executor.map(upload_part, range(1, num_parts + 1)))
+
+        return self.upload_cache.finish_large_file(file_id, part_sha1s)["fileId"]
+
+
+def get_upload_client():
+    """Create an :class:`UploadClient` using the app's B2 settings."""
+    config = current_app.config
+    return UploadClient(get_upload_cache(),
+                        part_size=config["B2_PART_SIZE"],
+                        part_concurrency=config["B2_UPLOAD_CONCURRENCY"])
+
+
+# files the archive ingest picks up
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aac", ".aif", ".aiff")
+
+# a YYYY-MM-DD or YYYYMMDD date in a file name
+FILE_NAME_DATE = re.compile(r"(?<!\d)(\d{4})-?(\d{2})-?(\d{2})(?!\d)")
+
+
+def find_archive_files(directory, show):
+    """Find the audio files under a directory and when they aired, from
+    the date in each file's name and the show's start time.
+
+    :return: ``(files, skipped)``, where files is a list of ``(path, air
+        date)`` sorted by air date and skipped is a list of ``(path,
+        reason)`` for the audio files with no usable date in their name
+    """
+    from scheduler.scheduler import get_air_date
+
+    files = []
+    skipped = []
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if not name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            match = FILE_NAME_DATE.search(name)
+            try:
+                day = date(*map(int, match.groups())) if match else None
+            except ValueError:
+                day = None
+            if not day:
+                skipped.append((path, "no date in its name"))
+                continue
+            air_date, error = get_air_date(show, day, allow_past=True)
+            if error:
+                skipped.append((path, error))
+                continue
+            files.append((path, air_date))
+
+    files.sort(key=lambda file: file[1])
+    return files, skipped
+
+
+@click.command("ingest-episodes")
+@click.argument("show_id", type=int)
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--user", "email", required=True, help="Email of the DJ to create the episodes as.")
+@click.option("--concurrency", default=4, show_default=True, help="Files to upload at once.")
+@click.option("--dry-run", is_flag=True, help="List what would be uploaded without uploading it.")
+@with_appcontext
+def ingest_episodes_command(show_id, directory, email, concurrency, dry_run):
+    """Upload a directory of a show's archived episodes to B2 and add
+    them to the schedule.
+
+    Each file's air date is taken from a date in its name, at the show's
+    start time, and has to fall on the show's day of the week. Files whose air date already has an episode are skipped,
+    so an interrupted ingest can be run again, and audio already in B2
+    isn't uploaded again.
+    """
+    from scheduler.scheduler import get_audio_file
+    from scheduler.scheduler import record_audio_file
+    from scheduler.scheduler import record_schedule_change
+
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("SELECT id, title, day_of_week, start_time FROM Shows WHERE id = %s", (show_id,))
+    show = cur.fetchone()
+    if not show:
+        raise click.ClickException(f"Show id {show_id} doesn't exist.")
+    cur.execute("SELECT id FROM Users WHERE email = %s", (email,))
+    user = cur.fetchone()
+    if not user:
+        raise click.ClickException(f"No user with email {email}.")
+
+    files, skipped = find_archive_files(directory, show)
+    for path, reason in skipped:
+        click.echo(f"Skipped {path}: {reason}")
+
+    cur.execute("SELECT air_date FROM Episodes WHERE air_date = ANY(%s)", ([air_date for _, air_date in files],))
+    taken = {row["air_date"] for row in cur.fetchall()}
+    db.rollback()
+    for path, air_date in files:
+        if air_date in taken:
+            click.echo(f"Skipped {path}: {air_date:%Y-%m-%d %H:%M} already has an episode")
+    files = [(path, air_date) for path, air_date in files if air_date not in taken]
+
+    if dry_run:
+        for path, air_date in files:
+            click.echo(f"Would upload {path} for {air_date:%Y-%m-%d %H:%M}")
+        return
+
+    client = get_upload_client()
+    pool = get_pool()
+
+    def upload(path, air_date):
+        sha1 = sha1_file(path)
+        size = os.path.getsize(path)
+        # audio already in B2 is reused, as the upload page does. This
+        # thread can't use the command's connection, so it checks out its
+        # own for the lookup
+        conn = pool.getconn()
+        try:
+            file_id = get_audio_file(conn.cursor(), sha1, size)
+        finally:
+            pool.putconn(conn)
+        if file_id:
+            return {"file_id": file_id, "sha1": sha1, "size": size, "reused": True}
+        # encoded like the upload page's, which uses encodeURIComponent
+        return client.upload_file(path, sha1=sha1, file_info={
+            "original-filename": quote(os.path.basename(path), safe="!~*'()"),
+            "show-title": quote(show["title"], safe="!~*'()"),
+            "air-date": f"{air_date:%Y-%m-%d}",
+            "uploader-uid": str(user["id"]),
+        })
+
+    created = 0
+    failed = 0
+    # uploads run in the pool; episodes are only written from this thread
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = {executor.submit(upload, path, air_date): (path, air_date) for path, air_date in files}
+        for future in as_completed(futures):
+            path, air_date = futures[future]
+            try:
+                uploaded = future.result()
+            except (UploadError, OSError) as e:
+                failed += 1
+                click.echo(f"Failed {path}: {e}")
+                continue
+
+            try:
+                cur.execute(
+                    "INSERT INTO Episodes (show_id, title, air_date, file_id, original_filename, description,"
+                    " created_by, updated_by)"
+                    " VALUES (%(show_id)s, %(title)s, %(air_date)s, %(file_id)s, %(original_filename)s, '',"
+                    " %(user)s, %(user)s)"
+                    " RETURNING id",
+                    {
+                        "show_id": show_id,
+                        "title": os.path.splitext(os.path.basename(path))[0],
+                        "air_date": air_date,
+                        "file_id": uploaded["file_id"],
+                        "original_filename": os.path.basename(path),
+                        "user": user["id"],
+                    })
+                record_schedule_change(cur, "create_episode", show_id, cur.fetchone()["id"])
+                if not uploaded.get("reused"):
+                    record_audio_file(cur, uploaded["sha1"], uploaded["file_id"], uploaded["size"], user["id"])
+                db.commit()
+            except psycopg2.errors.UniqueViolation:
+                db.rollback()
+                click.echo(f"Skipped {path}: {air_date:%Y-%m-%d %H:%M} already has an episode")
+                continue
+
+            created += 1
+            verb = "Reused" if uploaded.get("reused") else "Uploaded"
+            click.echo(f"{verb} {path} for {air_date:%Y-%m-%d %H:%M}")
+
+    if created:
+        get_cache().invalidate(show_tag(show_id))
+    click.echo(f"Created {created} episodes, {failed} failed.")
+    if failed:
+        raise click.ClickException(f"{failed} files failed to upload; run the ingest again to retry them.")
+
+
+def init_app(app):
+    """Register the upload commands with the Flask app. This is called
+    by the application factory.
+    """
+    app.cli.add_command(ingest_episodes_command)
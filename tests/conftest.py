@@ -1,36 +1,42 @@
 import os
-import tempfile
 
 import pytest
 
-from flaskr import create_app
-from flaskr.db import get_db
-from flaskr.db import init_db
+from scheduler import create_app
+from scheduler.db import get_db
+from scheduler.db import init_db
 
 # read in SQL for populating test data
 with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as f:
     _data_sql = f.read().decode("utf8")
 
+# a scratch PostgreSQL database; its tables are dropped and recreated by
+# every test that uses the app fixture
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
 
 @pytest.fixture
 def app():
     """Create and configure a new app instance for each test."""
-    # create a temporary file to isolate the database for each test
-    db_fd, db_path = tempfile.mkstemp()
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+
     # create the app with common test config
-    app = create_app({"TESTING": True, "DATABASE": db_path})
+    app = create_app({
+        "TESTING": True,
+        "SECRET_KEY": "test",
+        "DATABASE_URL": TEST_DATABASE_URL,
+    })
 
     # create the database and load test data
     with app.app_context():
         init_db()
-        get_db().executescript(_data_sql)
+        db = get_db()
+        db.cursor().execute(_data_sql)
+        db.commit()
 
     yield app
 
-    # close and remove the temporary database
-    os.close(db_fd)
-    os.unlink(db_path)
-
 
 @pytest.fixture
 def client(app):
@@ -48,9 +54,9 @@ class AuthActions:
     def __init__(self, client):
         self._client = client
 
-    def login(self, username="test", password="test"):
+    def login(self, email="test@example.com", password="test"):
         return self._client.post(
-            "/auth/login", data={"username": username, "password": password}
+            "/auth/login", data={"email": email, "password": password}
         )
 
     def logout(self):
@@ -1,8 +1,16 @@
-INSERT INTO user (username, password)
+INSERT INTO Users (name, email, password)
 VALUES
-  ('test', 'pbkdf2:sha256:50000$TCI4GzcX$0de171a4f4dac32e3364c7ddc7c14f3e2fa61f2d17574483f7ffbb431b4acb2f'),
-  ('other', 'pbkdf2:sha256:50000$kJPKsz6N$d2d4784f1b030a9761f5ccaeeaca413f27f2ecb76d6168407af962ddce849f79');
+  ('test', 'test@example.com', 'pbkdf2:sha256:50000$TCI4GzcX$0de171a4f4dac32e3364c7ddc7c14f3e2fa61f2d17574483f7ffbb431b4acb2f'),
+  ('other', 'other@example.com', 'pbkdf2:sha256:50000$kJPKsz6N$d2d4784f1b030a9761f5ccaeeaca413f27f2ecb76d6168407af962ddce849f79');
 
-INSERT INTO post (title, body, author_id, created)
+INSERT INTO Shows (title, day_of_week, start_time, description, file_path, created_by, updated_by)
 VALUES
-  ('test title', 'test' || x'0a' || 'body', 1, '2018-01-01 00:00:00');
+  ('test show', 'Monday', '20:00', 'test description', '/tmp/test_show.mp3', 1, 1);
+
+INSERT INTO UserShowsJoin (user_id, show_id)
+VALUES
+  (1, 1);
+
+INSERT INTO Episodes (show_id, title, air_date, file_id, original_filename, description, created_by, updated_by)
+VALUES
+  (1, 'test episode', '2099-01-05 20:00:00-08', 'test-file-id', 'test.mp3', 'test episode description', 1, 1);
@@ -1,37 +1,56 @@
+import time
+
 import pytest
 from flask import g
 from flask import session
 
-from flaskr.db import get_db
+from scheduler import auth as auth_module
+from scheduler.db import get_db
+
+
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    # the cache outlives the app, and every test reloads user 1
+    auth_module._user_cache.clear()
+
+
+def rename_user(app, name, user_id=1):
+    """Change a Users row behind the cache's back."""
+    with app.app_context():
+        db = get_db()
+        db.cursor().execute("UPDATE Users SET name = %s WHERE id = %s", (name, user_id))
+        db.commit()
 
 
 def test_register(client, app):
     # test that viewing the page renders without template errors
     assert client.get("/auth/register").status_code == 200
 
-    # test that successful registration redirects to the login page
-    response = client.post("/auth/register", data={"username": "a", "password": "a"})
-    assert response.headers["Location"] == "/auth/login"
+    # test that successful registration redirects to the index page
+    response = client.post(
+        "/auth/register", data={"email": "a@example.com", "name": "a", "password": "a"}
+    )
+    assert response.headers["Location"] == "/"
 
     # test that the user was inserted into the database
     with app.app_context():
-        assert (
-            get_db().execute("SELECT * FROM user WHERE username = 'a'").fetchone()
-            is not None
-        )
+        cur = get_db().cursor()
+        cur.execute("SELECT * FROM Users WHERE email = 'a@example.com'")
+        assert cur.fetchone() is not None
 
 
 @pytest.mark.parametrize(
-    ("username", "password", "message"),
+    ("email", "name", "password", "message"),
     (
-        ("", "", b"Username is required."),
-        ("a", "", b"Password is required."),
-        ("test", "test", b"already registered"),
+        ("", "a", "a", b"Email is required."),
+        ("a@example.com", "", "a", b"Name is required."),
+        ("a@example.com", "a", "", b"Password is required."),
+        ("test@example.com", "test", "test", b"already registered"),
     ),
 )
-def test_register_validate_input(client, username, password, message):
+def test_register_validate_input(client, email, name, password, message):
     response = client.post(
-        "/auth/register", data={"username": username, "password": password}
+        "/auth/register", data={"email": email, "name": name, "password": password}
     )
     assert message in response.data
 
@@ -49,16 +68,16 @@ def test_login(client, auth):
     with client:
         client.get("/")
         assert session["user_id"] == 1
-        assert g.user["username"] == "test"
+        assert g.user["name"] == "test"
 
 
 @pytest.mark.parametrize(
-    ("username", "password", "message"),
-    (("a", "test", b"Incorrect username."), ("test", "a", b"Incorrect password.")),
+    ("email", "password"),
+    (("a@example.com", "test"), ("test@example.com", "a")),
 )
-def test_login_validate_input(auth, username, password, message):
-    response = auth.login(username, password)
-    assert message in response.data
+def test_login_validate_input(auth, email, password):
+    response = auth.login(email, password)
+    assert b"Login failed." in response.data
 
 
 def test_logout(client, auth):
@@ -67,3 +86,64 @@ def test_logout(client, auth):
     with client:
         auth.logout()
         assert "user_id" not in session
+
+
+def test_user_cache_serves_until_ttl(client, auth, app):
+    app.config["USER_CACHE_TTL"] = 0.5
+    auth.login()
+    rename_user(app, "renamed")
+
+    with client:
+        client.get("/")
+        assert g.user["name"] == "test"
+
+        time.sleep(0.6)
+        client.get("/")
+        assert g.user["name"] == "renamed"
+
+
+def test_user_cache_holds_no_password(client, auth):
+    auth.login()
+    with client:
+        client.get("/")
+        assert "password" not in g.user
+
+
+def test_login_refreshes_cached_user(client, auth, app):
+    auth.login()
+    client.get("/")
+    rename_user(app, "renamed")
+
+    auth.login()
+    with client:
+        client.get("/")
+        assert g.user["name"] == "renamed"
+
+
+def test_logout_invalidates_cached_user(client, auth, app):
+    auth.login()
+    client.get("/")
+    assert 1 in auth_module._user_cache
+
+    auth.logout()
+    assert 1 not in auth_module._user_cache
+
+
+def test_invalidate_user(client, auth, app):
+    auth.login()
+    rename_user(app, "renamed")
+
+    with app.app_context():
+        auth_module.invalidate_user(1)
+    with client:
+        client.get("/")
+        assert g.user["name"] == "renamed"
+
+
+def test_feeds_skip_user_lookup(client, auth):
+    auth.login()
+    auth_module._user_cache.clear()
+    with client:
+        client.get("/schedule")
+        assert g.user is None
+    assert 1 not in auth_module._user_cache
@@ -0,0 +1,118 @@
+from psycopg2.extras import DictCursor
+
+from scheduler import create_app
+from scheduler.cache import Cache
+from scheduler.cache import MemoryBackend
+from scheduler.cache import get_cache
+from scheduler.cache import show_tag
+from scheduler.db import get_db
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_entries=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    backend.get_many(["a"])
+    backend.set("c", 3)
+    assert backend.get_many(["a", "b", "c"]) == [1, None, 3]
+
+
+def test_memory_backend_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("scheduler.cache.time.monotonic", lambda: now[0])
+    backend = MemoryBackend()
+    backend.set("a", 1, timeout=10)
+    assert backend.get_many(["a"]) == [1]
+    now[0] += 10
+    assert backend.get_many(["a"]) == [None]
+
+
+def test_memory_backend_warns_with_several_workers(caplog):
+    create_app({"TESTING": True, "WEB_CONCURRENCY": 1})
+    assert "CACHE_URL" not in caplog.text
+    create_app({"TESTING": True, "WEB_CONCURRENCY": 3})
+    assert "each of the 3 workers caches in memory" in caplog.text
+
+
+def test_invalidate_by_tag():
+    cache = Cache(MemoryBackend())
+    cache.set("one", 1, tags=["show:1", "user:1"])
+    cache.set("two", 2, tags=["show:2"])
+    assert cache.get("one") == 1
+
+    cache.invalidate("user:1")
+    assert cache.get("one") is None
+    assert cache.get("two") == 2
+    assert cache.stats() == {"hits": 2, "misses": 1, "invalidations": 1}
+
+
+def test_evicted_tag_only_causes_misses():
+    backend = MemoryBackend()
+    cache = Cache(backend)
+    cache.set("one", 1, tags=["show:1"])
+    backend._entries.pop("tag:show:1")
+    assert cache.get("one") is None
+
+
+def test_get_or_compute_stores_once():
+    cache = Cache(MemoryBackend())
+    calls = []
+    for _ in range(2):
+        assert cache.get_or_compute("one", lambda: calls.append(1) or 1, tags=["show:1"]) == 1
+    assert calls == [1]
+
+
+def test_write_during_fill_leaves_entry_stale():
+    cache = Cache(MemoryBackend())
+
+    def compute():
+        # the fill has read the old data when a write commits and
+        # invalidates what it touched
+        value = "old"
+        cache.invalidate("show:1")
+        return value
+
+    assert cache.get_or_compute("one", compute, tags=["show:1"]) == "old"
+    assert cache.get("one") is None
+    assert cache.get_or_compute("one", lambda: "new", tags=["show:1"]) == "new"
+
+
+def test_more_tags_read_before_fill():
+    cache = Cache(MemoryBackend())
+
+    def compute():
+        cache.invalidate("show:2")
+        return "old"
+
+    cache.get_or_compute("one", compute, tags=["user:1"], more_tags=lambda: ["show:1", "show:2"])
+    assert cache.get("one") is None
+
+
+def test_write_during_episodes_fill(client, app, monkeypatch):
+    def query_then_delete(self, *args):
+        # the feed's query has run, and a write to the show lands before
+        # the feed is cached
+        execute(self, *args)
+        if args[0].startswith("SELECT id, title, air_date"):
+            with app.app_context():
+                db = get_db()
+                db.cursor().execute("DELETE FROM Episodes WHERE show_id = 1")
+                db.commit()
+                get_cache().invalidate(show_tag(1))
+
+    execute = DictCursor.execute
+    monkeypatch.setattr(DictCursor, "execute", query_then_delete)
+    assert client.get("/episodes?show_id=1").json["episodes"]
+    monkeypatch.undo()
+
+    assert client.get("/episodes?show_id=1").json["episodes"] == []
+
+
+def test_write_invalidates_episodes(client, auth, app):
+    assert client.get("/episodes?show_id=1").json["episodes"]
+    with app.app_context():
+        assert app.extensions["cache"].get("episodes:1") is not None
+
+    auth.login()
+    client.post("/episodes/1/delete")
+    assert client.get("/episodes?show_id=1").json["episodes"] == []
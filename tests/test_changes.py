@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from scheduler.db import get_db
+from test_scheduler import NEW_SHOW
+
+
+@pytest.fixture
+def app(app):
+    app.config.update(SCHEDULE_STREAM_SECONDS=0.5, SCHEDULE_STREAM_HEARTBEAT=10)
+    return app
+
+
+def parse_events(body):
+    """Split a server-sent event stream into dicts of its fields."""
+    events = []
+    for block in body.decode().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if "data" in fields:
+            events.append(dict(fields, data=json.loads(fields["data"])))
+    return events
+
+
+def record_change(app, operation="update_show", id=None):
+    with app.app_context():
+        db = get_db()
+        db.cursor().execute(
+            "INSERT INTO ScheduleChanges (id, operation, show_id)"
+            " VALUES (COALESCE(%s, nextval('schedulechanges_id_seq')), %s, 1)",
+            (id, operation))
+        db.commit()
+
+
+def test_stream_catches_up_after_event_id(client, auth, app):
+    auth.login()
+    client.post("/shows/create", json=NEW_SHOW)
+    client.post("/shows/1/update", json=dict(NEW_SHOW, title="updated", day_of_week="Wednesday"))
+
+    response = client.get("/schedule/changes", query_string={"after": 0})
+    assert response.mimetype == "text/event-stream"
+    events = parse_events(response.data)
+    assert [(event["id"], event["data"]["operation"], event["data"]["show_id"]) for event in events] == [
+        ("1", "create_show", 2), ("2", "update_show", 1)]
+
+    # an EventSource reconnecting sends the last id it got
+    events = parse_events(client.get("/schedule/changes", headers={"Last-Event-ID": "1"}).data)
+    assert [event["id"] for event in events] == ["2"]
+
+
+def test_stream_starts_from_now_without_event_id(client, app):
+    record_change(app)
+    assert parse_events(client.get("/schedule/changes").data) == []
+
+
+def test_stream_resets_clients_ahead_of_the_log(client, app):
+    record_change(app)
+    events = parse_events(client.get("/schedule/changes", query_string={"after": 99}).data)
+    assert [(event.get("event"), event["data"]) for event in events] == [("reset", {"cursor": 1})]
+
+
+def test_stream_rejects_bad_event_id(client):
+    assert client.get("/schedule/changes", query_string={"after": "x"}).status_code == 400
+
+
+def test_stream_is_woken_by_commits(client, app):
+    app.config["SCHEDULE_STREAM_SECONDS"] = 3
+    # heartbeats are further apart than the stream lasts, so only a
+    # notification can get the change out
+    response = {}
+    thread = threading.Thread(target=lambda: response.update(
+        body=client.get("/schedule/changes", query_string={"after": 0}).data))
+    thread.start()
+    time.sleep(1)
+    record_change(app, "create_episode")
+    thread.join()
+
+    assert [event["data"]["operation"] for event in parse_events(response["body"])] == ["create_episode"]
+
+
+def test_stream_start_misses_no_late_commits(client, app):
+    insert = "INSERT INTO ScheduleChanges (operation, show_id) VALUES (%s, 1)"
+    first, second = (psycopg2.connect(app.config["DATABASE_URL"]) for _ in range(2))
+    # the first write takes its id and the second waits for it to commit
+    # before taking one, so the stream can't start past the first
+    first.cursor().execute(insert, ("create_show",))
+    writer = threading.Thread(target=lambda: (second.cursor().execute(insert, ("update_show",)), second.commit()))
+    writer.start()
+    time.sleep(0.2)
+
+    app.config["SCHEDULE_STREAM_SECONDS"] = 1
+    response = {}
+    reader = threading.Thread(target=lambda: response.update(body=client.get("/schedule/changes").data))
+    reader.start()
+    time.sleep(0.2)
+    first.commit()
+    writer.join()
+    reader.join()
+    first.close()
+    second.close()
+
+    assert [event["data"]["operation"] for event in parse_events(response["body"])] == ["create_show", "update_show"]
@@ -1,19 +1,22 @@
-import sqlite3
-
+import psycopg2
 import pytest
+from psycopg2.pool import PoolError
 
-from flaskr.db import get_db
+from scheduler import create_app
+from scheduler.db import ConnectionPool
+from scheduler.db import get_db
+from scheduler.db import get_pool
 
 
-def test_get_close_db(app):
+def test_get_db_reuses_pooled_connection(app):
     with app.app_context():
         db = get_db()
         assert db is get_db()
 
-    with pytest.raises(sqlite3.ProgrammingError) as e:
-        db.execute("SELECT 1")
-
-    assert "closed" in str(e.value)
+    # the connection went back to the pool rather than being closed
+    assert not db.closed
+    with app.app_context():
+        assert get_db() is db
 
 
 def test_init_db_command(runner, monkeypatch):
@@ -23,7 +26,96 @@ def test_init_db_command(runner, monkeypatch):
     def fake_init_db():
         Recorder.called = True
 
-    monkeypatch.setattr("flaskr.db.init_db", fake_init_db)
+    monkeypatch.setattr("scheduler.db.init_db", fake_init_db)
     result = runner.invoke(args=["init-db"])
     assert "Initialized" in result.output
     assert Recorder.called
+
+
+@pytest.fixture
+def pool(app):
+    pool = ConnectionPool(app.config["DATABASE_URL"], maxconn=2, timeout=0.1)
+    yield pool
+    pool.closeall()
+
+
+def test_pool_times_out_when_exhausted(pool):
+    conns = [pool.getconn(), pool.getconn()]
+    with pytest.raises(PoolError):
+        pool.getconn()
+    stats = pool.stats()
+    assert (stats["waits"], stats["exhausted"], stats["checkouts"], stats["size"]) == (1, 1, 2, 2)
+
+    # a connection given back frees the slot
+    pool.putconn(conns.pop())
+    conns.append(pool.getconn())
+    for conn in conns:
+        pool.putconn(conn)
+    assert pool.stats()["idle"] == 2
+
+
+def test_pool_discards_broken_connections(pool):
+    conn = pool.getconn()
+    conn.close()
+    pool.putconn(conn)
+    assert pool.stats()["discards"] == 1
+    assert pool.stats()["idle"] == 0
+
+    conn = pool.getconn()
+    assert not conn.closed
+    pool.putconn(conn)
+
+
+def test_pool_reconnects_after_failed_ping(pool):
+    pool.ping_after = 0
+    conn = pool.getconn()
+    pid = conn.get_backend_pid()
+    pool.putconn(conn)
+
+    # the server drops the idle connection
+    other = psycopg2.connect(pool.dsn)
+    other.cursor().execute("SELECT pg_terminate_backend(%s)", (pid,))
+    other.close()
+
+    conn = pool.getconn()
+    assert conn.get_backend_pid() != pid
+    stats = pool.stats()
+    assert (stats["connects"], stats["discards"]) == (2, 1)
+    pool.putconn(conn)
+
+
+def test_pool_resets_sessions(pool):
+    conn = pool.getconn()
+    cur = conn.cursor()
+    cur.execute("SET TIMEZONE = 'Pacific/Auckland'")
+    cur.execute("CREATE TEMPORARY TABLE leftover (id int)")
+    conn.commit()
+    pool.putconn(conn)
+
+    conn = pool.getconn()
+    cur = conn.cursor()
+    cur.execute("SHOW TIMEZONE")
+    assert cur.fetchone()[0] != "Pacific/Auckland"
+    cur.execute("SELECT to_regclass('pg_temp.leftover')")
+    assert cur.fetchone()[0] is None
+    pool.putconn(conn)
+
+
+def test_get_pool_per_database(app):
+    other = create_app({"TESTING": True, "DATABASE_URL": app.config["DATABASE_URL"] + "?application_name=other"})
+    with app.app_context():
+        pool = get_pool()
+    with other.app_context():
+        assert get_pool() is not pool
+        assert get_pool().dsn == other.config["DATABASE_URL"]
+    with app.app_context():
+        assert get_pool() is pool
+
+
+def test_get_pool_prefills(app):
+    app.config["DB_POOL_MIN_SIZE"] = 2
+    app.config["DATABASE_URL"] += "?application_name=prefilled"
+    with app.app_context():
+        stats = get_pool().stats()
+    assert stats["idle"] == 2
+    assert stats["connects"] == 2
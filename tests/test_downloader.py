@@ -0,0 +1,679 @@
+import hashlib
+import json
+import math
+import os
+import sys
+import time
+import wave
+
+import pytest
+import requests
+
+# the puller is a script run from its own directory, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "downloader"))
+
+import downloader  # noqa: E402
+from analysis import analyze_file  # noqa: E402
+from events import ScheduleWatcher  # noqa: E402
+from events import parse_events  # noqa: E402
+from manifest import Manifest  # noqa: E402
+from status import StatusReporter  # noqa: E402
+
+
+def make_episode(id, air_date, file_id=None):
+    return {"id": id, "title": f"episode {id}", "air_date": air_date, "file_id": file_id or f"file-{id}"}
+
+
+def test_place_file_replaces_target(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"new episode")
+    target = tmp_path / "target"
+    target.write_bytes(b"old episode")
+
+    downloader.place_file(str(source), str(target))
+
+    assert target.read_bytes() == b"new episode"
+    assert not os.path.exists(str(target) + ".kmgp-tmp")
+
+
+def test_plan_placements_skips_placed_episodes(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show", "file_path": str(tmp_path / "playout.mp3")}
+    episodes = [make_episode(2, 200), make_episode(1, 100)]
+    os.makedirs(tmp_path / "1")
+    (tmp_path / "1" / "1").write_bytes(b"episode 1")
+
+    placements = downloader.plan_placements([show], {1: episodes}, manifest, str(tmp_path), set())
+    assert [(s["id"], e["id"]) for s, e, source in placements] == [(1, 1)]
+
+    downloader.apply_placements(placements, manifest)
+    assert downloader.plan_placements([show], {1: episodes}, manifest, str(tmp_path), set()) == []
+
+    # someone changed the playout file behind our back
+    (tmp_path / "playout.mp3").write_bytes(b"something else")
+    assert downloader.plan_placements([show], {1: episodes}, manifest, str(tmp_path), set())
+
+
+def test_plan_placements_skips_failed_downloads(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show", "file_path": str(tmp_path / "playout.mp3")}
+    episodes = [make_episode(1, 100)]
+    assert downloader.plan_placements([show], {1: episodes}, manifest, str(tmp_path), {1}) == []
+
+
+def test_plan_placements_waits_for_airing_episode(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show", "file_path": str(tmp_path / "playout.mp3")}
+    os.makedirs(tmp_path / "1")
+    (tmp_path / "1" / "1").write_bytes(b"episode 1")
+    manifest.record("file-1", make_episode(1, 100), 1, str(tmp_path / "1" / "1"), 9, None)
+    downloader.apply_placements([(show, make_episode(1, 100), str(tmp_path / "1" / "1"))], manifest)
+
+    upcoming = {1: [make_episode(2, 800)]}
+    (tmp_path / "1" / "2").write_bytes(b"episode 2")
+    assert downloader.plan_placements([show], upcoming, manifest, str(tmp_path), set(), now=150, grace=100) == []
+    assert downloader.plan_placements([show], upcoming, manifest, str(tmp_path), set(), now=200, grace=100)
+
+
+def test_plan_placements_skips_episodes_beyond_horizon(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show", "file_path": str(tmp_path / "playout.mp3")}
+    upcoming = {1: [make_episode(1, 10 ** 6)]}
+    jobs, urgent = downloader.plan_downloads([(show, upcoming[1][0], str(tmp_path / "1" / "1"))], manifest,
+                                             now=1000, horizon=10000, urgent_window=1000)
+    assert jobs == []
+    assert downloader.plan_placements([show], upcoming, manifest, str(tmp_path), set(), now=1000) == []
+
+
+def test_plan_wakeups(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show", "file_path": str(tmp_path / "playout.mp3"), "next_air_date": 10000,
+            "episodes": []}
+    os.makedirs(tmp_path / "1")
+    (tmp_path / "1" / "1").write_bytes(b"episode 1")
+    manifest.record("file-1", make_episode(1, 100), 1, str(tmp_path / "1" / "1"), 9, None)
+    downloader.apply_placements([(show, make_episode(1, 100), str(tmp_path / "1" / "1"))], manifest)
+
+    wakeups = downloader.plan_wakeups([show], manifest, now=150, grace=100, margin=0)
+    assert sorted(t for t, reason in wakeups) == [200, 10000 - downloader.UPLOAD_CUTOFF_SECONDS]
+
+    # the slot rolls over to next week once its uploads have closed
+    week = 7 * 24 * 60 * 60
+    wakeups = downloader.plan_wakeups([show], manifest, now=10000, grace=100, margin=0)
+    assert [t for t, reason in wakeups] == [10000 + week - downloader.UPLOAD_CUTOFF_SECONDS]
+
+
+def record_download(manifest, tmp_path, episode, size):
+    path = tmp_path / str(episode["id"])
+    path.write_bytes(b"x" * size)
+    manifest.record(episode["file_id"], episode, 1, str(path), size, None)
+    return path
+
+
+def test_plan_evictions_by_air_date(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    for id, air_date in ((1, 100), (2, 900), (3, 2000)):
+        record_download(manifest, tmp_path, make_episode(id, air_date), 10)
+
+    evictions = downloader.plan_evictions(manifest, now=1000, grace=500, quota=0, protected_file_ids=set())
+    assert [entry["file_id"] for entry in evictions] == ["file-1"]
+
+    downloader.evict(manifest, evictions)
+    assert not (tmp_path / "1").exists()
+    assert manifest.get("file-1") is None
+    assert manifest.get("file-2") is not None
+
+
+def test_plan_evictions_for_quota(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    for id, air_date in ((1, 100), (2, 2000), (3, 3000), (4, 4000)):
+        record_download(manifest, tmp_path, make_episode(id, air_date), 10)
+
+    # the aired episode, then the furthest from airing, but never a next episode
+    evictions = downloader.plan_evictions(manifest, now=1000, grace=0, quota=10, protected_file_ids={"file-4"})
+    assert [entry["file_id"] for entry in evictions] == ["file-1", "file-3", "file-2"]
+
+
+def test_partials_count_toward_quota(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    for id, air_date in ((1, 2000), (2, 3000)):
+        record_download(manifest, tmp_path, make_episode(id, air_date), 10)
+    (tmp_path / "7").mkdir()
+    (tmp_path / "7" / "3.part").write_bytes(b"x" * 5)
+    (tmp_path / "7" / "4.part").write_bytes(b"x" * 7)
+
+    # the partial download of an episode gone from the schedule is deleted
+    partials = downloader.find_partials(str(tmp_path))
+    partial_size = downloader.evict_partials(partials, {str(tmp_path / "7" / "3")})
+    assert partial_size == 5
+    assert (tmp_path / "7" / "3.part").exists()
+    assert not (tmp_path / "7" / "4.part").exists()
+
+    # the one kept leaves room for only one complete episode
+    evictions = downloader.plan_evictions(manifest, now=1000, grace=0, quota=20, protected_file_ids=set(),
+                                          partial_size=partial_size)
+    assert [entry["file_id"] for entry in evictions] == ["file-2"]
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+
+class FakeScheduler:
+    """Stands in for the requests session the reporter posts with."""
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.reports = []
+
+    def post(self, url, json, headers, timeout):
+        assert headers["Authorization"] == "Bearer token"
+        if self.status_code == 200:
+            self.reports.append(json)
+        return FakeResponse(self.status_code)
+
+
+class FakeStream:
+    """Stands in for the requests session the schedule watcher streams
+    with, serving each connection's lines in turn."""
+
+    def __init__(self, *connections):
+        self.connections = list(connections)
+        self.last_event_ids = []
+
+    def get(self, url, headers, stream, timeout):
+        self.last_event_ids.append(headers.get("Last-Event-ID"))
+        return FakeStreamResponse(self.connections.pop(0))
+
+
+class FakeStreamResponse:
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, decode_unicode):
+        return iter(self.lines)
+
+
+class FakeB2Api:
+    """Stands in for the b2sdk B2Api downloads are authorized with."""
+
+    def __init__(self):
+        self.account_info = self
+        self.token = "token-1"
+        self.authorizations = 0
+
+    def get_download_url_for_fileid(self, file_id):
+        return f"https://b2.example.com/file/{file_id}"
+
+    def get_account_auth_token(self):
+        return self.token
+
+    def authorize_automatically(self):
+        self.authorizations += 1
+        self.token = f"token-{self.authorizations + 1}"
+
+
+class FakeDownloads:
+    """Stands in for the requests session files are downloaded with,
+    serving files by id with B2's headers and honoring Range requests."""
+
+    def __init__(self, files, sha1s=None, expired_tokens=(), honor_range=True):
+        self.files = files
+        self.sha1s = sha1s or {}
+        self.expired_tokens = set(expired_tokens)
+        self.honor_range = honor_range
+        self.requests = []
+
+    def get(self, url, headers, stream, timeout):
+        self.requests.append(headers)
+        if headers["Authorization"] in self.expired_tokens:
+            return FakeDownloadResponse(401)
+
+        file_id = url.rsplit("/", 1)[1]
+        data = self.files[file_id]
+        info = {"X-Bz-Content-Sha1": self.sha1s.get(file_id, hashlib.sha1(data).hexdigest())}
+        if "Range" not in headers or not self.honor_range:
+            return FakeDownloadResponse(200, dict(info, **{"Content-Length": str(len(data))}), data)
+
+        start = int(headers["Range"][len("bytes="):-1])
+        if start >= len(data):
+            return FakeDownloadResponse(416, {"Content-Range": f"bytes */{len(data)}"})
+        return FakeDownloadResponse(
+            206, dict(info, **{"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"}), data[start:])
+
+
+class FakeDownloadResponse:
+    def __init__(self, status_code, headers=None, body=b""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(f"status {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+AUDIO = bytes(range(256)) * 4
+
+
+def download(tmp_path, http, b2_api=None, **kwargs):
+    return downloader.b2_download_file(b2_api or FakeB2Api(), "file-1", str(tmp_path / "episode"), http=http,
+                                       chunk_size=100, **kwargs)
+
+
+def test_b2_download_file(tmp_path):
+    http = FakeDownloads({"file-1": AUDIO})
+    assert download(tmp_path, http) == (len(AUDIO), hashlib.sha1(AUDIO).hexdigest())
+    assert (tmp_path / "episode").read_bytes() == AUDIO
+    assert not (tmp_path / "episode.part").exists()
+    assert "Range" not in http.requests[0]
+
+
+@pytest.mark.parametrize("honor_range", (True, False))
+def test_b2_download_file_resumes_part(tmp_path, honor_range):
+    (tmp_path / "episode.part").write_bytes(AUDIO[:300])
+    http = FakeDownloads({"file-1": AUDIO}, honor_range=honor_range)
+
+    # a server ignoring the Range header sends the whole file again
+    assert download(tmp_path, http) == (len(AUDIO), hashlib.sha1(AUDIO).hexdigest())
+    assert http.requests[0]["Range"] == "bytes=300-"
+    assert (tmp_path / "episode").read_bytes() == AUDIO
+
+
+def test_b2_download_file_finishes_complete_part(tmp_path):
+    # the last attempt got every byte but didn't get to rename the .part
+    (tmp_path / "episode.part").write_bytes(AUDIO)
+    http = FakeDownloads({"file-1": AUDIO})
+    assert download(tmp_path, http, expected_sha1=hashlib.sha1(AUDIO).hexdigest()) == (
+        len(AUDIO), hashlib.sha1(AUDIO).hexdigest())
+    assert (tmp_path / "episode").read_bytes() == AUDIO
+
+
+@pytest.mark.parametrize("part", (AUDIO[:-1] + b"x", AUDIO + b"extra"))
+def test_b2_download_file_discards_bad_part(tmp_path, part):
+    (tmp_path / "episode.part").write_bytes(part)
+    http = FakeDownloads({"file-1": AUDIO})
+    with pytest.raises(IOError):
+        download(tmp_path, http, expected_sha1=hashlib.sha1(AUDIO).hexdigest())
+    assert not (tmp_path / "episode.part").exists()
+    assert not (tmp_path / "episode").exists()
+
+
+def test_b2_download_file_rejects_sha1_mismatch(tmp_path):
+    http = FakeDownloads({"file-1": AUDIO}, sha1s={"file-1": "0" * 40})
+    with pytest.raises(IOError, match="B2 expected"):
+        download(tmp_path, http)
+    assert not (tmp_path / "episode.part").exists()
+    assert not (tmp_path / "episode").exists()
+
+
+def test_b2_download_file_without_b2_sha1(tmp_path, caplog):
+    # large files have no X-Bz-Content-Sha1, nor a large_file_sha1 unless
+    # their uploader set one
+    http = FakeDownloads({"file-1": AUDIO}, sha1s={"file-1": "none"})
+    with pytest.raises(IOError, match="the scheduler expected"):
+        download(tmp_path, http, expected_sha1="0" * 40)
+    assert "B2 has no SHA-1" in caplog.text
+
+    assert download(tmp_path, http, expected_sha1=hashlib.sha1(AUDIO).hexdigest())[0] == len(AUDIO)
+    (tmp_path / "episode").unlink()
+    assert download(tmp_path, http)[0] == len(AUDIO)
+    assert "it can't be checked" in caplog.text
+
+
+def test_b2_download_file_reauthorizes(tmp_path):
+    b2_api = FakeB2Api()
+    http = FakeDownloads({"file-1": AUDIO}, expired_tokens={"token-1"})
+    with pytest.raises(IOError, match="re-authorized"):
+        download(tmp_path, http, b2_api)
+    assert b2_api.authorizations == 1
+
+    assert downloader.download_with_retry(b2_api, http, "file-1", str(tmp_path / "episode"), retries=2,
+                                          backoff=0)[0] == len(AUDIO)
+    assert [headers["Authorization"] for headers in http.requests] == ["token-1", "token-2"]
+
+
+class FakeB2Connection:
+    def __init__(self):
+        self.gets = 0
+
+    def get(self):
+        self.gets += 1
+        return FakeB2Api()
+
+
+def test_download_episodes_retries_with_backoff(tmp_path, monkeypatch):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    # file-1 fails twice then downloads, file-2 always fails
+    failures = {"file-1": 2, "file-2": 99}
+    attempts = []
+
+    def fake_download(b2_api, file_id, output_filename, http, throttle, expected_sha1):
+        attempts.append(file_id)
+        if failures.get(file_id, 0):
+            failures[file_id] -= 1
+            raise IOError(f"{file_id} failed")
+        with open(output_filename, "wb") as f:
+            f.write(file_id.encode())
+        return len(file_id), "sha1"
+
+    jitter = []
+    sleeps = []
+    monkeypatch.setattr(downloader, "b2_download_file", fake_download)
+    monkeypatch.setattr(downloader.random, "uniform", lambda low, high: jitter.append((low, high)) or high / 2)
+    monkeypatch.setattr(downloader.time, "sleep", sleeps.append)
+
+    show = {"id": 1, "title": "show"}
+    jobs = [(show, make_episode(id, 100 * id), str(tmp_path / str(id))) for id in (1, 2, 3)]
+    b2 = FakeB2Connection()
+    summary = downloader.download_episodes(b2, None, manifest, jobs, workers=1, retries=3, backoff=2)
+
+    assert attempts.count("file-1") == 3
+    assert attempts.count("file-2") == 3
+    assert attempts.count("file-3") == 1
+    # full jitter over an exponentially growing window, per episode
+    assert sorted(jitter) == [(0, 2), (0, 2), (0, 4), (0, 4)]
+    assert sorted(sleeps) == [1, 1, 2, 2]
+
+    assert b2.gets == 1
+    assert [episode["id"] for show, episode, path in summary["succeeded"]] in ([1, 3], [3, 1])
+    assert summary["skipped"] == []
+    assert [(job[1]["id"], str(e)) for job, e in summary["failed"]] == [(2, "file-2 failed")]
+    assert sorted(summary["results"]) == [1, 3]
+    assert summary["results"][1]["bytes"] == len("file-1")
+    assert manifest.get("file-1")["path"] == str(tmp_path / "1")
+    assert manifest.get("file-2") is None
+
+    # the next run only downloads what's still missing
+    summary = downloader.download_episodes(b2, None, manifest, jobs, workers=2, retries=1, backoff=0)
+    assert [job[1]["id"] for job in summary["skipped"]] in ([1, 3], [3, 1])
+    assert [job[1]["id"] for job, e in summary["failed"]] == [2]
+
+
+def test_manifest_is_current(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    episode = make_episode(1, 100)
+    path = tmp_path / "1"
+    path.write_bytes(AUDIO)
+    manifest.record("file-1", episode, 1, str(path), len(AUDIO), hashlib.sha1(AUDIO).hexdigest())
+    entry = manifest.get("file-1")
+    assert manifest.is_current(entry, str(path), rehash=True)
+    assert not manifest.is_current(entry, str(tmp_path / "elsewhere"))
+
+    # same size, new mtime
+    os.utime(path, ns=(entry["mtime_ns"] + 10 ** 9, entry["mtime_ns"] + 10 ** 9))
+    assert not manifest.is_current(entry, str(path))
+
+    # same mtime, new size
+    path.write_bytes(AUDIO[:-1])
+    os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+    assert not manifest.is_current(entry, str(path))
+
+    # corrupted in place with size and mtime put back: only a rehash notices
+    path.write_bytes(AUDIO[:-1] + b"x")
+    os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+    assert manifest.is_current(entry, str(path))
+    assert not manifest.is_current(entry, str(path), rehash=True)
+
+    path.unlink()
+    assert not manifest.is_current(entry, str(path))
+
+
+def test_download_episodes_skips_current_files(tmp_path, monkeypatch):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    http = FakeDownloads({"file-1": AUDIO})
+    show = {"id": 1, "title": "show"}
+    jobs = [(show, make_episode(1, 100), str(tmp_path / "1"))]
+
+    b2 = FakeB2Connection()
+    summary = downloader.download_episodes(b2, http, manifest, jobs, workers=1, retries=1, backoff=0)
+    assert len(summary["succeeded"]) == 1
+    assert manifest.get("file-1")["sha1"] == hashlib.sha1(AUDIO).hexdigest()
+
+    # nothing to download, so B2 isn't even connected to
+    b2 = FakeB2Connection()
+    summary = downloader.download_episodes(b2, http, manifest, jobs, workers=1, retries=1, backoff=0)
+    assert summary["skipped"] == jobs and not summary["succeeded"]
+    assert b2.gets == 0 and len(http.requests) == 1
+
+    # a file that changed size is downloaded again
+    (tmp_path / "1").write_bytes(b"truncated")
+    summary = downloader.download_episodes(b2, http, manifest, jobs, workers=1, retries=1, backoff=0)
+    assert len(summary["succeeded"]) == 1
+    assert (tmp_path / "1").read_bytes() == AUDIO
+
+    # one corrupted in place is only caught by a rehash
+    mtime_ns = manifest.get("file-1")["mtime_ns"]
+    (tmp_path / "1").write_bytes(AUDIO[:-1] + b"x")
+    os.utime(tmp_path / "1", ns=(mtime_ns, mtime_ns))
+    summary = downloader.download_episodes(b2, http, manifest, jobs, workers=1, retries=1, backoff=0)
+    assert summary["skipped"] == jobs
+    summary = downloader.download_episodes(b2, http, manifest, jobs, workers=1, retries=1, backoff=0, rehash=True)
+    assert len(summary["succeeded"]) == 1
+    assert (tmp_path / "1").read_bytes() == AUDIO
+    assert len(http.requests) == 3
+
+
+class UnreachableScheduler:
+    def get(self, url, headers, params, timeout):
+        raise requests.ConnectionError("connection refused")
+
+
+def test_get_schedule_falls_back_to_cache_when_unreachable(tmp_path):
+    cache_path = str(tmp_path / "schedule.json")
+    assert downloader.get_schedule(UnreachableScheduler(), "http://scheduler/schedule", cache_path) == ([], False)
+
+    shows = [{"id": 1, "title": "show", "episodes": []}]
+    with open(cache_path, "w") as f:
+        json.dump({"etag": '"1"', "cursor": 1, "shows": shows}, f)
+    assert downloader.get_schedule(UnreachableScheduler(), "http://scheduler/schedule", cache_path) == (shows, False)
+
+
+class UnreachableB2:
+    def get(self):
+        raise IOError("unable to authorize with B2: connection refused")
+
+
+def test_download_episodes_without_b2(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show"}
+    record_download(manifest, tmp_path, make_episode(1, 100), 10)
+    jobs = [(show, make_episode(id, 100 * id), str(tmp_path / str(id))) for id in (1, 2, 3)]
+
+    summary = downloader.download_episodes(UnreachableB2(), None, manifest, jobs, workers=1, retries=1, backoff=0)
+    assert [job[1]["id"] for job in summary["skipped"]] == [1]
+    assert [(job[1]["id"], str(e)) for job, e in summary["failed"]] == [
+        (2, "unable to authorize with B2: connection refused"), (3, "unable to authorize with B2: connection refused")]
+
+
+def test_b2_connection_wraps_connection_errors(monkeypatch):
+    b2 = downloader.B2Connection({})
+
+    def refuse():
+        raise requests.ConnectionError("connection refused")
+
+    monkeypatch.setattr(b2, "_connect", refuse)
+    with pytest.raises(IOError, match="unable to authorize with B2"):
+        b2.get()
+
+
+def make_report(id, finished_at, downloads=()):
+    return {"id": id, "started_at": finished_at - 1, "finished_at": finished_at,
+            "downloads": list(downloads), "placements": []}
+
+
+def test_status_reporter_spools_until_scheduler_is_back(tmp_path):
+    http = FakeScheduler(status_code=503)
+    reporter = StatusReporter(http, "http://scheduler/station/status", "token", str(tmp_path / "spool"))
+
+    reporter.submit(make_report("a", 100))
+    reporter.submit(make_report("b", 200))
+    assert len(reporter.spooled()) == 2
+
+    http.status_code = 200
+    reporter.submit(make_report("c", 300))
+    assert [report["id"] for report in http.reports] == ["a", "b", "c"]
+    assert reporter.spooled() == []
+
+
+def test_status_reporter_skips_quiet_reports_between_heartbeats(tmp_path):
+    http = FakeScheduler()
+    reporter = StatusReporter(http, "http://scheduler/station/status", "token", str(tmp_path / "spool"))
+
+    reporter.submit(make_report("a", 100), quiet=True)
+    reporter.submit(make_report("b", 200), quiet=True)
+    reporter.submit(make_report("c", 300, downloads=[{"status": "downloaded"}]))
+    assert [report["id"] for report in http.reports] == ["a", "c"]
+
+
+def test_parse_events():
+    lines = ["retry: 1000", "", ": heartbeat", "", "id: 7", 'data: {"operation":', 'data: "create_episode"}', "",
+             "event: reset", 'data: {"cursor": 3}', ""]
+    assert list(parse_events(lines)) == [
+        {"id": "7", "data": {"operation": "create_episode"}},
+        {"event": "reset", "data": {"cursor": 3}},
+    ]
+
+
+def test_schedule_watcher_resumes_after_last_change():
+    http = FakeStream(["id: 4", 'data: {"id": 4}', "", "id: 5", 'data: {"id": 5}', ""], [": heartbeat", ""])
+    changes = []
+    watcher = ScheduleWatcher(http, "http://scheduler/schedule/changes", changes.append, last_id=3)
+
+    watcher.follow()
+    watcher.follow()
+    assert [event["data"]["id"] for event in changes] == [4, 5]
+    assert http.last_event_ids == ["3", "5"]
+    assert watcher.connected
+
+
+def test_plan_downloads_orders_by_air_date_within_horizon(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show"}
+    jobs = [(show, make_episode(id, air_date), str(tmp_path / str(id)))
+            for id, air_date in ((1, 5000), (2, 1500), (3, 99999), (4, 1200))]
+    record_download(manifest, tmp_path, make_episode(4, 1200), 10)
+
+    jobs, urgent = downloader.plan_downloads(jobs, manifest, now=1000, horizon=10000, urgent_window=1000)
+    assert [episode["id"] for show, episode, path in jobs] == [4, 2, 1]
+    # episode 4 is already here
+    assert urgent == {2}
+
+
+def test_reruns_reuse_the_earlier_download(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show", "file_path": str(tmp_path / "playout.mp3")}
+    record_download(manifest, tmp_path, make_episode(1, 500, "rerun"), 10)
+    manifest.record_analysis("rerun", {"ok": True})
+    rerun = make_episode(2, 1500, "rerun")
+    jobs = [(show, episode, str(tmp_path / str(episode["id"]))) for episode in (make_episode(3, 2500, "rerun"), rerun)]
+
+    # one job per file, for its soonest airing, which isn't urgent since
+    # the file's already here
+    jobs, urgent = downloader.plan_downloads(jobs, manifest, now=1000, horizon=0, urgent_window=1000)
+    assert [episode["id"] for show, episode, path in jobs] == [2]
+    assert urgent == set()
+
+    assert downloader.adopt_downloads(manifest, jobs) == jobs
+    assert not (tmp_path / "1").exists()
+    entry = manifest.get("rerun")
+    assert (entry["path"], entry["episode_id"], entry["air_date"]) == (str(tmp_path / "2"), 2, 1500)
+    assert manifest.is_current(entry, str(tmp_path / "2"))
+    assert manifest.get_analysis("rerun") == {"ok": True}
+
+    # the aired episode no longer holds it, so it isn't evicted
+    assert downloader.plan_evictions(manifest, now=1000, grace=0, quota=0, protected_file_ids=set()) == []
+    placements = downloader.plan_placements([show], {1: [rerun]}, manifest, str(tmp_path), set())
+    assert [source for show, episode, source in placements] == [str(tmp_path / "2")]
+
+
+def test_token_bucket_limits_rate():
+    bucket = downloader.TokenBucket(rate=1000, burst=100)
+    start = time.monotonic()
+    bucket.consume(100)
+    bucket.consume(200)
+    assert time.monotonic() - start >= 0.19
+
+
+def write_wav(path, seconds, amplitude=0.5, silence=0.0, rate=8000, sample_width=2):
+    """A mono sine wave, with silence seconds of silence at either end."""
+    scale = 2 ** (8 * sample_width - 1) - 1
+    tone = [int(amplitude * scale * math.sin(2 * math.pi * 440 * i / rate)) for i in range(int(seconds * rate))]
+    samples = [0] * int(silence * rate) + tone + [0] * int(silence * rate)
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(sample_width)
+        f.setframerate(rate)
+        f.writeframes(b"".join(s.to_bytes(sample_width, "little", signed=True) for s in samples))
+
+
+def test_analyze_file_measures_wav(tmp_path):
+    pytest.importorskip("numpy")
+    write_wav(tmp_path / "episode.wav", 60, silence=2)
+
+    analysis = analyze_file(str(tmp_path / "episode.wav"), min_duration=30, block_seconds=1)
+    assert analysis["ok"] and analysis["analyzed"]
+    assert analysis["duration"] == pytest.approx(64)
+    assert analysis["peak_db"] == pytest.approx(-6.02, abs=0.1)
+    assert analysis["rms_db"] == pytest.approx(-9.2, abs=0.2)
+    assert analysis["leading_silence"] == pytest.approx(2, abs=0.1)
+    assert analysis["trailing_silence"] == pytest.approx(2, abs=0.1)
+
+
+def test_analyze_file_rejects_bad_audio(tmp_path):
+    pytest.importorskip("numpy")
+    write_wav(tmp_path / "short.wav", 5)
+    assert not analyze_file(str(tmp_path / "short.wav"), min_duration=30)["ok"]
+
+    write_wav(tmp_path / "silent.wav", 60, amplitude=0)
+    assert not analyze_file(str(tmp_path / "silent.wav"), min_duration=30)["ok"]
+
+    write_wav(tmp_path / "truncated.wav", 60)
+    with open(tmp_path / "truncated.wav", "r+b") as f:
+        f.truncate(os.path.getsize(tmp_path / "truncated.wav") // 2)
+    analysis = analyze_file(str(tmp_path / "truncated.wav"), min_duration=10)
+    assert not analysis["ok"] and "truncated" in analysis["problems"][0]
+
+    (tmp_path / "episode.docx").write_bytes(b"PK\x03\x04 not audio")
+    assert not analyze_file(str(tmp_path / "episode.docx"))["ok"]
+
+
+def test_analyze_file_recognizes_mp3(tmp_path):
+    (tmp_path / "episode.mp3").write_bytes(b"ID3\x04\x00" + b"\x00" * 100)
+    analysis = analyze_file(str(tmp_path / "episode.mp3"))
+    assert analysis["ok"] and analysis["format"] == "mp3" and not analysis["analyzed"]
+
+
+def test_analyze_downloads_blocks_placement(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    show = {"id": 1, "title": "show", "file_path": str(tmp_path / "playout.mp3")}
+    os.makedirs(tmp_path / "1")
+    episode = make_episode(1, 100)
+    (tmp_path / "1" / "1").write_bytes(b"not audio at all")
+    manifest.record("file-1", episode, 1, str(tmp_path / "1" / "1"), 16, None)
+
+    jobs = [(show, episode, str(tmp_path / "1" / "1"))]
+    analyses = downloader.analyze_downloads(manifest, jobs, workers=1, min_duration=60, silence_db=-50)
+    assert not analyses[1]["ok"]
+    assert manifest.get_analysis("file-1") == analyses[1]
@@ -1,4 +1,4 @@
-from flaskr import create_app
+from scheduler import create_app
 
 
 def test_config():
@@ -7,6 +7,8 @@ def test_config():
     assert create_app({"TESTING": True}).testing
 
 
-def test_hello(client):
-    response = client.get("/hello")
-    assert response.data == b"Hello, World!"
+def test_index_requires_login():
+    # no database needed: anonymous requests never touch it
+    client = create_app({"TESTING": True}).test_client()
+    response = client.get("/")
+    assert response.headers["Location"] == "/auth/login"
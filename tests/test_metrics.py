@@ -0,0 +1,64 @@
+import pytest
+from flask import g
+
+from scheduler import create_app
+from scheduler import metrics
+from scheduler.metrics import normalize_sql
+
+
+def test_normalize_sql():
+    assert normalize_sql(
+        "SELECT id\n  FROM Episodes WHERE show_id = 42 AND title = 'it''s'"
+    ) == "SELECT id FROM Episodes WHERE show_id = ? AND title = ?"
+
+
+def test_metrics_disabled(client):
+    assert client.get("/metrics").status_code == 404
+
+
+@pytest.fixture
+def metrics_client(app, monkeypatch):
+    # init_app sets these module globals; put them back afterwards
+    monkeypatch.setattr(metrics, "enabled", metrics.enabled)
+    monkeypatch.setattr(metrics, "slow_query_seconds", metrics.slow_query_seconds)
+    monkeypatch.setattr(metrics, "registry", metrics.Registry())
+    # the app fixture has already checked connections out of the pool
+    # with metrics off, as a long running worker's first app might
+    app.config["METRICS_ENABLED"] = True
+    return create_app(app.config).test_client()
+
+
+def parse_metrics(body):
+    """Map each sample line's name and labels to its value."""
+    return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in body.decode().splitlines() if line and not line.startswith("#")}
+
+
+def test_metrics(metrics_client):
+    metrics_client.get("/shows")
+    response = metrics_client.get("/metrics")
+    assert response.status_code == 200
+    samples = parse_metrics(response.data)
+    assert samples['kmgp_request_duration_seconds_count{endpoint="scheduler.get_shows"}'] == 1
+    assert samples['kmgp_request_queries_total{endpoint="scheduler.get_shows"}'] == 1
+    assert samples['kmgp_request_sql_seconds_total{endpoint="scheduler.get_shows"}'] > 0
+    assert "kmgp_db_pool_checkouts_total" in samples
+
+    # the feed is cached now, so it runs no queries
+    metrics_client.get("/shows")
+    samples = parse_metrics(metrics_client.get("/metrics").data)
+    assert samples['kmgp_request_duration_seconds_count{endpoint="scheduler.get_shows"}'] == 2
+    assert samples['kmgp_request_queries_total{endpoint="scheduler.get_shows"}'] == 1
+
+
+def test_slow_query_log(metrics_client, caplog):
+    metrics.slow_query_seconds = 0
+    with caplog.at_level("WARNING", logger="scheduler.slow_queries"):
+        metrics_client.get("/episodes?show_id=7")
+    assert "FROM Episodes WHERE show_id = %s" in caplog.text
+
+
+def test_queries_untimed_when_disabled(client):
+    with client:
+        client.get("/shows")
+        assert "metrics_queries" not in g
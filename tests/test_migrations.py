@@ -0,0 +1,31 @@
+from scheduler.db import get_migrations
+from scheduler.db import migrate_db
+from scheduler.db import split_statements
+
+
+def test_split_statements():
+    script = (
+        "-- migrate: no-transaction\n"
+        "-- a comment\n"
+        "\n"
+        "CREATE INDEX CONCURRENTLY a\n"
+        "  ON b (c);\n"
+        "\n"
+        "DROP INDEX d;\n"
+        "-- trailing comment\n"
+    )
+    assert split_statements(script) == [
+        "-- migrate: no-transaction\n-- a comment\n\nCREATE INDEX CONCURRENTLY a\n  ON b (c);",
+        "\nDROP INDEX d;",
+    ]
+
+
+def test_init_db_marks_migrations_applied(app):
+    with app.app_context():
+        assert get_migrations()
+        assert migrate_db(dry_run=True) == []
+
+
+def test_migrate_db_command(runner):
+    result = runner.invoke(args=["migrate-db"])
+    assert "up to date" in result.output
@@ -0,0 +1,177 @@
+"""EXPLAIN the hot queries against a seeded database and fail if any of
+them fall back to a sequential scan of a table that grows with the
+station's catalogue."""
+import contextlib
+import os
+
+import psycopg2
+import pytest
+from flask import g
+from psycopg2.extras import DictCursor
+
+from scheduler import create_app
+from scheduler import scheduler
+from scheduler.db import get_db
+from scheduler.db import init_db
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as f:
+    _data_sql = f.read().decode("utf8")
+
+# tables that grow without bound; everything else is small enough that a
+# sequential scan can be the right plan
+LARGE_TABLES = {"episodes", "usershowsjoin", "schedulechanges", "downloadreports"}
+
+# 5000 DJs, 2000 shows with 10 DJs each, and five years of weekly
+# episodes per show, nearly all of them in the past
+_seed_sql = """
+INSERT INTO Users (name, email, password)
+SELECT 'dj ' || i, 'dj' || i || '@example.com', 'x'
+FROM generate_series(1, 5000) i;
+
+INSERT INTO Shows (title, day_of_week, start_time, description, file_path, created_by, updated_by)
+SELECT 'show ' || i, (enum_range(NULL::weekday))[i % 7 + 1], make_time(i / 7 / 60, i / 7 % 60, 0),
+       'description', '/shows/' || i || '.mp3', 1, 1
+FROM generate_series(1, 2000) i;
+
+INSERT INTO UserShowsJoin (user_id, show_id)
+SELECT (s.id * 7 + k) % 5000 + 3, s.id
+FROM Shows s, generate_series(1, 10) k
+WHERE s.id > 1;
+
+INSERT INTO Episodes (show_id, title, air_date, file_id, original_filename, created_by, updated_by)
+SELECT s.id, 'episode ' || w,
+       date_trunc('week', CURRENT_TIMESTAMP)
+         + (w * 7 + array_position(enum_range(NULL::weekday), s.day_of_week) - 1) * interval '1 day'
+         + s.start_time::interval,
+       'file-' || s.id || '-' || w, 'episode.mp3', 1, 1
+FROM Shows s, generate_series(-250, 8) w
+WHERE s.id > 1;
+
+INSERT INTO ScheduleChanges (operation, show_id, episode_id)
+SELECT 'create_episode', show_id, id FROM Episodes;
+
+INSERT INTO StationRuns (id, started_at, finished_at, downloaded, failed)
+VALUES ('seed', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0, 0);
+
+INSERT INTO DownloadReports (run_id, show_id, episode_id, file_id, status, bytes, seconds)
+SELECT 'seed', show_id, id, file_id, 'downloaded', 100000000, 30 FROM Episodes;
+"""
+
+
+class RecordingConnection(psycopg2.extensions.connection):
+    """Connection that keeps every query its cursors run."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorded_queries = []
+
+
+class RecordingCursor(DictCursor):
+    """Cursor that keeps every query it runs, with parameters bound."""
+
+    def execute(self, query, vars=None):
+        self.connection.recorded_queries.append(self.mogrify(query, vars).decode())
+        return super().execute(query, vars)
+
+
+@pytest.fixture(scope="module")
+def app():
+    """An app whose database is seeded once for the whole module, since
+    loading it takes a while."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+
+    app = create_app({
+        "TESTING": True,
+        "SECRET_KEY": "test",
+        "DATABASE_URL": TEST_DATABASE_URL,
+    })
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.cursor().execute(_data_sql)
+        db.cursor().execute(_seed_sql)
+        db.commit()
+
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    conn.autocommit = True
+    conn.cursor().execute("VACUUM ANALYZE")
+    conn.close()
+
+    return app
+
+
+@pytest.fixture
+def recording_db(app):
+    """A connection that records the queries run on it."""
+    conn = psycopg2.connect(TEST_DATABASE_URL, connection_factory=RecordingConnection,
+                            cursor_factory=RecordingCursor)
+    yield conn
+    conn.close()
+
+
+@contextlib.contextmanager
+def request_using(app, conn, *args, **kwargs):
+    """Push a request context whose get_db() returns conn."""
+    with app.test_request_context(*args, **kwargs):
+        g.db = conn
+        try:
+            yield
+        finally:
+            # keep teardown from returning conn to the pool
+            g.pop("db")
+
+
+def seq_scans(plan):
+    """Yield the relation of every sequential scan in an EXPLAIN plan."""
+    if plan["Node Type"] == "Seq Scan":
+        yield plan["Relation Name"].lower()
+    for child in plan.get("Plans", ()):
+        yield from seq_scans(child)
+
+
+def assert_no_large_seq_scans(conn):
+    assert conn.recorded_queries
+    cur = conn.cursor()
+    for query in list(conn.recorded_queries):
+        cur.execute("EXPLAIN (FORMAT JSON) " + query)
+        plan = cur.fetchone()[0][0]["Plan"]
+        scanned = LARGE_TABLES.intersection(seq_scans(plan))
+        assert not scanned, f"sequential scan of {scanned} in:\n{query}"
+
+
+def test_index(app, recording_db):
+    with request_using(app, recording_db):
+        shows, episodes, next_cursor = scheduler.get_user_shows_page(3, page_size=2)
+        assert shows and next_cursor
+        scheduler.get_user_shows_page(3, after=scheduler.parse_show_cursor(next_cursor), page_size=2)
+    assert_no_large_seq_scans(recording_db)
+
+
+def test_get_upcoming_episodes(app, recording_db):
+    with request_using(app, recording_db, "/episodes", query_string={"show_id": 42}):
+        assert scheduler.get_upcoming_episodes()["episodes"]
+    assert_no_large_seq_scans(recording_db)
+
+
+def test_get_djs(app, recording_db):
+    with request_using(app, recording_db):
+        assert scheduler.get_djs(42)
+    assert_no_large_seq_scans(recording_db)
+
+
+def test_get_shows(app, recording_db):
+    with request_using(app, recording_db):
+        assert scheduler.get_shows()["shows"]
+    assert_no_large_seq_scans(recording_db)
+
+
+def test_get_schedule(app, recording_db):
+    with request_using(app, recording_db):
+        scheduler.get_schedule_version()
+        assert scheduler.get_schedule_shows()
+        assert scheduler.get_schedule_shows([42, 43])
+    assert_no_large_seq_scans(recording_db)
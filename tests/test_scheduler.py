@@ -0,0 +1,302 @@
+import threading
+from datetime import date
+from datetime import timedelta
+
+import psycopg2
+import pytest
+
+from scheduler.db import get_db
+from scheduler.scheduler import get_user_shows_page
+from scheduler.scheduler import parse_show_cursor
+
+NEW_SHOW = {
+    "title": "created",
+    "day_of_week": "Tuesday",
+    "start_time": "18:00",
+    "djs": [1, 2],
+    "description": "created description",
+    "file_path": "/tmp/created.mp3",
+}
+
+
+def next_monday(weeks=3):
+    """A Monday a few weeks out, for episodes of the test show."""
+    today = date.today()
+    return (today + timedelta(days=7 * weeks - today.weekday())).isoformat()
+
+
+def query_one(app, sql, vars=None):
+    with app.app_context():
+        cur = get_db().cursor()
+        cur.execute(sql, vars)
+        return cur.fetchone()
+
+
+def test_index(client, auth):
+    response = client.get("/")
+    assert response.headers["Location"] == "/auth/login"
+
+    auth.login()
+    response = client.get("/")
+    assert b"test show" in response.data
+    assert b"Mondays at 08:00 PM" in response.data
+    assert b"test episode" in response.data
+    assert b'href="/shows/1/update"' in response.data
+
+
+def test_index_only_lists_own_shows(client, auth):
+    auth.login("other@example.com", "other")
+    response = client.get("/")
+    assert b"Logged in as other" in response.data
+    assert b"test show" not in response.data
+
+
+def add_shows(app, count, created_at="2020-01-01 00:00:00"):
+    """Give the test user more shows, all created at the same moment so
+    that only their ids order them."""
+    with app.app_context():
+        db = get_db()
+        cur = db.cursor()
+        for i in range(count):
+            cur.execute(
+                "INSERT INTO Shows (title, day_of_week, start_time, description, file_path, created_by, updated_by,"
+                " created_at)"
+                " VALUES (%s, 'Tuesday', %s, '', '/tmp/show.mp3', 1, 1, %s) RETURNING id",
+                (f"show {i}", f"{i:02}:00", created_at))
+            cur.execute("INSERT INTO UserShowsJoin (user_id, show_id) VALUES (1, %s)", (cur.fetchone()["id"],))
+        db.commit()
+
+
+@pytest.mark.parametrize(("extra_shows", "page_sizes"), ((4, [2, 2, 1]), (3, [2, 2])))
+def test_show_pages(app, extra_shows, page_sizes):
+    add_shows(app, extra_shows)
+    seen = []
+    sizes = []
+    with app.app_context():
+        after = None
+        while True:
+            shows, episodes, next_cursor = get_user_shows_page(1, after=after, page_size=2)
+            assert set(episodes) == {show["id"] for show in shows}
+            seen += [show["id"] for show in shows]
+            sizes.append(len(shows))
+            if not next_cursor:
+                break
+            after = parse_show_cursor(next_cursor)
+
+    # newest first, ties on created_at broken by id, each show once and
+    # no empty page after an exactly full one
+    assert sizes == page_sizes
+    assert seen == [1] + list(range(extra_shows + 1, 1, -1))
+
+
+def test_show_page_episode_limit(app):
+    with app.app_context():
+        db = get_db()
+        db.cursor().execute(
+            "INSERT INTO Episodes (show_id, title, air_date, file_id, original_filename, description,"
+            " created_by, updated_by)"
+            " SELECT 1, 'more', '2099-01-05 20:00:00-08'::timestamptz + n * interval '7 days', 'f', 'f.mp3', '', 1, 1"
+            " FROM generate_series(1, 3) n")
+        db.commit()
+        shows, episodes, next_cursor = get_user_shows_page(1, episode_limit=2)
+    assert [episode["title"] for episode in episodes[1]] == ["test episode", "more"]
+    assert shows[0]["upcoming_count"] == 4
+    assert shows[0]["next_episode"]["title"] == "test episode"
+    assert next_cursor is None
+
+
+def test_index_pages(client, auth, app):
+    app.config["INDEX_SHOWS_PER_PAGE"] = 1
+    add_shows(app, 1)
+    auth.login()
+    response = client.get("/")
+    assert b"test show" in response.data and b"More Shows" in response.data
+
+    with app.app_context():
+        shows, episodes, next_cursor = get_user_shows_page(1, page_size=1)
+    response = client.get("/", query_string={"after": next_cursor})
+    assert b"show 0" in response.data and b"More Shows" not in response.data
+
+    assert client.get("/", query_string={"after": "garbage"}).status_code == 400
+
+
+@pytest.mark.parametrize("path", ("/shows/create", "/shows/1/update", "/shows/1/create_episode",
+                                  "/shows/1/reserve_episode", "/episodes/1/delete"))
+def test_login_required(client, path):
+    response = client.post(path)
+    assert response.headers["Location"] == "/auth/login"
+
+
+@pytest.mark.parametrize(("method", "path"), (("GET", "/shows/2/update"), ("POST", "/shows/2/create_episode"),
+                                              ("POST", "/episodes/2/delete")))
+def test_exists_required(client, auth, method, path):
+    auth.login()
+    assert client.open(path, method=method, json={}).status_code == 404
+
+
+def test_create_show(client, auth, app):
+    auth.login()
+    assert client.get("/shows/create").status_code == 200
+    response = client.post("/shows/create", json=NEW_SHOW)
+    assert response.json == {"redirect": "/"}
+
+    assert query_one(app, "SELECT COUNT(id) FROM Shows")[0] == 2
+    assert query_one(app, "SELECT COUNT(id) FROM UserShowsJoin WHERE show_id = 2")[0] == 2
+
+
+@pytest.mark.parametrize(
+    ("changes", "error"),
+    (
+        ({"title": ""}, "title is required"),
+        ({"djs": []}, "djs is required"),
+        ({"day_of_week": "Monday", "start_time": "20:00"}, "another show already exists in this timeslot"),
+    ),
+)
+def test_create_update_validate(client, auth, changes, error):
+    auth.login()
+    response = client.post("/shows/create", json=dict(NEW_SHOW, **changes))
+    assert response.status_code == 400
+    assert response.json["error"] == error
+
+
+def test_update_show(client, auth, app):
+    auth.login()
+    assert client.get("/shows/1/update").status_code == 200
+    client.post("/shows/1/update", json=dict(NEW_SHOW, title="updated", djs=[2]))
+
+    assert query_one(app, "SELECT title FROM Shows WHERE id = 1")["title"] == "updated"
+    assert query_one(app, "SELECT user_id FROM UserShowsJoin WHERE show_id = 1")["user_id"] == 2
+
+
+def test_create_episode(client, auth, app):
+    auth.login()
+    air_date = next_monday()
+    token = client.post("/shows/1/reserve_episode", json={"air_date": air_date}).json["reservation_token"]
+
+    response = client.post("/shows/1/create_episode", json={
+        "title": "created episode",
+        "description": "",
+        "air_date": air_date,
+        "file_id": "created-file-id",
+        "original_filename": "created.mp3",
+        "reservation_token": token,
+    })
+    assert response.json == {"redirect": "/"}
+    assert query_one(app, "SELECT COUNT(id) FROM Episodes WHERE show_id = 1")[0] == 2
+    assert query_one(app, "SELECT COUNT(*) FROM EpisodeReservations")[0] == 0
+
+    # the slot is taken now
+    response = client.post("/shows/1/reserve_episode", json={"air_date": air_date})
+    assert response.json["error"] == "another episode already exists in this timeslot"
+
+
+def test_reservations_hold_the_slot(client, auth):
+    air_date = next_monday()
+    auth.login()
+    assert client.post("/shows/1/reserve_episode", json={"air_date": air_date}).status_code == 200
+    # reserving again extends this DJ's own reservation
+    assert client.post("/shows/1/reserve_episode", json={"air_date": air_date}).status_code == 200
+
+    auth.logout()
+    auth.login("other@example.com", "other")
+    response = client.post("/shows/1/reserve_episode", json={"air_date": air_date})
+    assert response.json["error"] == "another DJ is uploading an episode for this timeslot"
+
+
+@pytest.mark.parametrize(
+    ("air_date", "error"),
+    (
+        (next_monday(weeks=-1), "air date is in the past"),
+        ((date.fromisoformat(next_monday()) + timedelta(days=1)).isoformat(), "air date does not match schedule"),
+    ),
+)
+def test_reserve_episode_validate(client, auth, air_date, error):
+    auth.login()
+    response = client.post("/shows/1/reserve_episode", json={"air_date": air_date})
+    assert response.status_code == 400
+    assert response.json["error"] == error
+
+
+def test_delete_episode(client, auth, app):
+    auth.login()
+    response = client.post("/episodes/1/delete")
+    assert response.headers["Location"] == "/"
+    assert query_one(app, "SELECT * FROM Episodes WHERE id = 1") is None
+
+
+def test_station_feeds(client):
+    assert client.get("/shows").json["shows"] == [
+        {"id": 1, "title": "test show", "file_path": "/tmp/test_show.mp3"}]
+
+    episodes = client.get("/episodes", query_string={"show_id": 1}).json["episodes"]
+    assert [episode["file_id"] for episode in episodes] == ["test-file-id"]
+
+
+@pytest.mark.parametrize("query_string", ({}, {"show_id": ""}, {"show_id": "one"}))
+def test_upcoming_episodes_needs_show_id(client, query_string):
+    response = client.get("/episodes", query_string=query_string)
+    assert response.status_code == 400
+    assert response.json["error"] == "show_id must be an integer"
+
+
+def test_schedule_not_modified(client, auth):
+    response = client.get("/schedule")
+    etag = response.headers["ETag"]
+    assert response.json["full"]
+
+    response = client.get("/schedule", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    auth.login()
+    client.post("/shows/create", json=NEW_SHOW)
+    assert client.get("/schedule", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_schedule_since_cursor(client, auth):
+    cursor = client.get("/schedule").json["cursor"]
+    auth.login()
+    client.post("/shows/create", json=NEW_SHOW)
+
+    feed = client.get("/schedule", query_string={"since": cursor}).json
+    assert not feed["full"]
+    assert [show["title"] for show in feed["shows"]] == ["created"]
+    assert client.get("/schedule", query_string={"since": feed["cursor"]}).json["shows"] == []
+    # a cursor from some other database gets the whole feed
+    assert client.get("/schedule", query_string={"since": feed["cursor"] + 100}).json["full"]
+
+
+def test_schedule_episode_sha1(client, app):
+    with app.app_context():
+        db = get_db()
+        db.cursor().execute(
+            "INSERT INTO AudioFiles (sha1, file_id, size, uploaded_by) VALUES (%s, 'test-file-id', 5, 1)",
+            ("a" * 40,))
+        db.commit()
+    episodes = client.get("/schedule").json["shows"][0]["episodes"]
+    assert [(episode["file_id"], episode["sha1"]) for episode in episodes] == [("test-file-id", "a" * 40)]
+
+
+def test_schedule_change_ids_follow_commit_order(client, app):
+    cursor = client.get("/schedule").json["cursor"]
+    first = psycopg2.connect(app.config["DATABASE_URL"])
+    second = psycopg2.connect(app.config["DATABASE_URL"])
+    try:
+        first.cursor().execute("INSERT INTO ScheduleChanges (operation, show_id) VALUES ('update_show', 1)")
+        # a second writer waits for the first to commit before taking an id
+        thread = threading.Thread(target=lambda: (
+            second.cursor().execute("INSERT INTO ScheduleChanges (operation, show_id) VALUES ('update_show', 1)"),
+            second.commit()))
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive()
+        assert client.get("/schedule").json["cursor"] == cursor
+        first.commit()
+        thread.join()
+    finally:
+        first.close()
+        second.close()
+
+    feed = client.get("/schedule", query_string={"since": cursor}).json
+    assert feed["cursor"] == cursor + 2
+    assert [show["id"] for show in feed["shows"]] == [1]
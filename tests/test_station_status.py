@@ -0,0 +1,100 @@
+import pytest
+
+from scheduler.db import get_db
+
+HEADERS = {"Authorization": "Bearer station-token"}
+
+
+@pytest.fixture
+def app(app):
+    app.config["STATION_TOKEN"] = "station-token"
+    return app
+
+
+def make_report(id="run-1", placed_at=1000):
+    return {
+        "id": id,
+        "started_at": 900,
+        "finished_at": 1000,
+        "downloads": [
+            {"show_id": 1, "episode_id": 1, "file_id": "test-file-id", "status": "downloaded",
+             "bytes": 1234, "seconds": 1.5, "sha1": "da39a3ee5e6b4b0d3255bfef95601890afd80709"},
+            {"show_id": 1, "episode_id": 2, "file_id": "missing", "status": "failed", "error": "404"},
+        ],
+        "placements": [{"show_id": 1, "episode_id": 1, "file_id": "test-file-id", "placed_at": placed_at}],
+    }
+
+
+def test_requires_station_token(client):
+    assert client.post("/station/status", json=make_report()).status_code == 401
+    assert client.post("/station/status", json=make_report(),
+                       headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+
+def test_rejects_malformed_report(client):
+    assert client.post("/station/status", json={"id": "run-1"}, headers=HEADERS).status_code == 400
+    report = make_report()
+    report["downloads"][0]["status"] = "great"
+    assert client.post("/station/status", json=report, headers=HEADERS).status_code == 400
+
+
+@pytest.mark.parametrize(("path", "value"), (
+    (("started_at",), None),
+    (("id",), None),
+    (("downloads", 0, "episode_id"), None),
+    (("downloads", 0, "show_id"), "1"),
+    (("downloads", 0, "bytes"), "lots"),
+    (("placements", 0, "placed_at"), None),
+    (("placements", 0, "file_id"), None),
+))
+def test_rejects_null_and_mistyped_fields(client, app, path, value):
+    report = make_report()
+    parent = report
+    for key in path[:-1]:
+        parent = parent[key]
+    parent[path[-1]] = value
+    assert client.post("/station/status", json=report, headers=HEADERS).status_code == 400
+
+    with app.app_context():
+        cur = get_db().cursor()
+        cur.execute("SELECT count(*) FROM StationRuns")
+        assert cur.fetchone()[0] == 0
+
+
+def test_rejects_values_the_database_refuses(client):
+    report = make_report()
+    report["downloads"][0]["bytes"] = 10 ** 30
+    assert client.post("/station/status", json=report, headers=HEADERS).status_code == 400
+    # and the run can be reported again once it's fixed
+    assert client.post("/station/status", json=make_report(), headers=HEADERS).json["status"] == "stored"
+
+
+def test_stores_report_once(client, app):
+    assert client.post("/station/status", json=make_report(), headers=HEADERS).json["status"] == "stored"
+    assert client.post("/station/status", json=make_report(), headers=HEADERS).json["status"] == "duplicate"
+
+    with app.app_context():
+        cur = get_db().cursor()
+        cur.execute("SELECT downloaded, failed FROM StationRuns")
+        assert cur.fetchall() == [[1, 1]]
+        cur.execute("SELECT episode_id, status FROM DownloadReports ORDER BY id")
+        assert cur.fetchall() == [[1, "downloaded"], [2, "failed"]]
+        cur.execute("SELECT episode_id, run_id FROM StationPlacements WHERE show_id = 1")
+        assert cur.fetchone() == [1, "run-1"]
+
+
+def test_older_placements_dont_win(client, app):
+    client.post("/station/status", json=make_report("run-2", placed_at=2000), headers=HEADERS)
+    client.post("/station/status", json=make_report("run-1", placed_at=1000), headers=HEADERS)
+
+    with app.app_context():
+        cur = get_db().cursor()
+        cur.execute("SELECT run_id FROM StationPlacements WHERE show_id = 1")
+        assert cur.fetchone() == ["run-2"]
+
+
+def test_dashboard_shows_sync_state(client, auth):
+    client.post("/station/status", json=make_report(), headers=HEADERS)
+    auth.login()
+    response = client.get("/")
+    assert b"Ready to Air" in response.data
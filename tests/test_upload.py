@@ -0,0 +1,279 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from datetime import time as time_of_day
+
+import pytest
+
+from scheduler.db import get_db
+from scheduler import scheduler
+from scheduler.scheduler import get_audio_file_verifier
+from scheduler.storage import B2UploadCache
+from scheduler.upload import MIN_PART_SIZE
+from scheduler.upload import UploadClient
+from scheduler.upload import find_archive_files
+from scheduler.upload import sha1_file
+from test_scheduler import next_monday
+from test_scheduler import query_one
+
+# the local B2 stand-in the benchmarks use
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from fake_b2 import FakeB2  # noqa: E402
+
+
+@pytest.fixture
+def b2():
+    server = FakeB2({})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def use_b2(app, b2, monkeypatch):
+    app.config.update(B2_UPLOAD_KEY_ID="fake-key-id", B2_UPLOAD_KEY="fake-key", B2_BUCKET_ID="fake-bucket",
+                      B2_REALM=b2.url)
+    monkeypatch.setattr("scheduler.storage._upload_cache", None)
+
+
+def make_client(b2, **kwargs):
+    return UploadClient(B2UploadCache("fake-key-id", "fake-key", "fake-bucket", realm=b2.url, pool_size=1),
+                        part_size=MIN_PART_SIZE, backoff=0, **kwargs)
+
+
+def test_sha1_file(tmp_path):
+    path = tmp_path / "audio.mp3"
+    path.write_bytes(b"x" * 100000)
+    assert sha1_file(str(path), chunk_size=4096) == hashlib.sha1(b"x" * 100000).hexdigest()
+
+
+def test_find_archive_files(tmp_path):
+    (tmp_path / "2021").mkdir()
+    for name in ("2021/show 2021-03-01.mp3", "show_20200106.WAV", "undated.mp3", "2020-02-30.mp3",
+                 "tuesday 2021-03-02.mp3", "notes.txt"):
+        (tmp_path / name).write_bytes(b"")
+
+    files, skipped = find_archive_files(str(tmp_path), {"day_of_week": "Monday", "start_time": time_of_day(20, 0)})
+
+    assert [(os.path.basename(path), f"{air_date:%Y-%m-%d %H:%M %z}") for path, air_date in files] == [
+        ("show_20200106.WAV", "2020-01-06 20:00 -0800"),
+        ("show 2021-03-01.mp3", "2021-03-01 20:00 -0800"),
+    ]
+    assert sorted((os.path.basename(path), reason) for path, reason in skipped) == [
+        ("2020-02-30.mp3", "no date in its name"),
+        ("tuesday 2021-03-02.mp3", "air date does not match schedule"),
+        ("undated.mp3", "no date in its name"),
+    ]
+
+
+@pytest.mark.parametrize("size", (1000, 3 * MIN_PART_SIZE + 1))
+def test_upload_file(b2, tmp_path, size):
+    path = tmp_path / "audio.mp3"
+    path.write_bytes(os.urandom(size))
+    sha1 = hashlib.sha1(path.read_bytes()).hexdigest()
+
+    uploaded = make_client(b2).upload_file(str(path), file_info={"show-title": "test"})
+
+    assert uploaded == {"file_id": uploaded["file_id"], "sha1": sha1, "size": size}
+    assert b2.files[uploaded["file_id"]] == path.read_bytes()
+    # named by content, the way the upload page names them
+    assert b2.uploads[uploaded["file_id"]]["fileName"] == sha1
+    assert b2.stats["parts"] == (0 if size < MIN_PART_SIZE else 4)
+
+
+def test_upload_file_retries(b2, tmp_path):
+    b2.fail_rate = 0.3
+    client = make_client(b2, retries=20)
+    for i in range(10):
+        path = tmp_path / f"audio{i}.mp3"
+        path.write_bytes(os.urandom(1000))
+        assert b2.files[client.upload_file(str(path))["file_id"]] == path.read_bytes()
+    assert b2.stats["failures"]
+
+
+def test_ingest_episodes(app, runner, b2, tmp_path, monkeypatch):
+    use_b2(app, b2, monkeypatch)
+    # the test show is on Mondays, and 2099-01-05 already has an episode
+    for name in ("test show 2020-01-06.mp3", "tëst show 2020-01-13.mp3", "test show 2099-01-05.mp3", "undated.mp3",
+                 "test show 2020-01-14.mp3"):
+        (tmp_path / name).write_bytes(name.encode())
+
+    result = runner.invoke(args=["ingest-episodes", "1", str(tmp_path), "--user", "test@example.com"])
+    assert result.exit_code == 0, result.output
+    assert "Created 2 episodes, 0 failed." in result.output
+    assert "undated.mp3: no date in its name" in result.output
+    assert "2020-01-14.mp3: air date does not match schedule" in result.output
+    assert "2099-01-05 20:00 already has an episode" in result.output
+
+    with app.app_context():
+        cur = get_db().cursor()
+        cur.execute("SELECT title, file_id FROM Episodes WHERE air_date < '2021-01-01' ORDER BY air_date")
+        episodes = cur.fetchall()
+    assert [episode["title"] for episode in episodes] == ["test show 2020-01-06", "tëst show 2020-01-13"]
+    assert b2.files[episodes[0]["file_id"]] == b"test show 2020-01-06.mp3"
+
+    # running it again uploads nothing
+    result = runner.invoke(args=["ingest-episodes", "1", str(tmp_path), "--user", "test@example.com"])
+    assert "Created 0 episodes, 0 failed." in result.output
+    assert b2.stats["uploads"] == 2
+
+    # a rerun of audio that's already in B2 isn't uploaded again
+    (tmp_path / "test show 2020-01-20.mp3").write_bytes(b"test show 2020-01-06.mp3")
+    result = runner.invoke(args=["ingest-episodes", "1", str(tmp_path), "--user", "test@example.com"])
+    assert "Reused" in result.output and "Created 1 episodes, 0 failed." in result.output
+    assert b2.stats["uploads"] == 2
+    assert query_one(app, "SELECT COUNT(*) FROM AudioFiles")[0] == 2
+
+
+def test_find_audio_file(client, auth, app):
+    sha1 = hashlib.sha1(b"audio").hexdigest()
+    auth.login()
+    assert client.get(f"/audio_files/{sha1}").status_code == 400
+    assert client.get("/audio_files/not-a-sha1?size=5").status_code == 400
+    assert client.get(f"/audio_files/{sha1}?size=5").status_code == 404
+
+    with app.app_context():
+        db = get_db()
+        db.cursor().execute("INSERT INTO AudioFiles (sha1, file_id, size, uploaded_by) VALUES (%s, 'stored', 5, 1)",
+                            (sha1,))
+        db.commit()
+    assert client.get(f"/audio_files/{sha1}?size=5").json == {"file_id": "stored"}
+    # the same hash with another size isn't the same audio
+    assert client.get(f"/audio_files/{sha1}?size=6").status_code == 404
+
+
+@pytest.mark.parametrize(("claimed", "recorded"), ((None, True), ("0" * 40, False)))
+def test_create_episode_records_audio_file(client, auth, app, b2, tmp_path, monkeypatch, claimed, recorded):
+    use_b2(app, b2, monkeypatch)
+    path = tmp_path / "audio.mp3"
+    path.write_bytes(os.urandom(1000))
+    uploaded = make_client(b2).upload_file(str(path), file_info={"uploader-uid": "1"})
+
+    # hold the check back until the POST has been seen to make no B2 calls
+    checked = threading.Event()
+    verify = scheduler.verify_audio_file
+    monkeypatch.setattr(scheduler, "verify_audio_file", lambda *args: checked.wait(5) and verify(*args))
+
+    auth.login()
+    requests = b2.stats["requests"]
+    response = client.post("/shows/1/create_episode", json={
+        "title": "created episode",
+        "description": "",
+        "air_date": next_monday(),
+        "file_id": uploaded["file_id"],
+        "original_filename": "audio.mp3",
+        "sha1": claimed or uploaded["sha1"],
+        "size": uploaded["size"],
+    })
+    assert response.json == {"redirect": "/"}
+    # B2 is asked about the audio after the POST returns
+    assert b2.stats["requests"] == requests
+    checked.set()
+    with app.app_context():
+        get_audio_file_verifier().join()
+
+    # only audio B2 vouches for is offered to later uploads
+    response = client.get(f"/audio_files/{claimed or uploaded['sha1']}?size={uploaded['size']}")
+    assert response.status_code == (200 if recorded else 404)
+    if recorded:
+        assert response.json == {"file_id": uploaded["file_id"]}
+
+
+def test_upload_cache_reauthorizes_after_ttl(b2):
+    cache = B2UploadCache("fake-key-id", "fake-key", "fake-bucket", realm=b2.url, auth_ttl=0.2)
+    first = cache.session
+    assert cache.session is first
+    assert b2.stats["authorizations"] == 1
+
+    time.sleep(0.3)
+    assert cache.session is not first
+    assert b2.stats["authorizations"] == 2
+
+
+def test_upload_cache_keeps_old_session_while_reauthorizing(b2):
+    cache = B2UploadCache("fake-key-id", "fake-key", "fake-bucket", realm=b2.url)
+    old = cache.session
+    cache.auth_ttl = 0
+    b2.latency = 1
+    refresh = threading.Thread(target=lambda: cache.session)
+    refresh.start()
+    time.sleep(0.2)
+
+    # a slow authorization doesn't hold up other requests
+    start = time.monotonic()
+    assert cache.session is old
+    assert time.monotonic() - start < 0.5
+    refresh.join()
+    assert b2.stats["authorizations"] == 2
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_upload_cache_refills_url_pool(b2):
+    cache = B2UploadCache("fake-key-id", "fake-key", "fake-bucket", realm=b2.url, pool_size=3)
+    assert cache.get_upload_url()["uploadUrl"] == f"{b2.url}/upload"
+    # the first URL had to be fetched; the pool then fills behind it
+    wait_for(lambda: len(cache._urls) == 3)
+    assert b2.stats["upload_urls"] == 4
+
+    cache.get_upload_url()
+    wait_for(lambda: b2.stats["upload_urls"] == 5 and len(cache._urls) == 3)
+
+    # URLs kept past their TTL are dropped rather than handed out
+    cache.url_ttl = 0
+    cache.get_upload_url()
+    assert b2.stats["upload_urls"] >= 6
+
+
+def start_large_file(client, **json):
+    return client.post("/shows/1/uploads", json=dict({"file_name": "audio"}, **json))
+
+
+def test_large_file_upload(client, auth, app, b2, monkeypatch):
+    use_b2(app, b2, monkeypatch)
+    auth.login()
+    sha1 = hashlib.sha1(b"audio").hexdigest()
+    file_id = start_large_file(client, sha1=sha1, file_info={"show-title": "test%20show"}).json["file_id"]
+    assert query_one(app, "SELECT show_id, created_by FROM LargeFileUploads WHERE file_id = %s",
+                     (file_id,)) == [1, 1]
+    assert b2.uploads[file_id]["fileInfo"] == {"show-title": "test%20show", "uploader-uid": "1",
+                                              "large_file_sha1": sha1}
+
+    assert client.post(f"/uploads/{file_id}/part_url", json={}).json["upload_url"].endswith(file_id)
+    assert client.get(f"/uploads/{file_id}/parts").json == {"parts": []}
+
+
+@pytest.mark.parametrize("json", (
+    {"file_info": ["original-filename"]},
+    {"file_info": {"large_file_sha1": "0" * 40}},
+    {"file_info": {"uploader-uid": "2"}},
+    {"file_info": {"show-title": 1}},
+    {"sha1": "not-a-sha1"},
+))
+def test_start_upload_validates_file_info(client, auth, app, b2, monkeypatch, json):
+    use_b2(app, b2, monkeypatch)
+    auth.login()
+    assert start_large_file(client, **json).status_code == 400
+    assert not b2.uploads
+
+
+def test_large_file_belongs_to_its_uploader(client, auth, app, b2, monkeypatch):
+    use_b2(app, b2, monkeypatch)
+    auth.login()
+    file_id = start_large_file(client).json["file_id"]
+
+    auth.login("other@example.com", "other")
+    assert client.post(f"/uploads/{file_id}/part_url", json={}).status_code == 404
+    assert client.get(f"/uploads/{file_id}/parts").status_code == 404
+    assert client.post(f"/uploads/{file_id}/finish", json={"part_sha1_array": []}).status_code == 404
+    # nor can anyone use a file id that never went through the scheduler
+    auth.login()
+    assert client.get("/uploads/unknown/parts").status_code == 404